@@ -0,0 +1,385 @@
+# Local stand-in for an AGWPE server
+#
+# Speaks the subset of the AGWPE TCP protocol pyham_pe uses: version, port
+# information and capabilities, callsign registration, and connect, data and
+# disconnect frames. Instead of a radio, the "air" is a set of simulated
+# Station objects. Frames the BBS sends to a callsign are handed to the
+# station with that callsign, and stations open connections, send lines and
+# hang up towards the BBS. No radio hardware or real AGWPE server is needed.
+#
+# Everything runs in one thread. Stations must only be used from that thread,
+# i.e. from their callbacks and from functions given to call_later or
+# call_soon.
+
+import heapq
+import itertools
+import logging
+import queue
+import selectors
+import socket
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Same header layout as pe._HDR_FMT
+header_format = "BxxxBxBx10s10sIxxxx"
+header_length = struct.calcsize(header_format)
+pid_no_layer3 = 0xF0
+
+# AGWPE version reported to the client
+version = (2005, 127)
+# Baud rate code, traffic level, TX delay, TX tail, persistence, slot time,
+# max frames, active connections, bytes received in the last 2 minutes
+port_caps = (0, 0, 30, 10, 63, 10, 7, 0, 0)
+
+
+def pack_frame(port, kind, call_from, call_to, data=b"", pid=0):
+  header = struct.pack(
+    header_format,
+    port,
+    ord(kind),
+    pid,
+    call_from.encode(),
+    call_to.encode(),
+    len(data),
+  )
+  return header + data
+
+
+def unpack_header(buffer):
+  port, kind, pid, call_from, call_to, length = struct.unpack(
+    header_format, buffer[:header_length]
+  )
+  return (
+    port,
+    chr(kind),
+    pid,
+    call_from.rstrip(b"\0").decode(errors="replace"),
+    call_to.rstrip(b"\0").decode(errors="replace"),
+    length,
+  )
+
+
+class Timer:
+  __slots__ = ("due", "func", "args", "cancelled")
+
+  def __init__(self, due, func, args):
+    self.due = due
+    self.func = func
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+
+class Station:
+  """
+  A simulated station on the air. Subclass it and override the callbacks to
+  script what the station does.
+  """
+
+  def __init__(self, call, port=0):
+    self.call = call
+    self.port = port
+    self.emulator = None
+    self.connected = False
+    self.buffer = bytearray()
+    self._expect = None
+    self._expect_timer = None
+
+  # === Actions ===
+
+  def connect(self):
+    """Open a connection to the BBS."""
+    self.buffer.clear()
+    self.connected = True
+    self.emulator.send_to_bbs(
+      self.port, "C", self.call, f"*** CONNECTED To Station {self.call}\r\0"
+    )
+
+  def send(self, text):
+    """Send a line to the BBS."""
+    self.emulator.send_to_bbs(self.port, "D", self.call, text + "\r", pid_no_layer3)
+
+  def disconnect(self):
+    """Hang up."""
+    self.cancel_expect()
+    self.connected = False
+    self.emulator.send_to_bbs(
+      self.port, "d", self.call, f"*** DISCONNECTED From Station {self.call}\r\0"
+    )
+
+  def expect(self, pattern, callback, timeout=None):
+    """
+    Call callback once pattern has been received, with everything received up
+    to and including it. Calls on_timeout if it does not arrive in time.
+    """
+    self.cancel_expect()
+    self._expect = (pattern, callback)
+    if timeout is not None:
+      self._expect_timer = self.emulator.call_later(timeout, self._expired)
+    self._match()
+
+  def cancel_expect(self):
+    self._expect = None
+    if self._expect_timer is not None:
+      self._expect_timer.cancel()
+      self._expect_timer = None
+
+  def _expired(self):
+    self._expect_timer = None
+    if self._expect is not None:
+      pattern, _ = self._expect
+      self._expect = None
+      self.on_timeout(pattern)
+
+  def _match(self):
+    if self._expect is None:
+      return
+    pattern, callback = self._expect
+    end = self.buffer.find(pattern)
+    if end < 0:
+      return
+    end += len(pattern)
+    received = bytes(self.buffer[:end])
+    del self.buffer[:end]
+    self.cancel_expect()
+    callback(received)
+
+  # === Callbacks ===
+
+  def on_data(self, data):
+    """Data from the BBS."""
+    self.buffer += data
+    self._match()
+
+  def on_disconnected(self):
+    """The BBS closed the connection."""
+    self.cancel_expect()
+    self.connected = False
+
+  def on_timeout(self, pattern):
+    logger.warning("%s: timed out waiting for %r", self.call, pattern)
+
+
+class Emulator:
+  """AGWPE server which connects simulated stations to the BBS."""
+
+  def __init__(self, host="127.0.0.1", port=0, ports=1):
+    self.ports = ports
+    self.sock = socket.create_server((host, port))
+    self.sock.setblocking(False)
+    self.address = self.sock.getsockname()
+    # Callsigns the client has registered, i.e. the BBS callsign
+    self.registered = []
+    self.registered_event = threading.Event()
+    self.stations = {}
+    self.frames_to_bbs = 0
+    self.frames_from_bbs = 0
+    self.bytes_from_bbs = 0
+    self._client = None
+    self._inbuf = bytearray()
+    self._outbuf = bytearray()
+    self._timers = []
+    self._sequence = itertools.count()
+    self._calls = queue.SimpleQueue()
+    self._selector = selectors.DefaultSelector()
+    self._wakeup_r, self._wakeup_w = socket.socketpair()
+    self._wakeup_r.setblocking(False)
+    self._wakeup_w.setblocking(False)
+    self._running = False
+    self._thread = None
+
+  @property
+  def bbs_call(self):
+    return self.registered[0] if self.registered else None
+
+  def add_station(self, station):
+    station.emulator = self
+    self.stations[(station.port, station.call)] = station
+    return station
+
+  def start(self):
+    self._selector.register(self.sock, selectors.EVENT_READ, self._accept)
+    self._selector.register(self._wakeup_r, selectors.EVENT_READ, self._drain_wakeup)
+    self._running = True
+    self._thread = threading.Thread(target=self._run, name="agwpe-emulator")
+    self._thread.daemon = True
+    self._thread.start()
+    logger.info("AGWPE emulator listening on %s:%s", *self.address)
+
+  def stop(self):
+    self.call_soon(self._stop)
+    self._thread.join(timeout=5)
+
+  def _stop(self):
+    self._running = False
+
+  # === Scheduling ===
+
+  def call_later(self, delay, func, *args):
+    """Run func in the emulator thread after delay seconds."""
+    timer = Timer(time.monotonic() + delay, func, args)
+    heapq.heappush(self._timers, (timer.due, next(self._sequence), timer))
+    return timer
+
+  def call_soon(self, func, *args):
+    """Run func in the emulator thread. Safe to call from any thread."""
+    self._calls.put((func, args))
+    try:
+      self._wakeup_w.send(b"\0")
+    except BlockingIOError:
+      pass
+
+  def _run(self):
+    while self._running:
+      timeout = None
+      if self._timers:
+        timeout = max(0, self._timers[0][0] - time.monotonic())
+      for key, events in self._selector.select(timeout):
+        key.data(key.fileobj, events)
+      now = time.monotonic()
+      while self._timers and self._timers[0][0] <= now:
+        _, _, timer = heapq.heappop(self._timers)
+        if not timer.cancelled:
+          self._dispatch(timer.func, timer.args)
+    if self._client is not None:
+      self._client.close()
+    self._selector.close()
+    self.sock.close()
+
+  def _dispatch(self, func, args):
+    try:
+      func(*args)
+    except Exception:
+      logger.exception("Error in emulator callback %s", func)
+
+  def _drain_wakeup(self, sock, events):
+    try:
+      while sock.recv(512):
+        pass
+    except BlockingIOError:
+      pass
+    while True:
+      try:
+        func, args = self._calls.get_nowait()
+      except queue.Empty:
+        return
+      self._dispatch(func, args)
+
+  # === Client connection ===
+
+  def _accept(self, sock, events):
+    client, addr = sock.accept()
+    if self._client is not None:
+      logger.warning("Refusing second AGWPE client from %s", addr)
+      client.close()
+      return
+    logger.info("AGWPE client connected from %s", addr)
+    client.setblocking(False)
+    # Frames are small; do not let Nagle add latency to the measurements
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._client = client
+    self._selector.register(client, selectors.EVENT_READ, self._io)
+
+  def _io(self, client, events):
+    if events & selectors.EVENT_WRITE:
+      self._write()
+    if not events & selectors.EVENT_READ:
+      return
+    try:
+      data = client.recv(65536)
+    except BlockingIOError:
+      return
+    except OSError:
+      data = b""
+    if not data:
+      logger.info("AGWPE client disconnected")
+      self._selector.unregister(client)
+      client.close()
+      self._client = None
+      self._inbuf.clear()
+      self._outbuf.clear()
+      return
+    self._inbuf += data
+    while len(self._inbuf) >= header_length:
+      port, kind, pid, call_from, call_to, length = unpack_header(self._inbuf)
+      if len(self._inbuf) < header_length + length:
+        break
+      payload = bytes(self._inbuf[header_length : header_length + length])
+      del self._inbuf[: header_length + length]
+      self._frame_received(port, kind, pid, call_from, call_to, payload)
+
+  def _send(self, frame):
+    if self._client is None:
+      return
+    was_empty = not self._outbuf
+    self._outbuf += frame
+    if was_empty:
+      self._write()
+
+  def _write(self):
+    try:
+      sent = self._client.send(self._outbuf)
+    except BlockingIOError:
+      sent = 0
+    except OSError as e:
+      logger.error("Error writing to AGWPE client: %s", e)
+      self._outbuf.clear()
+      return
+    del self._outbuf[:sent]
+    events = selectors.EVENT_READ
+    if self._outbuf:
+      events |= selectors.EVENT_WRITE
+    self._selector.modify(self._client, events, self._io)
+
+  def send_to_bbs(self, port, kind, call_from, data, pid=0):
+    if isinstance(data, str):
+      data = data.encode()
+    self.frames_to_bbs += 1
+    self._send(pack_frame(port, kind, call_from, self.bbs_call or "", data, pid))
+
+  # === Frames from the client ===
+
+  def _frame_received(self, port, kind, pid, call_from, call_to, data):
+    match kind:
+      case "R":
+        self._send(pack_frame(0, "R", "", "", struct.pack("H2xH2x", *version)))
+      case "G":
+        info = f"{self.ports};"
+        info += "".join(f"Port{i + 1} Soak test emulator;" for i in range(self.ports))
+        self._send(pack_frame(0, "G", "", "", info.encode() + b"\0"))
+      case "g":
+        self._send(pack_frame(port, "g", "", "", struct.pack("8BI", *port_caps)))
+      case "X":
+        if call_from not in self.registered:
+          self.registered.append(call_from)
+        self._send(pack_frame(0, "X", call_from, "", b"\x01"))
+        self.registered_event.set()
+      case "x":
+        if call_from in self.registered:
+          self.registered.remove(call_from)
+      case "y":
+        self._send(pack_frame(port, "y", "", "", struct.pack("I", 0)))
+      case "Y":
+        self._send(pack_frame(port, "Y", call_from, call_to, struct.pack("I", 0)))
+      case "D":
+        self.frames_from_bbs += 1
+        self.bytes_from_bbs += len(data)
+        station = self.stations.get((port, call_to))
+        if station is not None and station.connected:
+          station.on_data(data)
+      case "d":
+        # Confirm the disconnect, as AGWPE does once the link is down
+        message = f"*** DISCONNECTED From Station {call_to}\r\0"
+        self._send(pack_frame(port, "d", call_to, call_from, message.encode()))
+        station = self.stations.get((port, call_to))
+        if station is not None and station.connected:
+          station.on_disconnected()
+      case "m" | "k":
+        pass
+      case _:
+        logger.warning("Unsupported AGWPE frame %r from %s", kind, call_from)
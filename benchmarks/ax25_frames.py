@@ -0,0 +1,86 @@
+# AX.25 frame and airtime benchmark
+#
+# Runs a set of commands against an in-memory AX.25 connection and counts
+# the I frames the BBS sends for each, with and without output coalescing.
+# Airtime is estimated from the frame sizes at the given baud rate. Run it
+# from the repository root:
+#
+#   python3 benchmarks/ax25_frames.py --baud 1200 --paclen 128
+
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from oglbbs import bbs  # noqa: E402
+from oglbbs import bbs_db  # noqa: E402
+from oglbbs import session_manager  # noqa: E402
+
+from fakes import FakeConnection  # noqa: E402
+
+# Flags, addresses, control, PID and FCS of an I frame
+frame_overhead = 20
+
+commands = ["HELP", "INFO", "LIST", "READ", "WHO", "VER", "LIST\rREAD\rVER"]
+
+
+def airtime(frames, baud):
+  return sum((length + frame_overhead) * 8 / baud for length in frames)
+
+
+def measure(db_file, coalesce, baud):
+  bbs.coalesce_output = coalesce
+  results = []
+  conn = FakeConnection()
+  session_manager.add_ax25("BE0NCH", "N0CALL", 0, conn)
+  bbs.send_greeting("BE0NCH", "N0CALL", 0)
+  results.append(("(greeting)", conn.frames))
+  for command in commands:
+    conn.frames = []
+    bbs.handle_data(db_file, "BE0NCH", "N0CALL", 0, (command + "\r").encode())
+    results.append((command.replace("\r", " + "), conn.frames))
+  session_manager.remove("BE0NCH", "N0CALL", 0)
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description="oglbbs AX.25 frame benchmark")
+  parser.add_argument("--baud", type=int, default=1200)
+  parser.add_argument("--paclen", type=int, default=128)
+  args = parser.parse_args()
+
+  db_file = os.path.join(tempfile.mkdtemp(), "bench.db")
+  with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    bbs_db.init_db(db_file)
+    db = bbs_db.get_db(db_file)
+    for i in range(5):
+      bbs_db.store_message(db, "N0CAL", f"Bulletin number {i}")
+      bbs_db.store_private_message(db, "N0CAL", "BE0NCH", f"Private message {i}")
+    bbs.init("OGL BBS", db_file)
+    bbs.set_paclen(args.paclen)
+    before = measure(db_file, False, args.baud)
+    after = measure(db_file, True, args.baud)
+
+  print(f"paclen {args.paclen}, {args.baud} baud")
+  print(f"{'command':<20} {'frames':>13} {'airtime (s)':>17}")
+  total = [0, 0, 0.0, 0.0]
+  for (command, old), (_, new) in zip(before, after):
+    old_time = airtime(old, args.baud)
+    new_time = airtime(new, args.baud)
+    total[0] += len(old)
+    total[1] += len(new)
+    total[2] += old_time
+    total[3] += new_time
+    print(
+      f"{command:<20} {len(old):>5} -> {len(new):<5} {old_time:>7.2f} -> {new_time:<7.2f}"
+    )
+  print(
+    f"{'total':<20} {total[0]:>5} -> {total[1]:<5} {total[2]:>7.2f} -> {total[3]:<7.2f}"
+  )
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,335 @@
+# Command dispatcher and database benchmark
+#
+# Drives bbs.handle_command directly for every command, including the chat
+# states, over in-memory fake transports. Each command runs against seeded
+# databases of several sizes. Seeded databases are cached in --data-dir, as
+# the large ones take a while to build. Run it from the repository root:
+#
+#   python3 benchmarks/dispatch.py --sizes 1k,100k,1M -o results.json
+#   python3 benchmarks/dispatch.py --sizes 1k --compare results.json
+#
+# Reports commands/s, mean, p50 and p99 latency and the memory allocated per
+# command, and saves the results as JSON for comparing releases.
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from oglbbs import bbs  # noqa: E402
+from oglbbs import bbs_db  # noqa: E402
+from oglbbs import ratelimit  # noqa: E402
+from oglbbs import session_manager  # noqa: E402
+
+from fakes import FakeChannel, FakeConnection  # noqa: E402
+
+bbs_call = "N0CALL"
+port = 0
+# Station A is connected over SSH, station B over AX.25
+call_a = "BE0NCH"
+call_b = "BE1NCH-1"
+# Private messages seeded for each of the stations
+mailbox_size = 200
+# Share of private messages in the seeded database
+private_share = 0.5
+seed_batch = 10000
+
+
+def parse_size(text):
+  text = text.strip().lower()
+  multiplier = 1
+  if text.endswith("k"):
+    multiplier, text = 1000, text[:-1]
+  elif text.endswith("m"):
+    multiplier, text = 1000000, text[:-1]
+  return int(float(text) * multiplier)
+
+
+def seed(db_file, size):
+  """Create a database with size messages, to and from many stations."""
+  bbs_db.init_db(db_file)
+  bbs_db.shutdown()
+  db = sqlite3.connect(db_file)
+  rng = random.Random(size)
+  calls = [f"N{i % 10}X{chr(65 + i % 26)}{chr(65 + i // 26 % 26)}" for i in range(1000)]
+  own = [call_a, call_b]
+  rows = []
+  for i in range(size):
+    sender = rng.choice(calls)
+    content = f"Message {i} " + "x" * rng.randint(10, 120)
+    if i < mailbox_size * len(own):
+      recipient = own[i % len(own)]
+    elif rng.random() < private_share:
+      recipient = rng.choice(calls)
+    else:
+      recipient = None
+    rows.append((sender, recipient, bbs_db.base_callsign(recipient or ""), content))
+    if len(rows) == seed_batch:
+      _insert(db, rows)
+      rows = []
+  _insert(db, rows)
+  # Leave a single file behind, without the WAL, so it can be copied
+  db.execute("PRAGMA journal_mode = DELETE")
+  db.close()
+
+
+def _insert(db, rows):
+  with db:
+    db.executemany(
+      """
+        INSERT INTO messages (sender, recipient, base_recipient, content, is_private)
+        VALUES (?, ?, NULLIF(?, ''), ?, ? IS NOT NULL)
+      """,
+      [(s, r, b, c, r) for s, r, b, c in rows],
+    )
+
+
+def seeded_db(data_dir, size):
+  # Seeded with the current schema, so triggers fill derived tables and indexes
+  schema = len(bbs_db.migrations)
+  db_file = os.path.join(data_dir, f"bench-{size}-v{schema}.db")
+  if not os.path.exists(db_file):
+    print(f"Seeding {size} messages into {db_file}...", file=sys.stderr)
+    seed(db_file + ".tmp", size)
+    os.replace(db_file + ".tmp", db_file)
+  return db_file
+
+
+def connect():
+  session_manager.add_tcp(call_a, bbs_call, port, FakeChannel())
+  session_manager.add_ax25(call_b, bbs_call, port, FakeConnection())
+
+
+def disconnect():
+  session_manager.remove(call_a, bbs_call, port)
+  session_manager.remove(call_b, bbs_call, port)
+
+
+def run(who, line):
+  call = call_a if who == "a" else call_b
+  bbs.handle_command(bbs.db_filename, call, bbs_call, port, line)
+
+
+class Deletable:
+  """Yields DEL commands for the messages seeded for station A."""
+
+  def __init__(self, db_file):
+    db = sqlite3.connect(db_file)
+    self.ids = [
+      row[0]
+      for row in db.execute(
+        "SELECT id FROM messages WHERE base_recipient = ? AND deleted = 0",
+        (call_a,),
+      )
+    ]
+    db.close()
+
+  def __call__(self, i):
+    return f"DEL {self.ids[i % len(self.ids)]}"
+
+
+def scenarios(db_file):
+  """(name, station, line or line factory, setup steps, teardown steps)"""
+  chat = [("a", f"CHAT {call_b}")]
+  room = [("a", "JOIN BENCH"), ("b", "JOIN BENCH")]
+  return [
+    ("HELP", "a", "HELP", [], []),
+    ("INFO", "a", "INFO", [], []),
+    ("VER", "a", "VER", [], []),
+    ("WHO", "a", "WHO", [], []),
+    ("UNKNOWN", "a", "FOO BAR", [], []),
+    ("MSG", "a", "MSG Benchmark bulletin", [], []),
+    ("SEND", "a", f"SEND {call_b} Benchmark message", [], []),
+    ("LIST", "a", "LIST", [], []),
+    ("READ", "a", "READ", [], []),
+    ("READ_AX25", "b", "READ", [], []),
+    ("LIST_50", "a", "LIST 50", [], []),
+    ("MORE", "a", "MORE", [("a", "LIST 50")], []),
+    ("SEARCH", "a", "SEARCH message 12", [], []),
+    ("SEARCH_PRIVATE", "a", "SEARCH PRIVATE message", [], []),
+    ("DEL", "a", Deletable(db_file), [], []),
+    ("BYE", "a", "BYE", [], [disconnect, connect]),
+    ("CHAT", "a", f"CHAT {call_b}", [], [("b", "ABORT")]),
+    ("CHAT_REQUEST_HELP", "b", "HELP", chat, [("b", "ABORT")]),
+    ("ACCEPT", "b", "ACCEPT", chat, [("a", "_EOF_")]),
+    ("ABORT", "b", "ABORT", chat, []),
+    ("CHAT_LINE", "a", "Hello there", chat + [("b", "ACCEPT")], [("a", "_EOF_")]),
+    ("CHAT_EOF", "a", "_EOF_", chat + [("b", "ACCEPT")], []),
+    ("JOIN", "a", "JOIN BENCH", [], [("a", "_EOF_")]),
+    ("ROOM_LINE", "a", "Hello room", room, [("a", "_EOF_"), ("b", "_EOF_")]),
+  ]
+
+
+def steps(actions):
+  for action in actions:
+    if callable(action):
+      action()
+    else:
+      run(*action)
+
+
+def measure(scenario, iterations, track_allocations):
+  _, who, line, setup, teardown = scenario
+  timings = []
+  peaks = []
+  blocks = []
+  for i in range(iterations):
+    steps(setup)
+    text = line(i) if callable(line) else line
+    if track_allocations:
+      tracemalloc.reset_peak()
+      before, _ = tracemalloc.get_traced_memory()
+      blocks_before = sys.getallocatedblocks()
+    start = time.perf_counter_ns()
+    run(who, text)
+    timings.append(time.perf_counter_ns() - start)
+    if track_allocations:
+      _, peak = tracemalloc.get_traced_memory()
+      peaks.append(peak - before)
+      blocks.append(sys.getallocatedblocks() - blocks_before)
+    steps(teardown)
+  return timings, peaks, blocks
+
+
+def percentile(sorted_values, q):
+  return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def bench_size(size, data_dir, iterations, alloc_iterations):
+  db_file = seeded_db(data_dir, size)
+  # Work on a copy, so the cached database stays pristine
+  work_file = os.path.join(tempfile.mkdtemp(), "work.db")
+  shutil.copyfile(db_file, work_file)
+
+  bbs_db.init_db(work_file)
+  bbs_db.start_writer(work_file)
+  bbs.init("OGL BBS", work_file, [call_a])
+  # Commands run back to back, far over the limits of a real station
+  ratelimit.enabled = False
+  connect()
+  results = []
+  for scenario in scenarios(work_file):
+    # Warm up caches and prepared statements
+    measure(scenario, min(20, iterations), False)
+    timings, _, _ = measure(scenario, iterations, False)
+    tracemalloc.start()
+    _, peaks, blocks = measure(scenario, alloc_iterations, True)
+    tracemalloc.stop()
+    timings.sort()
+    total = sum(timings)
+    results.append(
+      {
+        "db_size": size,
+        "command": scenario[0],
+        "iterations": iterations,
+        "ops_per_sec": round(iterations / (total / 1e9), 1),
+        "mean_us": round(total / iterations / 1000, 2),
+        "p50_us": round(percentile(timings, 0.5) / 1000, 2),
+        "p99_us": round(percentile(timings, 0.99) / 1000, 2),
+        "alloc_peak_bytes": sum(peaks) // len(peaks),
+        "alloc_net_blocks": round(sum(blocks) / len(blocks), 1),
+      }
+    )
+  disconnect()
+  bbs_db.shutdown()
+  return results
+
+
+def git_revision():
+  try:
+    return subprocess.run(
+      ["git", "describe", "--always", "--dirty"],
+      cwd=os.path.dirname(os.path.abspath(__file__)),
+      capture_output=True,
+      text=True,
+      check=True,
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def print_results(results, baseline=None):
+  old = {}
+  if baseline is not None:
+    old = {(r["db_size"], r["command"]): r for r in baseline["results"]}
+  header = f"{'size':>8} {'command':<18} {'cmd/s':>10} {'mean us':>9} {'p50 us':>9}"
+  header += f" {'p99 us':>9} {'alloc B':>9} {'blocks':>7}"
+  if old:
+    header += f" {'p50 vs base':>12}"
+  print(header)
+  for r in results:
+    row = f"{r['db_size']:>8} {r['command']:<18} {r['ops_per_sec']:>10.0f}"
+    row += f" {r['mean_us']:>9.1f} {r['p50_us']:>9.1f} {r['p99_us']:>9.1f}"
+    row += f" {r['alloc_peak_bytes']:>9} {r['alloc_net_blocks']:>7.1f}"
+    base = old.get((r["db_size"], r["command"]))
+    if base is not None and base["p50_us"]:
+      change = (r["p50_us"] - base["p50_us"]) / base["p50_us"] * 100
+      row += f" {change:>+11.1f}%"
+    print(row)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="oglbbs dispatcher benchmark")
+  parser.add_argument("--sizes", default="1k,100k,1M", help="Database sizes")
+  parser.add_argument("-n", "--iterations", type=int, default=500)
+  parser.add_argument(
+    "--alloc-iterations",
+    type=int,
+    default=50,
+    help="Iterations traced for allocations, which is slow",
+  )
+  parser.add_argument(
+    "--data-dir",
+    default=os.path.join(tempfile.gettempdir(), "oglbbs-bench"),
+    help="Cache of seeded databases",
+  )
+  parser.add_argument("-o", "--output", help="Save the results to this JSON file")
+  parser.add_argument("--compare", help="JSON results of an earlier run")
+  args = parser.parse_args()
+
+  logging.disable(logging.CRITICAL)
+  os.makedirs(args.data_dir, exist_ok=True)
+  results = []
+  for size in args.sizes.split(","):
+    results += bench_size(
+      parse_size(size), args.data_dir, args.iterations, args.alloc_iterations
+    )
+
+  baseline = None
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+  print_results(results, baseline)
+
+  if args.output:
+    report = {
+      "meta": {
+        "version": bbs.version,
+        "revision": git_revision(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "iterations": args.iterations,
+      },
+      "results": results,
+    }
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,29 @@
+# In-memory stand-ins for the pyham_pe and Paramiko objects the BBS talks to
+
+
+class FakeConnection:
+  """Stands in for a pyham_pe connection and records the frames sent."""
+
+  def __init__(self):
+    self.frames = []
+
+  def send_data(self, data):
+    self.frames.append(len(data))
+
+  def close(self):
+    pass
+
+
+class FakeChannel:
+  """Stands in for a Paramiko channel and counts the bytes written."""
+
+  def __init__(self):
+    self.writes = 0
+    self.sent = 0
+
+  def sendall(self, data):
+    self.writes += 1
+    self.sent += len(data)
+
+  def close(self):
+    pass
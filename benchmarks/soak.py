@@ -0,0 +1,703 @@
+# End-to-end soak test
+#
+# Runs the BBS in this process against a local AGWPE emulator and SSH
+# server. Hundreds of simulated AX.25 stations connect to it, run a mix of
+# commands, chat with each other and disconnect. At the same time a number
+# of SSH clients log in, run commands and log out. No radio hardware is
+# needed. Run it from the repository root:
+#
+#   python3 benchmarks/soak.py --stations 300 --ssh-clients 20 --duration 3h \
+#     --baud 1000000
+#
+# AX.25 output goes through the airtime scheduler, as on a node with the
+# default config. It is paced to the baud rate of the ports, which the
+# emulator reports as 1200, far too slow for hundreds of busy stations, so
+# --baud sets a faster one. --no-fair-output uses the writer threads instead.
+#
+# Every --report-interval it prints throughput and tail latency, sessions in
+# session_manager against the clients actually connected, and the thread,
+# file descriptor and memory use of the process. At the end all clients hang
+# up, and sessions still registered afterwards are reported as leaked. The
+# memory figures include the simulated clients, which use a constant amount
+# of memory once all of them are connected.
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import resource
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from oglbbs import airtime  # noqa: E402
+from oglbbs import bbs  # noqa: E402
+from oglbbs import bbs_db  # noqa: E402
+from oglbbs import dispatcher  # noqa: E402
+from oglbbs import log  # noqa: E402
+from oglbbs import ratelimit  # noqa: E402
+from oglbbs import session_manager  # noqa: E402
+from oglbbs import ssh_server  # noqa: E402
+from oglbbs import timers  # noqa: E402
+
+from agwpe_emulator import Emulator, Station  # noqa: E402
+
+logger = logging.getLogger("soak")
+
+bbs_call = "BE0BBS"
+prompt = b">\r\n"
+password = "soaktest"
+
+# (command, weight). {call} is replaced with a random station.
+command_mix = [
+  ("HELP", 5),
+  ("INFO", 5),
+  ("LIST", 20),
+  ("READ", 20),
+  ("MORE", 5),
+  ("SEARCH soak {n}", 5),
+  ("WHO", 10),
+  ("VER", 5),
+  ("STATS", 2),
+  ("MSG Soak test bulletin {n}", 10),
+  ("SEND {call} Soak test message {n}", 20),
+  ("FOO", 3),
+]
+commands = [command for command, _ in command_mix]
+weights = [weight for _, weight in command_mix]
+
+
+def parse_duration(text):
+  units = {"s": 1, "m": 60, "h": 3600}
+  if text[-1] in units:
+    return float(text[:-1]) * units[text[-1]]
+  return float(text)
+
+
+def make_call(prefix, i):
+  """Valid, unique callsign, like SA0AAA, for simulated client i."""
+  letters = ""
+  n = i // 10
+  for _ in range(3):
+    letters = chr(65 + n % 26) + letters
+    n //= 26
+  return f"{prefix}{i % 10}{letters}"
+
+
+def free_port():
+  s = socket.socket()
+  s.bind(("127.0.0.1", 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+
+# === Statistics ===
+
+
+class Latency:
+  """Latency samples of the current interval, and a histogram of all of them."""
+
+  # Histogram bucket bounds grow by 5%, so percentiles are within 5%
+  ratio = 1.05
+
+  def __init__(self):
+    self.samples = []
+    self.buckets = {}
+    self.count = 0
+
+  def add(self, seconds):
+    self.samples.append(seconds)
+    bucket = math.ceil(math.log(max(seconds, 1e-6)) / math.log(self.ratio))
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.count += 1
+
+  def take_interval(self):
+    samples, self.samples = self.samples, []
+    samples.sort()
+    return samples
+
+  def total_percentile(self, q):
+    rank = q * self.count
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= rank:
+        return self.ratio**bucket
+    return 0.0
+
+
+class Stats:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latency = {}
+    self.errors = {}
+
+  def record(self, name, seconds):
+    with self.lock:
+      latency = self.latency.get(name)
+      if latency is None:
+        latency = self.latency[name] = Latency()
+      latency.add(seconds)
+
+  def error(self, name):
+    with self.lock:
+      self.errors[name] = self.errors.get(name, 0) + 1
+
+  def take_interval(self):
+    with self.lock:
+      return {name: latency.take_interval() for name, latency in self.latency.items()}
+
+
+def percentile(sorted_values, q):
+  if not sorted_values:
+    return 0.0
+  return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def rss_bytes():
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except OSError:
+    # Peak instead of current, on systems without /proc
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_fds():
+  try:
+    return len(os.listdir("/proc/self/fd"))
+  except OSError:
+    return -1
+
+
+# === AX.25 stations ===
+
+
+class SoakStation(Station):
+  """Connects, runs commands and chats, hangs up, and comes back later."""
+
+  def __init__(self, call, port, harness):
+    super().__init__(call, port)
+    self.harness = harness
+    self.state = "off"
+    self.actions_left = 0
+    self.timer = None
+    self.chat = None
+
+  def start(self, delay):
+    self.timer = self.emulator.call_later(delay, self.join)
+
+  def join(self):
+    if self.harness.stopping:
+      return
+    self.state = "connecting"
+    self.connect()
+    start = time.monotonic()
+    self.expect(
+      prompt,
+      lambda _: self.joined(start),
+      self.harness.args.timeout,
+    )
+
+  def joined(self, start):
+    self.harness.stats.record("ax25 connect", time.monotonic() - start)
+    self.actions_left = random.randint(5, 30)
+    self.idle()
+
+  def idle(self):
+    self.state = "idle"
+    self.chat = None
+    delay = random.expovariate(1 / self.harness.args.think_time)
+    self.timer = self.emulator.call_later(delay, self.act)
+
+  def act(self):
+    self.timer = None
+    if self.harness.stopping or self.actions_left <= 0:
+      self.leave()
+      return
+    self.actions_left -= 1
+    if random.random() < self.harness.args.chat_share:
+      partner = self.harness.idle_partner(self)
+      if partner is not None:
+        Chat(self, partner, self.harness).start()
+        return
+    self.state = "command"
+    command = random.choices(commands, weights)[0]
+    command = command.format(call=self.harness.random_call(), n=self.actions_left)
+    label = command.split()[0]
+    start = time.monotonic()
+    self.send(command)
+    self.expect(
+      prompt,
+      lambda _: self.done(label, start),
+      self.harness.args.timeout,
+    )
+
+  def done(self, label, start):
+    self.harness.stats.record("ax25 command", time.monotonic() - start)
+    self.harness.count(label)
+    self.idle()
+
+  def leave(self):
+    if random.random() < 0.5:
+      # Ask the BBS to hang up
+      self.state = "bye"
+      self.send("BYE")
+      self.expect(b"Goodbye!", lambda _: None, self.harness.args.timeout)
+    else:
+      self.disconnect()
+      self.rest()
+
+  def rest(self):
+    self.state = "off"
+    if self.harness.stopping:
+      return
+    delay = random.expovariate(1 / self.harness.args.rest_time)
+    self.timer = self.emulator.call_later(delay, self.join)
+
+  def cancel_timer(self):
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+
+  def on_disconnected(self):
+    super().on_disconnected()
+    if self.state != "bye":
+      self.harness.stats.error("ax25 dropped by the BBS")
+    chat, self.chat = self.chat, None
+    self.cancel_timer()
+    self.rest()
+    if chat is not None:
+      chat.fail()
+
+  def on_timeout(self, pattern):
+    self.harness.stats.error(f"ax25 timeout in {self.state}")
+    logger.warning("%s: timed out in %s waiting for %r", self.call, self.state, pattern)
+    self.fail()
+
+  def fail(self):
+    chat, self.chat = self.chat, None
+    self.cancel_timer()
+    if self.connected:
+      self.disconnect()
+    self.rest()
+    if chat is not None:
+      chat.fail()
+
+
+class Chat:
+  """Two stations chatting: request, accept, a few lines each way, end."""
+
+  def __init__(self, caller, callee, harness):
+    self.caller = caller
+    self.callee = callee
+    self.harness = harness
+    self.lines = random.randint(1, 5)
+    self.waiting = 0
+    self.then = None
+    self.failed = False
+
+  def start(self):
+    for station in (self.caller, self.callee):
+      station.cancel_timer()
+      station.state = "chat"
+      station.chat = self
+    timeout = self.harness.args.timeout
+    start = time.monotonic()
+    self.caller.send(f"CHAT {self.callee.call}")
+    self.wait(2, self.accept)
+    self.caller.expect(prompt, lambda _: self.requested(start), timeout)
+    self.callee.expect(b"Type ACCEPT to start chatting.", self.arrived, timeout)
+
+  def wait(self, count, then):
+    self.waiting = count
+    self.then = then
+
+  def arrived(self, _=None):
+    if self.failed:
+      return
+    self.waiting -= 1
+    if self.waiting == 0:
+      self.then()
+
+  def requested(self, start):
+    self.harness.stats.record("ax25 command", time.monotonic() - start)
+    self.harness.count("CHAT")
+    self.arrived()
+
+  def accept(self):
+    timeout = self.harness.args.timeout
+    self.callee.send("ACCEPT")
+    self.wait(2, lambda: self.line(0))
+    for station in (self.caller, self.callee):
+      station.expect(b"Type _EOF_ to end chat.\r\n", self.arrived, timeout)
+
+  def line(self, i):
+    timeout = self.harness.args.timeout
+    if i == self.lines:
+      self.caller.send("_EOF_")
+      self.wait(2, self.finish)
+      self.caller.expect(prompt, self.arrived, timeout)
+      self.callee.expect(b"Chat session ended.\r\n", self.arrived, timeout)
+      return
+    text = f"Line {i} from {self.caller.call}"
+    reply = f"Reply {i} from {self.callee.call}"
+    start = time.monotonic()
+    self.caller.send(text)
+
+    def replied(_):
+      self.harness.stats.record("ax25 chat round trip", time.monotonic() - start)
+      self.harness.count("chat line")
+      self.line(i + 1)
+
+    def received(_):
+      self.callee.send(reply)
+      self.caller.expect(reply.encode() + b"\r\n", replied, timeout)
+
+    self.callee.expect(text.encode() + b"\r\n", received, timeout)
+
+  def finish(self):
+    self.caller.idle()
+    self.callee.idle()
+
+  def fail(self):
+    if self.failed:
+      return
+    self.failed = True
+    for station in (self.caller, self.callee):
+      if station.chat is self:
+        station.fail()
+
+
+# === SSH clients ===
+
+
+def read_until(chan, pattern):
+  received = bytearray()
+  while pattern not in received:
+    data = chan.recv(4096)
+    if not data:
+      raise EOFError("Connection closed by the BBS")
+    received += data
+  return received
+
+
+def ssh_client(harness, call):
+  args = harness.args
+  while not harness.stopping:
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+      start = time.monotonic()
+      client.connect(
+        "127.0.0.1",
+        harness.ssh_port,
+        username=call,
+        password=password,
+        timeout=args.timeout,
+        allow_agent=False,
+        look_for_keys=False,
+      )
+      chan = client.get_transport().open_session()
+      chan.settimeout(args.timeout)
+      chan.invoke_shell()
+      read_until(chan, prompt)
+      harness.stats.record("ssh connect", time.monotonic() - start)
+      with harness.lock:
+        harness.ssh_connected += 1
+      try:
+        for n in range(random.randint(5, 30)):
+          if harness.stopping:
+            break
+          time.sleep(random.expovariate(1 / args.think_time))
+          command = random.choices(commands, weights)[0]
+          command = command.format(call=harness.random_call(), n=n)
+          start = time.monotonic()
+          chan.sendall((command + "\r").encode())
+          read_until(chan, prompt)
+          harness.stats.record("ssh command", time.monotonic() - start)
+          harness.count(command.split()[0])
+        if random.random() < 0.5:
+          chan.sendall(b"BYE\r")
+          read_until(chan, b"Goodbye!")
+      finally:
+        with harness.lock:
+          harness.ssh_connected -= 1
+    except (OSError, EOFError, paramiko.SSHException) as e:
+      harness.stats.error(f"ssh {type(e).__name__}")
+      logger.warning("SSH client %s: %r", call, e)
+    finally:
+      client.close()
+    if not harness.stopping:
+      time.sleep(random.expovariate(1 / args.rest_time))
+
+
+def run_timers(harness):
+  # Stands in for the main loop of the BBS. Nothing wakes it up for timers set
+  # by other threads, so it looks at least every tick.
+  while not harness.stopping:
+    wait = timers.timeout()
+    time.sleep(timers.tick if wait is None else min(wait, timers.tick))
+    timers.run()
+
+
+def serve_ssh(harness):
+  while not harness.stopping:
+    readable, _, _ = select.select([ssh_server.sock], [], [], 0.5)
+    if readable:
+      ssh_server.accept_client()
+
+
+# === Harness ===
+
+
+class Harness:
+  def __init__(self, args):
+    self.args = args
+    self.stats = Stats()
+    self.lock = threading.Lock()
+    self.commands = {}
+    self.stopping = False
+    self.stations = []
+    self.ssh_calls = [make_call("SB", i) for i in range(args.ssh_clients)]
+    self.ssh_connected = 0
+    self.ssh_port = None
+    self.emulator = None
+
+  def count(self, label):
+    with self.lock:
+      self.commands[label] = self.commands.get(label, 0) + 1
+
+  def random_call(self):
+    return random.choice(self.stations).call
+
+  def idle_partner(self, caller):
+    candidates = [s for s in self.stations if s.state == "idle" and s is not caller]
+    return random.choice(candidates) if candidates else None
+
+  def connected_clients(self):
+    ax25 = sum(1 for s in self.stations if s.connected)
+    return ax25, self.ssh_connected
+
+  def start(self):
+    args = self.args
+    db_file = os.path.join(tempfile.mkdtemp(), "soak.db")
+    bbs_db.init_db(db_file)
+    bbs_db.start_writer(db_file)
+    bbs.init("OGL BBS soak test", db_file)
+    bbs.set_paclen(args.paclen)
+    dispatcher.start(args.workers)
+    bbs.use_writers = True
+    # The output path of the BBS as configured by default, paced per port
+    bbs.use_airtime = args.fair_output
+    if args.baud is not None:
+      for port in range(args.ports):
+        airtime.baud_rate[port] = args.baud
+    # Every client connects from this host, and the load is the point
+    ratelimit.enabled = False
+
+    self.emulator = Emulator(ports=args.ports)
+    for i in range(args.stations):
+      station = SoakStation(make_call("SA", i), i % args.ports, self)
+      self.stations.append(self.emulator.add_station(station))
+    self.emulator.start()
+    if not bbs.run_bbs(*self.emulator.address, bbs_call, db_file):
+      sys.exit("BBS did not start")
+    if not self.emulator.registered_event.wait(10):
+      sys.exit("BBS did not register its callsign")
+
+    if args.ssh_clients:
+      key_file = args.key
+      if key_file is None:
+        key_file = os.path.join(os.path.dirname(db_file), "host_key")
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_file)
+      self.ssh_port = free_port()
+      max_conn = args.ssh_clients * 2
+      if not ssh_server.start_ssh_server(
+        "127.0.0.1", self.ssh_port, [key_file], bbs_call, db_file, max_conn
+      ):
+        sys.exit("SSH server did not start")
+      threading.Thread(target=serve_ssh, args=(self,), daemon=True).start()
+
+    threading.Thread(target=run_timers, args=(self,), daemon=True).start()
+    for station in self.stations:
+      self.emulator.call_soon(station.start, random.uniform(0, args.ramp_up))
+    for call in self.ssh_calls:
+      threading.Thread(target=ssh_client, args=(self, call), daemon=True).start()
+
+  def snapshot(self, elapsed, interval):
+    """Print and return one line of the report."""
+    with self.lock:
+      commands = sum(self.commands.values())
+    samples = self.stats.take_interval()
+    ax25, ssh = self.connected_clients()
+    row = {
+      "elapsed_s": round(elapsed),
+      "commands": commands,
+      "commands_per_s": 0.0,
+      "sessions": len(session_manager.sessions),
+      "clients_connected": ax25 + ssh,
+      "threads": threading.active_count(),
+      "fds": open_fds(),
+      "rss_mb": round(rss_bytes() / 2**20, 1),
+      "latency_ms": {},
+    }
+    for name, values in sorted(samples.items()):
+      row["latency_ms"][name] = {
+        "count": len(values),
+        "p50": round(percentile(values, 0.5) * 1000, 2),
+        "p99": round(percentile(values, 0.99) * 1000, 2),
+      }
+    previous = self.rows[-1]["commands"] if self.rows else 0
+    row["commands_per_s"] = round((commands - previous) / interval, 1)
+    latency = " ".join(
+      f"{name}={v['p50']:.1f}/{v['p99']:.1f}" for name, v in row["latency_ms"].items()
+    )
+    print(
+      f"{row['elapsed_s']:>7}s {row['commands_per_s']:>8.1f} cmd/s"
+      f" sessions {row['sessions']:>4}/{row['clients_connected']:<4}"
+      f" threads {row['threads']:>4} fds {row['fds']:>5}"
+      f" rss {row['rss_mb']:>7.1f} MB  p50/p99 ms: {latency}",
+      flush=True,
+    )
+    return row
+
+  def run(self):
+    args = self.args
+    self.rows = []
+    start = time.monotonic()
+    last = start
+    while time.monotonic() - start < args.duration:
+      time.sleep(min(args.report_interval, args.duration - (time.monotonic() - start)))
+      now = time.monotonic()
+      self.rows.append(self.snapshot(now - start, now - last))
+      last = now
+
+    # Let everyone hang up, then look for sessions left behind
+    self.stopping = True
+    self.emulator.call_soon(self.hang_up_all)
+    deadline = time.monotonic() + args.timeout + 10
+    while time.monotonic() < deadline:
+      if not session_manager.sessions and self.ssh_connected == 0:
+        break
+      time.sleep(0.5)
+    time.sleep(1)
+    return list(session_manager.sessions.values())
+
+  def hang_up_all(self):
+    for station in self.stations:
+      station.cancel_timer()
+      station.cancel_expect()
+      if station.connected:
+        station.disconnect()
+      station.state = "off"
+
+  def summary(self, leaked):
+    first, last = self.rows[0], self.rows[-1]
+    print()
+    rate = last["commands"] / max(1, last["elapsed_s"])
+    print(f"Commands: {last['commands']}, {rate:.1f}/s")
+    with self.stats.lock:
+      for name, latency in sorted(self.stats.latency.items()):
+        p50 = latency.total_percentile(0.5) * 1000
+        p99 = latency.total_percentile(0.99) * 1000
+        p999 = latency.total_percentile(0.999) * 1000
+        print(
+          f"  {name:<22} {latency.count:>9}  p50 {p50:>8.1f} ms"
+          f"  p99 {p99:>8.1f} ms  p99.9 {p999:>8.1f} ms"
+        )
+      errors = dict(self.stats.errors)
+    print(f"Errors: {errors or 'none'}")
+    print(
+      f"Growth from the first report: threads {last['threads'] - first['threads']:+d},"
+      f" fds {last['fds'] - first['fds']:+d},"
+      f" rss {last['rss_mb'] - first['rss_mb']:+.1f} MB"
+    )
+    print(f"Leaked sessions: {len(leaked)}")
+    for session in leaked:
+      print(f"  {session!r}")
+    return errors
+
+
+def main():
+  parser = argparse.ArgumentParser(description="oglbbs end-to-end soak test")
+  parser.add_argument("--stations", type=int, default=200, help="AX.25 stations")
+  parser.add_argument("--ports", type=int, default=1, help="AGWPE radio ports")
+  parser.add_argument("--ssh-clients", type=int, default=20)
+  parser.add_argument("-k", "--key", help="SSH host key, generated if not given")
+  parser.add_argument(
+    "--duration", type=parse_duration, default="10m", help="e.g. 90s, 30m, 3h"
+  )
+  parser.add_argument("--ramp-up", type=float, default=30, help="Seconds")
+  parser.add_argument(
+    "--think-time", type=float, default=2, help="Mean seconds between commands"
+  )
+  parser.add_argument(
+    "--rest-time", type=float, default=10, help="Mean seconds between sessions"
+  )
+  parser.add_argument(
+    "--chat-share", type=float, default=0.05, help="Share of actions which chat"
+  )
+  parser.add_argument("--paclen", type=int, default=128)
+  parser.add_argument(
+    "--fair-output",
+    action=argparse.BooleanOptionalAction,
+    default=True,
+    help="Schedule AX.25 output by airtime, as the BBS does by default",
+  )
+  parser.add_argument(
+    "--baud", type=int, help="Baud rate of the radio ports, from AGWPE if not given"
+  )
+  parser.add_argument(
+    "--workers",
+    type=int,
+    default=dispatcher.default_workers,
+    help="Command workers, 0 to handle commands on the receiving threads",
+  )
+  parser.add_argument("--timeout", type=float, default=30, help="Reply timeout")
+  parser.add_argument(
+    "--report-interval", type=parse_duration, default="60s", help="e.g. 10s, 5m"
+  )
+  parser.add_argument("-o", "--output", help="Save the reports to this JSON file")
+  parser.add_argument("--log-level", default="WARNING")
+  args = parser.parse_args()
+
+  log.setup(args.log_level, {"soak": "INFO"})
+  harness = Harness(args)
+  harness.start()
+  leaked = harness.run()
+  errors = harness.summary(leaked)
+
+  if args.output:
+    report = {
+      "args": vars(args),
+      "reports": harness.rows,
+      "commands": harness.commands,
+      "errors": errors,
+      "leaked_sessions": [repr(session) for session in leaked],
+    }
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+
+  if args.ssh_clients:
+    ssh_server.shutdown()
+  bbs.shutdown()
+  harness.emulator.stop()
+  dispatcher.shutdown()
+  bbs_db.shutdown()
+  log.shutdown()
+  sys.exit(1 if leaked else 0)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,116 @@
+# SSH handshake micro-benchmark
+#
+# Starts the SSH server of oglbbs on a local port and measures how many
+# complete handshakes (key exchange and password authentication) per second
+# it can serve. Run it from the repository root:
+#
+#   python3 benchmarks/ssh_handshake.py -k ./oglbbs_ed25519 -n 200
+#
+# Compare the output of two checkouts to see the effect of a change.
+
+import argparse
+import contextlib
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from oglbbs import bbs  # noqa: E402
+from oglbbs import bbs_db  # noqa: E402
+from oglbbs import ratelimit  # noqa: E402
+from oglbbs import ssh_server  # noqa: E402
+
+
+def free_port():
+  s = socket.socket()
+  s.bind(("127.0.0.1", 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+
+def serve(stop):
+  while not stop.is_set():
+    ssh_server.step()
+    time.sleep(0.001)
+
+
+def handshake(port, call, password):
+  sock = socket.create_connection(("127.0.0.1", port))
+  transport = paramiko.Transport(sock)
+  try:
+    transport.connect()
+    transport.auth_password(call, password)
+  finally:
+    transport.close()
+
+
+def run(port, count, clients, call, password):
+  done = []
+  errors = []
+  lock = threading.Lock()
+
+  def worker():
+    while True:
+      with lock:
+        if len(done) + len(errors) >= count:
+          return
+        done.append(None)
+      try:
+        handshake(port, call, password)
+      except Exception as e:
+        with lock:
+          done.pop()
+          errors.append(e)
+
+  threads = [threading.Thread(target=worker) for _ in range(clients)]
+  start = time.perf_counter()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return time.perf_counter() - start, len(done), errors
+
+
+def main():
+  parser = argparse.ArgumentParser(description="oglbbs SSH handshake benchmark")
+  parser.add_argument("-k", "--key", required=True, help="Host key file")
+  parser.add_argument("-n", "--count", type=int, default=100)
+  parser.add_argument("-c", "--clients", type=int, default=4)
+  args = parser.parse_args()
+
+  # The server is chatty, keep its output out of the results
+  with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    elapsed, ok, errors = bench(args)
+
+  print(f"handshakes: {ok}, errors: {len(errors)}, clients: {args.clients}")
+  print(f"elapsed: {elapsed:.2f} s, {ok / elapsed:.1f} handshakes/s")
+
+
+def bench(args):
+  db_file = os.path.join(tempfile.mkdtemp(), "bench.db")
+  bbs_db.init_db(db_file)
+  bbs.db_filename = db_file
+  # Every client logs in as one callsign from this host, far over the limits
+  ratelimit.enabled = False
+  port = free_port()
+  ssh_server.start_ssh_server("127.0.0.1", port, [args.key], "N0CALL", db_file)
+
+  stop = threading.Event()
+  threading.Thread(target=serve, args=(stop,), daemon=True).start()
+
+  # Create the user once, so every run measures the same path
+  handshake(port, "BE0NCH-1", "benchmark")
+  elapsed, ok, errors = run(port, args.count, args.clients, "BE0NCH-1", "benchmark")
+  stop.set()
+  return elapsed, ok, errors
+
+
+if __name__ == "__main__":
+  main()
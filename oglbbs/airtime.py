@@ -0,0 +1,221 @@
+import collections
+import logging
+import threading
+import time
+
+from . import bbs_db
+from . import metrics
+from . import ratelimit
+from . import session_manager
+
+logger = logging.getLogger(__name__)
+
+# Output to AX.25 stations goes through a scheduler per radio port instead of
+# a writer thread per session. It hands frames to AGWPE only as fast as the
+# channel can send them, estimated from the baud rate, so that the order in
+# which they go on air is decided here and not in the queue of the TNC.
+# Sessions with little output waiting, like a prompt or a chat line, are
+# served first. The rest share the channel by deficit round-robin, a frame of
+# paclen bytes per turn, so one long LIST does not hold up the others.
+default_baud = 1200
+# Baud rate per radio port, from the port capabilities of AGWPE or the config
+baud_rate = {}
+# Baud rate codes of the AGWPE port capabilities
+baud_codes = {0: 1200, 1: 2400, 2: 4800, 3: 9600, 4: 19200, 5: 38400, 6: 57600}
+# Bytes sent with every I frame: flags, addresses, control, PID and FCS
+frame_overhead = 20
+# Seconds of airtime handed to the TNC ahead of the channel
+backlog = 2.0
+# Frames of a session handed to the TNC and not yet sent, by the estimate
+max_outstanding = 4
+# Sessions which never had more than this many bytes waiting go first
+interactive_bytes = 256
+
+_schedulers = {}
+_lock = threading.Lock()
+
+metrics.describe(
+  "oglbbs_airtime_seconds_total",
+  "counter",
+  "Estimated airtime of the frames sent, per radio port",
+)
+
+
+class Flow:
+  """Output of a session waiting for the channel."""
+
+  __slots__ = ("session", "interactive", "deficit", "in_flight", "ready_at")
+
+  def __init__(self, session):
+    self.session = session
+    # Until more than interactive_bytes are waiting, then until it is drained
+    self.interactive = True
+    self.deficit = 0
+    # Estimated times the frames handed to the TNC are on air
+    self.in_flight = collections.deque()
+    self.ready_at = 0.0
+
+  def outstanding(self, now):
+    while self.in_flight and self.in_flight[0] <= now:
+      self.in_flight.popleft()
+    return len(self.in_flight)
+
+
+class Scheduler:
+  """Schedules the frames of the sessions on one radio port."""
+
+  def __init__(self, port, paclen):
+    self.port = port
+    self.paclen = paclen
+    self.baud = baud_rate.get(port, default_baud)
+    # Estimated time the channel has sent everything handed to the TNC
+    self.channel_free = 0.0
+    self.flows = collections.deque()
+    self._flows_by_session = {}
+    self._woken = collections.deque()
+    self._event = threading.Event()
+    self._thread = threading.Thread(
+      target=self.run, name=f"airtime-{port}", daemon=True
+    )
+    self._thread.start()
+    logger.info("Scheduling output on port %s at %s baud.", port, self.baud)
+
+  def wake(self, session):
+    self._woken.append(session)
+    self._event.set()
+
+  def airtime(self, length):
+    return (length + frame_overhead) * 8 / self.baud
+
+  def run(self):
+    while True:
+      self._event.clear()
+      while self._woken:
+        session = self._woken.popleft()
+        if session not in self._flows_by_session:
+          flow = self._flows_by_session[session] = Flow(session)
+          self.flows.append(flow)
+      try:
+        wait = self._step(time.monotonic())
+      except Exception:
+        logger.exception("Error scheduling output on port %s", self.port)
+        wait = 1.0
+      if wait is None or wait > 0:
+        self._event.wait(wait)
+
+  def _step(self, now):
+    """
+    Send the next frame. Returns 0 to be called again at once, otherwise the
+    seconds until something can be sent, None if nothing is waiting.
+    """
+    self._drop_finished()
+    if not self.flows:
+      return None
+    waits = []
+    # Prompts and chat lines go first, past the backlog
+    for flow in self.flows:
+      if flow.session.outbox_bytes > interactive_bytes:
+        flow.interactive = False
+      if flow.interactive:
+        wait = self._blocked(flow, now)
+        if wait == 0:
+          self._send(flow, now)
+          return 0
+        waits.append(wait)
+    if self.channel_free - now > backlog:
+      waits.append(self.channel_free - backlog - now)
+      return min(waits)
+    # Deficit round-robin over the others, a quantum of paclen bytes per turn
+    for _ in range(len(self.flows)):
+      flow = self.flows[0]
+      wait = self._blocked(flow, now)
+      if wait == 0:
+        if flow.deficit < min(self.paclen, flow.session.outbox_bytes):
+          flow.deficit += self.paclen
+        flow.deficit -= self._send(flow, now)
+        if flow.deficit < min(self.paclen, flow.session.outbox_bytes):
+          self.flows.rotate(-1)
+        return 0
+      waits.append(wait)
+      self.flows.rotate(-1)
+    return min(waits) if waits else None
+
+  def _blocked(self, flow, now):
+    # Seconds until the flow, which has output waiting, may send
+    if flow.ready_at > now:
+      return flow.ready_at - now
+    if flow.outstanding(now) >= max_outstanding:
+      return flow.in_flight[0] - now
+    return 0
+
+  def _drop_finished(self):
+    # Output queued after a flow is dropped wakes its session again
+    for flow in list(self.flows):
+      session = flow.session
+      if session_manager.get(session.src, session.dst, session.port) is not session:
+        # The station has gone, and its output with it
+        with session.outbox_ready:
+          session.outbox.clear()
+          session.outbox_bytes = 0
+      elif session.outbox_bytes:
+        continue
+      elif session.closing:
+        from . import bbs
+
+        bbs.close_transport(session)
+      self.flows.remove(flow)
+      del self._flows_by_session[session]
+
+  def _send(self, flow, now):
+    session = flow.session
+    with session.outbox_ready:
+      frame = _take(session, self.paclen)
+    if not frame:
+      return 0
+    airtime = self.airtime(len(frame))
+    self.channel_free = max(self.channel_free, now) + airtime
+    flow.in_flight.append(self.channel_free)
+    wait = ratelimit.delay("output", bbs_db.base_callsign(session.src), len(frame))
+    if wait > 0:
+      flow.ready_at = now + wait
+    from . import bbs
+
+    with bbs._agwpe_send_lock:
+      session.ax25_session.send_data(frame)
+    metrics.inc("oglbbs_sent_bytes_total", len(frame), transport="ax25")
+    metrics.inc("oglbbs_sent_frames_total", transport="ax25")
+    metrics.inc("oglbbs_airtime_seconds_total", airtime, port=str(self.port))
+    return len(frame)
+
+
+def _take(session, size):
+  # Called with session.outbox_ready held. Takes up to size bytes.
+  parts = []
+  while size > 0 and session.outbox:
+    chunk = session.outbox.popleft()
+    if len(chunk) > size:
+      # The rest stays queued without being copied
+      session.outbox.appendleft(memoryview(chunk)[size:])
+      chunk = chunk[:size]
+    parts.append(chunk)
+    size -= len(chunk)
+  frame = b"".join(parts)
+  session.outbox_bytes -= len(frame)
+  return frame
+
+
+def wake(session, paclen):
+  """Schedule the queued output of an AX.25 session on its radio port."""
+  scheduler = _schedulers.get(session.port)
+  if scheduler is None:
+    with _lock:
+      scheduler = _schedulers.get(session.port)
+      if scheduler is None:
+        scheduler = _schedulers[session.port] = Scheduler(session.port, paclen)
+  scheduler.wake(session)
+
+
+def set_port_baud(port, baud_code):
+  """Take the baud rate of a port from AGWPE, unless it is configured."""
+  if port not in baud_rate and baud_code in baud_codes:
+    baud_rate[port] = baud_codes[baud_code]
@@ -1,26 +1,179 @@
-import pe
-import pe.app
+import hashlib
+import logging
+import os
 import time
-from pyfiglet import Figlet
+import threading
+from contextlib import contextmanager
 
+from . import airtime
 from . import bbs_db
+from . import dispatcher
+from . import forward
+from . import metrics
+from . import presence
+from . import ratelimit
 from . import session_manager
-from . import ssh_server
+from . import timers
 import re
 
+# pe, pyfiglet and the SSH server (paramiko) are slow to import. They are
+# imported when the transport is started or the banner is rendered, so that a
+# node runs without the parts it does not use.
+
+logger = logging.getLogger(__name__)
+
 version = "1.0.1"
 line_ending = "\r\n"
 
-
-def init(banner):
-  global bbs_banner_text
+# Maximum AX.25 I frame payload, per radio port
+default_paclen = 128
+paclen = {}
+# Collect the output of a command and send it in as few frames as possible
+coalesce_output = True
+_output_batch = threading.local()
+# Write output on a thread of each session, so a slow link holds up only its
+# own writer. Otherwise output is written by the thread producing it.
+use_writers = False
+# Bytes queued for a session before overflow_policy applies
+max_queued_output = 65536
+# "drop_oldest" discards the oldest queued output, "disconnect" hangs up
+overflow_policy = "drop_oldest"
+# Seconds an idle writer waits for more output before its thread exits
+writer_linger = 5.0
+# Output to AX.25 sessions is scheduled per radio port by airtime, in place of
+# their writer threads
+use_airtime = False
+_agwpe_send_lock = threading.Lock()
+
+# Commands measured by name, anything else is counted as UNKNOWN
+command_names = {
+  "HELP",
+  "INFO",
+  "MSG",
+  "LIST",
+  "SEND",
+  "READ",
+  "DEL",
+  "VER",
+  "CHAT",
+  "WHO",
+  "BYE",
+  "STATS",
+  "ACCEPT",
+  "ABORT",
+  "MORE",
+  "SEARCH",
+  "JOIN",
+}
+# Messages per page of LIST and READ, and the most a user may ask for
+page_size = 5
+max_page_size = 50
+# Most matches shown by SEARCH
+search_limit = 10
+# Callsigns, without SSID, allowed to use sysop commands
+sysops = set()
+# Seconds a chat request waits to be accepted
+chat_request_timeout = 120
+# Seconds without input before a user is disconnected, per transport, 0 never
+idle_timeout = {"ax25": 900, "tcp": 3600}
+# Seconds between housekeeping runs, and between the batches of one run
+housekeeping_interval = 600
+housekeeping_pause = 1.0
+# Figlet font of the banner
+banner_font = "slant"
+
+help_text = (
+  """
+Commands:
+  HELP              - Show this help
+  INFO              - About this BBS
+  MSG <text>        - Post a public message
+  LIST [n]          - Show recent public messages
+  SEND <CALL> <msg> - Send private message
+  READ [n]          - Read private messages
+  MORE              - Show older messages of LIST or READ
+  SEARCH <words>    - Search messages, PUBLIC or PRIVATE first to narrow
+  ... ARCHIVE ...   - LIST, READ or SEARCH ARCHIVE for archived ones
+  DEL <ID>          - Delete private message
+  VER               - Show version
+  CHAT <CALL>       - Send a chat message
+  JOIN <room>       - Chat with everyone in a room
+  WHO               - List connected sessions
+  STATS             - Node statistics (sysop)
+  BYE               - Disconnect"""
+  + line_ending
+).encode()
+info_text = (
+  "This is OGLBBS. More info on https://github.com/leventelist/oglbbs" + line_ending
+).encode()
+
+metrics.describe(
+  "oglbbs_command_duration_seconds",
+  "histogram",
+  "Time to handle a command and hand its output to the transport",
+)
+metrics.describe("oglbbs_sent_bytes_total", "counter", "Bytes sent to users")
+metrics.describe(
+  "oglbbs_output_overflows_total", "counter", "Output queues of sessions overflowing"
+)
+metrics.describe(
+  "oglbbs_sent_frames_total", "counter", "AX.25 frames or SSH writes sent to users"
+)
+
+
+def init(banner, db_file_name="bbs.db", sysop_calls=(), banner_cache_dir=None):
+  global bbs_banner
+  global db_filename
+  db_filename = db_file_name
+  presence.on_chat = remote_chat_event
+  if _session_changed not in session_manager.watchers:
+    session_manager.watchers.append(_session_changed)
+  sysops.clear()
+  sysops.update(bbs_db.base_callsign(call.upper()) for call in sysop_calls)
   # Generate the banner text
-  f = Figlet(font="slant")
   bbs_banner_text = line_ending + line_ending
-  bbs_banner_text += f.renderText(banner) + line_ending
+  bbs_banner_text += render_banner(banner, banner_font, banner_cache_dir) + line_ending
+  bbs_banner = bbs_banner_text.encode()
+
+
+def render_banner(text, font, cache_dir=None):
+  """
+  Render text in a Figlet font. The result is cached in cache_dir, if given,
+  as loading pyfiglet and the font takes seconds on small boards.
+  """
+  path = None
+  if cache_dir is not None:
+    key = hashlib.sha256(f"{font}\0{text}".encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"banner-{key}.txt")
+    try:
+      with open(path, encoding="utf-8", newline="") as f:
+        return f.read()
+    except OSError:
+      pass
+
+  from pyfiglet import Figlet
+
+  rendered = Figlet(font=font).renderText(text)
+  if path is not None:
+    try:
+      with open(path + ".tmp", "w", encoding="utf-8", newline="") as f:
+        f.write(rendered)
+      os.replace(path + ".tmp", path)
+    except OSError as e:
+      logger.warning("Cannot cache the banner in %s: %s", cache_dir, e)
+  return rendered
 
 
 # Connect to the AGWPE server and start the BBS
+def set_paclen(length, port_paclen=None):
+  """Set the default AX.25 paclen and optionally per port values."""
+  global default_paclen
+  default_paclen = length
+  paclen.clear()
+  if port_paclen:
+    paclen.update(port_paclen)
+
+
 def run_bbs(agw_host, agw_port, call, db_file_name):
   global app
   global engine
@@ -28,21 +181,29 @@ def run_bbs(agw_host, agw_port, call, db_file_name):
   db_filename = db_file_name
 
   if not is_valid_callsign(call):
-    print(f"Invalid callsign: {call}")
+    logger.warning("Invalid callsign: %s", call)
     return False
 
+  import pe.app
+
+  _define_connection_class()
   app = pe.app.Application()
   try:
     app.start(agw_host, agw_port)
   except Exception as e:
-    print(f"Error starting BBS: {e}")
+    logger.error("Error starting BBS: %s", e)
     return False
   engine = app.engine
+  # AGWPE reports the baud rate of its ports with their capabilities
+  for port in range(len(app.get_port_info() or ())):
+    caps = app.get_port_caps(port)
+    if caps is not None:
+      airtime.set_port_baud(port, caps.baud_rate)
 
   # Set BBS callsign
   engine.register_callsign(call)
-  print(f"BBS running on {agw_host}:{agw_port} using AGWPE protocol")
-  print(f"Station call: {call}")
+  logger.info("BBS running on %s:%s using AGWPE protocol", agw_host, agw_port)
+  logger.info("Station call: %s", call)
   return True
 
 
@@ -69,33 +230,103 @@ def send_prompt(session, prefix=""):
   send_data(session, prompt)
 
 
+# Feed received bytes to the session and queue its complete lines
+def handle_data(db_filename, src, dst, port, data):
+  session = session_manager.get(src, dst, port)
+  if session is None:
+    logger.warning("Session %s -> %s on port %s not found.", src, dst, port)
+    return
+
+  session.last_active = time.monotonic()
+  lines = list(session.assembler.feed(data))
+  if not lines:
+    return
+  # Lines past the tokens left are dropped, the ones before still run
+  admitted = ratelimit.admit("command", bbs_db.base_callsign(src), len(lines))
+  if admitted < len(lines):
+    send_data(session, "Too many commands, slow down." + line_ending)
+    if not admitted:
+      return
+    lines = lines[:admitted]
+  if not dispatcher.submit(session, handle_lines, db_filename, session, lines):
+    logger.warning("Too many commands queued for %s, dropping input.", src)
+    send_data(session, "Busy, please wait for the replies." + line_ending)
+
+
+def handle_lines(db_filename, session, lines):
+  # The station may have disconnected while the lines were queued
+  if not is_current(session):
+    return
+  # The replies to all commands of the chunk go out together
+  with batched_output():
+    for line in lines:
+      if line is None:
+        send_data(session, "Line too long." + line_ending)
+        send_prompt(session)
+        continue
+      handle_command(db_filename, session.src, session.dst, session.port, line)
+
+
 # === Command Handler ===
 def handle_command(db_filename, src, dst, port, line):
+  label = command_label(session_manager.get(src, dst, port), line)
+  with metrics.timer("oglbbs_command_duration_seconds", command=label):
+    with batched_output():
+      _handle_command(db_filename, src, dst, port, line)
+
+
+def command_label(session, line):
+  """Name of the command for the metrics, from a bounded set."""
+  if session is not None and session.state == "chat":
+    return "CHAT_LINE"
+  if session is not None and session.state == "room":
+    return "ROOM_LINE"
+  tokens = line.split(maxsplit=1)
+  if not tokens:
+    return "EMPTY"
+  cmd = tokens[0].upper()
+  if cmd in command_names:
+    return cmd
+  return "UNKNOWN"
+
+
+def is_current(session):
+  """False once the station has disconnected or connected again."""
+  return session_manager.get(session.src, session.dst, session.port) is session
+
+
+def is_sysop(call):
+  return bbs_db.base_callsign(call.upper()) in sysops
+
+
+def _handle_command(db_filename, src, dst, port, line):
   session = session_manager.get(src, dst, port)
 
-  if session["active"] is False:
-    print(f"Session {src} -> {dst} on port {port} is not active.")
+  if session is None or session.active is False:
+    logger.warning("Session %s -> %s on port %s is not active.", src, dst, port)
     return
 
-  match session["state"]:
+  match session.state:
     case "new":
       handle_new_session(session, db_filename, src, dst, port, line)
     case "chat_request":
       handle_chat_request_session(session, db_filename, src, dst, port, line)
     case "chat":
       handle_chat_session(session, db_filename, src, dst, port, line)
+    case "room":
+      handle_room_session(session, db_filename, src, dst, port, line)
     case _:
       handle_new_session(session, db_filename, src, dst, port, line)
 
   # There might have been a change in the session state
-  # Generate the prompt again
-  do_prompt = True
-  match session["state"]:
-    case "chat":
+  # Generate the prompt again, unless the user has left
+  do_prompt = session.active
+  match session.state:
+    case "chat" | "room":
       do_prompt = False
       prompt_prefix = None
     case "chat_request":
-      prompt_prefix = f"Chat request with {session.get('chat_target')}"
+      prompt_prefix = f"Chat request with {session.chat_target}"
     case "new":
       prompt_prefix = None
     case _:
@@ -113,22 +344,32 @@ def handle_chat_session(session, db_filename, src, dst, port, line):
     return False
   cmd = tokens[0].upper()
 
-  # Get target session
-  target_sessions = session_manager.get_all_sessions_by_call(session["chat_target"])
-
   match cmd:
     case "_EOF_":
-      print(f"Chat session ended from {src} to {dst} on port {port}")
-      session["state"] = "new"
-      session["chat_target"] = None
+      logger.info("Chat session ended from %s to %s on port %s", src, dst, port)
+      chat_target = session.chat_target
+      session.state = "new"
+      session.chat_target = None
       send_data(session, "Chat session ended." + line_ending)
-      for (_, _, _), target_session in target_sessions:
-        send_data(target_session, "Chat session ended." + line_ending)
-        target_session["state"] = "new"
-        target_session["chat_target"] = None
+      chat_event(chat_target, "end", src)
     case _:
-      for (_, _, _), target_session in target_sessions:
-        send_data(target_session, line + line_ending)
+      chat_event(session.chat_target, "line", src, line)
+  return True
+
+
+def handle_room_session(session, db_filename, src, dst, port, line):
+  if line.strip().upper() == "_EOF_":
+    logger.info("%s left room %s", src, session.room)
+    others = session_manager.leave_room(session)
+    session.state = "new"
+    send_data(session, "You left the room." + line_ending)
+    for other in others:
+      send_data(other, f"{src} left the room." + line_ending)
+    return True
+  # Only queued for each member here, their writers send it
+  for other in session_manager.room_members(session.room):
+    if other is not session:
+      send_data(other, f"{src}: {line}" + line_ending)
   return True
 
 
@@ -138,34 +379,23 @@ def handle_chat_request_session(session, db_filename, src, dst, port, line):
     return False
   cmd = tokens[0].upper()
 
-  target_sessions = session_manager.get_all_sessions_by_call(session["chat_target"])
-
   match cmd:
     case "ACCEPT":
-      print(f"Accepting chat request from {src} to {dst} on port {port}")
-      if session["chat_target"] != src.upper():
-        session["state"] = "chat"
+      logger.info("Accepting chat request from %s to %s on port %s", src, dst, port)
+      if session.chat_target != src.upper():
+        session.state = "chat"
         send_data(
           session,
           line_ending + "You are now connected. Type _EOF_ to end chat." + line_ending,
         )
-        for (_, _, _), target_session in target_sessions:
-          send_data(
-            target_session,
-            line_ending
-            + "You are now connected. Type _EOF_ to end chat."
-            + line_ending,
-          )
-          target_session["state"] = "chat"
+        chat_event(session.chat_target, "accept", src)
     case "ABORT":
-      print(f"Aborting chat request from {src} to {dst} on port {port}")
-      session["state"] = "new"
-      session["chat_target"] = None
+      logger.info("Aborting chat request from %s to %s on port %s", src, dst, port)
+      chat_target = session.chat_target
+      session.state = "new"
+      session.chat_target = None
       send_data(session, "Chat request aborted." + line_ending)
-      for (_, _, _), target_session in target_sessions:
-        send_data(target_session, "Chat request aborted." + line_ending)
-        target_session["state"] = "new"
-        target_session["chat_target"] = None
+      chat_event(chat_target, "abort", src)
     case "HELP":
       send_data(
         session,
@@ -188,74 +418,60 @@ def handle_new_session(session, db_filename, src, dst, port, line):
 
   cmd = tokens[0].upper()
 
-  db_handle = bbs_db.init_db(db_filename)
+  db_handle = bbs_db.get_db(db_filename)
 
   match cmd:
     case "HELP":
-      send_data(
-        session,
-        """
-Commands:
-  HELP              - Show this help
-  INFO              - About this BBS
-  MSG <text>        - Post a public message
-  LIST              - Show recent public messages
-  SEND <CALL> <msg> - Send private message
-  READ              - Read private messages
-  DEL <ID>          - Delete private message
-  VER               - Show version
-  CHAT <CALL>       - Send a chat message
-  WHO               - List connected sessions
-  BYE               - Disconnect"""
-        + line_ending,
-      )
+      send_data(session, help_text)
 
     case "INFO":
-      send_data(
-        session,
-        "This is OGLBBS. More info on https://github.com/leventelist/oglbbs"
-        + line_ending,
-      )
+      send_data(session, info_text)
 
     case "MSG":
-      if len(tokens) == 2:
+      if len(tokens) != 2:
+        send_data(session, "Usage: MSG <your message>" + line_ending)
+      elif allow_message(session):
         bbs_db.store_message(db_handle, src.upper(), tokens[1])
         send_data(session, "Message stored." + line_ending)
+
+    case "LIST" | "READ":
+      archived, tokens = archive_arg(tokens)
+      count = page_size_arg(tokens)
+      if count is None:
+        send_data(session, f"Usage: {cmd} [ARCHIVE] [count]" + line_ending)
+      elif archived and bbs_db.archive_file is None:
+        send_data(session, "No archive on this BBS." + line_ending)
       else:
-        send_data(session, "Usage: MSG <your message>" + line_ending)
+        send_page(session, db_handle, cmd, count, archived=archived)
+
+    case "SEARCH":
+      archived, tokens = archive_arg(tokens)
+      if len(tokens) != 2:
+        send_data(
+          session, "Usage: SEARCH [ARCHIVE] [PUBLIC|PRIVATE] <words>" + line_ending
+        )
+      elif archived and bbs_db.archive_file is None:
+        send_data(session, "No archive on this BBS." + line_ending)
+      else:
+        send_search(session, db_handle, tokens[1], archived)
 
-    case "LIST":
-      rows = bbs_db.list_messages(db_handle)
-      if not rows:
-        send_data(session, "No public messages." + line_ending)
+    case "MORE":
+      if session.more is None:
+        send_data(session, "Nothing more to show." + line_ending)
       else:
-        output = "\r\n".join([f"[{r[2]}] {r[0]}: {r[1]}" for r in rows])
-        output += line_ending
-        send_data(session, output)
+        send_page(session, db_handle, *session.more)
 
     case "SEND":
       if len(tokens) == 2:
         parts = tokens[1].split(maxsplit=1)
         if len(parts) != 2:
           send_data(session, "Usage: SEND <CALLSIGN> <message>" + line_ending)
-        else:
+        elif allow_message(session):
           rcpt, msg = parts
-          bbs_db.store_private_message(db_handle, src.upper(), rcpt.upper(), msg)
-          send_data(session, f"Message sent to {rcpt}" + line_ending)
+          send_private_message(session, db_handle, rcpt, msg)
       else:
         send_data(session, "Usage: SEND <CALLSIGN> <message>" + line_ending)
 
-    case "READ":
-      rows = bbs_db.list_private_messages(db_handle, src.upper())
-      if not rows:
-        output = "No private messages." + line_ending
-      else:
-        output = line_ending + "Private messages:" + line_ending
-        for r in rows:
-          output += f"[{r[3]}] ID:{r[0]} From {r[1]}: {r[2]}" + line_ending
-        output += line_ending
-      send_data(session, output)
-
     case "DEL":
       if len(tokens) == 2 and tokens[1].isdigit():
         msg_id = int(tokens[1])
@@ -269,15 +485,9 @@ Commands:
 
     case "BYE":
       send_data(session, "Goodbye!" + line_ending)
-      if "ax25_session" in session:
-        session["ax25_session"].close()
-      elif "tcp_session" in session:
-        # Close the TCP session
-        print(f"Closing TCP session for {src} -> {dst}")
-        ssh_server.close_client(session["tcp_session"])
-      else:
-        print(f"No session found. Cannot close.")
-      session["active"] = False
+      flush(session)
+      close_after_output(session)
+      session.active = False
 
     case "WHO":
       active_sessions = session_manager.get_active_sessions()
@@ -286,8 +496,13 @@ Commands:
         send_data(session, "No active sessions." + line_ending)
       else:
         output = "Active sessions:" + line_ending
-        for (s, d, port), _ in active_sessions:
-          output += f"{s} -> {d} on port {port}" + line_ending
+        for s in active_sessions:
+          output += f"{s.src} -> {s.dst} on port {s.port}" + line_ending
+        # Users of the other processes sharing the presence directory
+        for process_name, src_call, dst_call, s_port in presence.remote_sessions():
+          output += (
+            f"{src_call} -> {dst_call} on port {s_port} at {process_name}" + line_ending
+          )
         send_data(session, output + line_ending)
 
     case "CHAT":
@@ -297,52 +512,199 @@ Commands:
       else:
         send_data(session, "Usage: CHAT <CALLSIGN>" + line_ending)
 
+    case "JOIN":
+      if len(tokens) == 2 and re.fullmatch(r"\w{1,16}", tokens[1]):
+        join_room(session, tokens[1].upper(), src)
+      else:
+        send_data(session, "Usage: JOIN <room>" + line_ending)
+
     case "VER":
       send_data(session, f"OGLBBS version {version}" + line_ending)
 
+    case "STATS":
+      if is_sysop(src):
+        send_data(session, format_stats())
+      else:
+        send_data(session, "STATS is for the sysop only." + line_ending)
+
     case _:
       send_data(session, f"Unknown command: {cmd}" + line_ending)
       send_data(session, "Type HELP for commands." + line_ending)
-  bbs_db.shutdown(db_handle)
   return True
 
 
-class bbs_connection(pe.connect.Connection):
-  def __init__(self, port, call_from, call_to, incoming=False):
-    super().__init__(port, call_from, call_to, incoming)
-    # Now perform any initialization of your own that you might need
-    print(f"New connection from {call_from} to {call_to} on port {port}")
-
-  @classmethod
-  def query_accept(cls, port, call_from, call_to):
-    """
-    This method is called when a new connection is being established.
-    You can return True to accept the connection or False to reject it.
-    """
-    print(f"Querying connection from {call_from} to {call_to} on port {port}")
-    # Validate callsigns
-    if not is_valid_callsign(call_from) or not is_valid_callsign(call_to):
-      print(f"Invalid callsign: {call_from} -> {call_to}")
-      return False
-    print(f"Accepting connection from {call_from} to {call_to}")
+def _define_connection_class():
+  """
+  Define bbs_connection. pe creates one for every AX.25 connection, taking the
+  most recently defined subclass of its Connection class.
+  """
+  global bbs_connection
+  import pe.connect
+
+  class bbs_connection(pe.connect.Connection):
+    def __init__(self, port, call_from, call_to, incoming=False):
+      super().__init__(port, call_from, call_to, incoming)
+      # Now perform any initialization of your own that you might need
+      logger.info("New connection from %s to %s on port %s", call_from, call_to, port)
+
+    @classmethod
+    def query_accept(cls, port, call_from, call_to):
+      """
+      This method is called when a new connection is being established.
+      You can return True to accept the connection or False to reject it.
+      """
+      logger.debug(
+        "Querying connection from %s to %s on port %s", call_from, call_to, port
+      )
+      # Validate callsigns
+      if not is_valid_callsign(call_from) or not is_valid_callsign(call_to):
+        logger.warning("Invalid callsign: %s -> %s", call_from, call_to)
+        return False
+      if not ratelimit.allow("connect", bbs_db.base_callsign(call_from)):
+        logger.warning("Refusing connection from %s: too many connects", call_from)
+        return False
+      logger.info("Accepting connection from %s to %s", call_from, call_to)
+      return True
+
+    def connected(self):
+      logger.info("Connection opened from %s to %s", self.call_from, self.call_to)
+      session_manager.add_ax25(self.call_from, self.call_to, self.port, self)
+      send_greeting(self.call_from, self.call_to, self.port)
+
+    def disconnected(self):
+      logger.info("Connection closed from %s to %s", self.call_from, self.call_to)
+      session_manager.remove(self.call_from, self.call_to, self.port, self)
+
+    def data_received(self, pid, data):
+      handle_data(db_filename, self.call_from, self.call_to, self.port, data)
+
+
+def send_private_message(session, db_handle, rcpt, msg):
+  """Store a SEND, to be forwarded if it is for a user of another node."""
+  call, _, node = rcpt.upper().partition("@")
+  # A plain CALL has no node, not an empty one
+  node = node or None
+  if node and forward.is_local(node):
+    node = None
+  elif node and forward.route(node) is None:
+    send_data(session, f"No route to {node}." + line_ending)
+    return
+  elif node is None and forward.peers:
+    # Replies go to the node the user was last heard from
+    node = bbs_db.get_home(db_handle, call)
+    if node is not None and forward.route(node) is None:
+      node = None
+  if node is not None:
+    node = forward.node_of(node)
+  bbs_db.store_private_message(db_handle, session.src.upper(), call, msg, node)
+  if node is None:
+    send_data(session, f"Message sent to {rcpt}" + line_ending)
+  else:
+    forward.kick()
+    send_data(session, f"Message to {call} queued for {node}." + line_ending)
+
+
+def allow_message(session):
+  """Whether the user may store another message, telling them if not."""
+  if ratelimit.allow("message", bbs_db.base_callsign(session.src)):
     return True
+  send_data(session, "Too many messages, try again later." + line_ending)
+  return False
+
+
+def archive_arg(tokens):
+  """
+  Whether LIST, READ or SEARCH asks for the archive, and the tokens without
+  the ARCHIVE keyword.
+  """
+  if len(tokens) == 2:
+    parts = tokens[1].split(maxsplit=1)
+    if parts[0].upper() == "ARCHIVE":
+      return True, [tokens[0], *parts[1:]]
+  return False, tokens
+
 
-  def connected(self):
-    print(f"Connection opened from {self.call_from} to {self.call_to}")
-    session_manager.add_ax25(self.call_from, self.call_to, self.port, self)
-    send_greeting(self.call_from, self.call_to, self.port)
-
-  def disconnected(self):
-    print(f"Connection closed from {self.call_from} to {self.call_to}")
-    session_manager.remove(self.call_from, self.call_to, self.port)
-
-  def data_received(self, pid, data):
-    handle_command(
-      db_filename,
-      self.call_from,
-      self.call_to,
-      self.port,
-      data.decode(errors="ignore").strip(),
+def page_size_arg(tokens):
+  """Page size asked for by LIST or READ, page_size if none, None if invalid."""
+  if len(tokens) == 1:
+    return page_size
+  if tokens[1].isdigit() and int(tokens[1]) > 0:
+    return min(int(tokens[1]), max_page_size)
+  return None
+
+
+def send_page(session, db_handle, command, count, before_id=None, archived=False):
+  """
+  Send count messages of LIST or READ, older than before_id, and remember
+  where MORE continues. Rows are sent as they are read from the database.
+  """
+  if command == "LIST":
+    rows = bbs_db.list_messages(db_handle, count + 1, before_id, archived)
+  else:
+    rows = bbs_db.list_private_messages(
+      db_handle, session.src.upper(), count + 1, before_id, archived
+    )
+  session.more = None
+  ids = []
+  for msg_id, sender, content, timestamp in rows:
+    if len(ids) == count:
+      # One row more than the page was asked for, so there is another page
+      session.more = (command, count, ids[-1], archived)
+      break
+    if command == "LIST":
+      send_data(session, f"[{timestamp}] {sender}: {content}" + line_ending)
+    else:
+      if not ids:
+        send_data(session, line_ending + "Private messages:" + line_ending)
+      send_data(
+        session, f"[{timestamp}] ID:{msg_id} From {sender}: {content}" + line_ending
+      )
+    ids.append(msg_id)
+
+  if not ids:
+    if before_id is not None:
+      send_data(session, "No more messages." + line_ending)
+    elif archived:
+      send_data(session, "No archived messages." + line_ending)
+    elif command == "LIST":
+      send_data(session, "No public messages." + line_ending)
+    else:
+      send_data(session, "No private messages." + line_ending)
+    return
+  if command == "READ" and not archived:
+    bbs_db.mark_read(db_handle, ids)
+    send_data(session, line_ending)
+  if session.more is not None:
+    send_data(session, "Type MORE for older messages." + line_ending)
+
+
+def send_search(session, db_handle, text, archived=False):
+  """Send the newest messages matching the words of a SEARCH."""
+  scope = "all"
+  parts = text.split(maxsplit=1)
+  if len(parts) == 2 and parts[0].upper() in ("PUBLIC", "PRIVATE"):
+    scope = parts[0].lower()
+    text = parts[1]
+  query = bbs_db.fts_query(text)
+  if query is None:
+    send_data(session, "Usage: SEARCH [ARCHIVE] [PUBLIC|PRIVATE] <words>" + line_ending)
+    return
+  rows = bbs_db.search_messages(
+    db_handle, query, session.src.upper(), scope, search_limit, archived
+  )
+  found = 0
+  for msg_id, sender, content, timestamp, is_private in rows:
+    if is_private:
+      line = f"[{timestamp}] ID:{msg_id} From {sender} (private): {content}"
+    else:
+      line = f"[{timestamp}] {sender}: {content}"
+    send_data(session, line + line_ending)
+    found += 1
+  if found == 0:
+    send_data(session, "No messages found." + line_ending)
+  elif found == search_limit:
+    send_data(
+      session, f"Showing the {found} newest matches. Add words to narrow." + line_ending
     )
 
 
@@ -355,15 +717,25 @@ def chat_init(session, chat_target, call):
   target_active = False
   # check if the target is active, i.e. connected to the BBS
   target_sessions = session_manager.get_all_sessions_by_call(chat_target)
-  print(f"Got sessions for {chat_target}: {target_sessions}")
-  for (_, _, _), target_session in target_sessions:
-    if target_session["active"]:
-      session["chat_target"] = chat_target
-      # print(f"Chatting with {chat_target} on port {session['port']}")
+  if not target_sessions and "-" not in chat_target:
+    # No exact match, try the callsign with any SSID
+    target_sessions = session_manager.get_all_sessions_by_base_call(chat_target)
+  logger.debug("Got sessions for %s: %s", chat_target, target_sessions)
+  for target_session in target_sessions:
+    if target_session.active:
+      chat_target = target_session.src
+      session.chat_target = chat_target
       target_active = True
       break
 
   if not target_active:
+    remote_target = presence.find(chat_target)
+    if remote_target is not None:
+      # The other process answers busy if the user is already in a chat
+      logger.info("Chat request from %s to %s of another process", call, remote_target)
+      start_chat_request(session, remote_target)
+      chat_event(remote_target, "request", call)
+      return True
     send_data(session, f"{chat_target} is not connected." + line_ending)
     send_data(
       session,
@@ -372,47 +744,337 @@ def chat_init(session, chat_target, call):
     return False
 
   # Check if the target is already in a chat
-  if target_session["state"] == "chat_request" or target_session["state"] == "chat":
+  if target_session.state in ("chat_request", "chat", "room"):
     send_data(session, f"{chat_target} is already in a chat." + line_ending)
     return False
 
-  # Set the chat target in the session
-  session["chat_target"] = chat_target
-  session["state"] = "chat_request"
-  target_session["state"] = "chat_request"
-  target_session["chat_target"] = call
-
+  start_chat_request(session, chat_target)
   # Notify the target about the chat request
-  send_data(
-    target_session,
-    f"{call} wants to chat with you. Type ACCEPT to start chatting." + line_ending,
-  )
-
+  submit_chat_event(target_session, "request", call)
   return True
 
 
-# Send data to the session, either ax25 or tcp
+def start_chat_request(session, chat_target):
+  session.chat_target = chat_target
+  session.state = "chat_request"
+  session.chat_deadline = time.monotonic() + chat_request_timeout
+  timers.call_later(chat_request_timeout, _chat_request_timer, session)
+
+
+def chat_event(target_call, event, call, text=None):
+  """
+  Pass a chat event from call to the sessions of target_call, or to the other
+  process the user is connected to.
+  """
+  target_sessions = session_manager.get_all_sessions_by_call(target_call)
+  if not target_sessions:
+    presence.send_chat(target_call, event, call, text)
+  for target_session in target_sessions:
+    submit_chat_event(target_session, event, call, text)
+
+
+def submit_chat_event(target_session, event, call, text=None):
+  """Apply a chat event on the command queue of the target session."""
+  if not dispatcher.submit(
+    target_session, _apply_queued_chat_event, target_session, event, call, text
+  ):
+    logger.warning(
+      "Dropped chat event %s from %s to %s", event, call, target_session.src
+    )
+
+
+def apply_chat_event(target_session, event, call, text=None):
+  match event:
+    case "request":
+      target_session.state = "chat_request"
+      target_session.chat_target = call
+      send_data(
+        target_session,
+        f"{call} wants to chat with you. Type ACCEPT to start chatting." + line_ending,
+      )
+    case "accept":
+      send_data(
+        target_session,
+        line_ending + "You are now connected. Type _EOF_ to end chat." + line_ending,
+      )
+      target_session.state = "chat"
+    case "abort":
+      send_data(target_session, "Chat request aborted." + line_ending)
+      target_session.state = "new"
+      target_session.chat_target = None
+    case "end":
+      send_data(target_session, "Chat session ended." + line_ending)
+      target_session.state = "new"
+      target_session.chat_target = None
+    case "timeout":
+      if target_session.state == "chat_request":
+        target_session.state = "new"
+        target_session.chat_target = None
+        send_data(target_session, "Chat request timed out." + line_ending)
+        send_prompt(target_session)
+    case "busy":
+      # Answer of another process to a request
+      if target_session.state == "chat_request" and target_session.chat_target == call:
+        target_session.state = "new"
+        target_session.chat_target = None
+        target_session.chat_deadline = None
+        send_data(target_session, f"{call} is already in a chat." + line_ending)
+        send_prompt(target_session)
+    case "line":
+      send_data(target_session, text + line_ending)
+
+
+def remote_chat_event(target_call, event, call, text):
+  """A chat event from another process, called on the presence thread."""
+  for target_session in session_manager.get_all_sessions_by_call(target_call):
+    submit_chat_event(target_session, event, call, text)
+
+
+def _apply_queued_chat_event(target_session, event, call, text):
+  if not is_current(target_session):
+    return
+  # The user may have started another chat since the request was sent
+  if event == "request" and (
+    not target_session.active
+    or target_session.state in ("chat_request", "chat", "room")
+  ):
+    chat_event(call, "busy", target_session.src)
+    return
+  with batched_output():
+    apply_chat_event(target_session, event, call, text)
+
+
+def join_room(session, room, call):
+  logger.info("%s joined room %s", call, room)
+  others = session_manager.join_room(session, room)
+  session.state = "room"
+  msg = f"You are in room {room}. Type _EOF_ to leave." + line_ending
+  if others:
+    msg += "Here: " + ", ".join(other.src for other in others) + line_ending
+  else:
+    msg += "Nobody else is here yet." + line_ending
+  send_data(session, msg)
+  for other in others:
+    send_data(other, f"{call} joined the room." + line_ending)
+
+
+@contextmanager
+def batched_output():
+  """Hold back output to sessions until the end of the block, then flush it."""
+  if getattr(_output_batch, "sessions", None) is not None:
+    # Already batching, the outermost block flushes
+    yield
+    return
+  _output_batch.sessions = {}
+  try:
+    yield
+  finally:
+    sessions = _output_batch.sessions
+    _output_batch.sessions = None
+    for session in sessions:
+      flush(session)
+
+
+# Send data, str or bytes, to the session, either ax25 or tcp
 def send_data(session, data):
-  if session["active"]:
-    if "ax25_session" in session:
-      print(f"Sending data to ax25 session")
-      session["ax25_session"].send_data(data.encode())
-    elif "tcp_session" in session:
-      print(f"Sending data to tcp_session")
-      ssh_server.send_data(session["tcp_session"], data.encode())
-    else:
-      print(f"No session found. Cannot send data.")
+  if not session.active:
+    logger.warning("Session is not active, cannot send data.")
+    return False
+  if session.ax25_session is None and session.tcp_session is None:
+    logger.warning("No session found. Cannot send data.")
+    return False
+  if isinstance(data, str):
+    data = data.encode()
+  with session.output_lock:
+    session.output += data
+  pending = getattr(_output_batch, "sessions", None)
+  if pending is None or not coalesce_output:
+    return flush(session)
+  pending[session] = None
+  return True
+
+
+# Send out the buffered output of the session
+def flush(session):
+  with session.output_lock:
+    if not session.output:
+      return True
+    data = bytes(session.output)
+    session.output.clear()
+  if not session.active:
+    logger.warning("Session is not active, cannot send data.")
+    return False
+  if use_writers:
+    return queue_output(session, data)
+  return transmit(session, data)
+
+
+def queue_output(session, data):
+  """
+  Queue data for the writer thread of the session, starting it if needed.
+  Returns False if the session is being closed.
+  """
+  with session.outbox_ready:
+    if session.closing:
       return False
+    session.outbox.append(data)
+    session.outbox_bytes += len(data)
+    if session.outbox_bytes > max_queued_output and len(session.outbox) > 1:
+      _overflow(session)
+    _wake_writer(session)
+  return True
+
+
+def _wake_writer(session):
+  # Called with session.outbox_ready held
+  if use_airtime and session.ax25_session is not None:
+    airtime.wake(session, paclen.get(session.port, default_paclen))
+  elif session.writer is None:
+    session.writer = threading.Thread(
+      target=_writer_loop, args=(session,), name=f"writer-{session.src}", daemon=True
+    )
+    session.writer.start()
   else:
-    print(f"Session is not active, cannot send data.")
-    return False
+    session.outbox_ready.notify()
+
+
+def _overflow(session):
+  metrics.inc("oglbbs_output_overflows_total", policy=overflow_policy)
+  if overflow_policy == "disconnect":
+    logger.warning("Output queue of %s is full, disconnecting.", session.src)
+    session.outbox.clear()
+    session.outbox_bytes = 0
+    session.closing = True
+    return
+  logger.debug("Output queue of %s is full, dropping the oldest.", session.src)
+  while session.outbox_bytes > max_queued_output and len(session.outbox) > 1:
+    session.outbox_bytes -= len(session.outbox.popleft())
+
+
+def close_after_output(session):
+  """Hang up on the session once its queued output has been written."""
+  if not use_writers:
+    close_transport(session)
+    return
+  with session.outbox_ready:
+    session.closing = True
+    _wake_writer(session)
+
+
+def _writer_loop(session):
+  while True:
+    with session.outbox_ready:
+      while not session.outbox and not session.closing:
+        # Linger for a while, so a burst of output does not start many threads
+        if not session.outbox_ready.wait(writer_linger) and not session.outbox:
+          if not session.closing:
+            session.writer = None
+            return
+      # Write everything queued in one go, it goes out in full frames
+      data = b"".join(session.outbox)
+      session.outbox.clear()
+      session.outbox_bytes = 0
+      closing = session.closing and not data
+      if closing:
+        session.writer = None
+    if closing:
+      close_transport(session)
+      return
+    # Over its output rate, the station waits on its own writer thread
+    wait = ratelimit.delay("output", bbs_db.base_callsign(session.src), len(data))
+    if wait > 0:
+      time.sleep(wait)
+    try:
+      transmit(session, data)
+    except Exception as e:
+      logger.error("Error sending to %s: %s", session.src, e)
+
+
+def close_transport(session):
+  if session.ax25_session is not None:
+    # The disconnect frame must not land inside a data frame of another thread
+    with _agwpe_send_lock:
+      session.ax25_session.close()
+  elif session.tcp_session is not None:
+    # Close the TCP session
+    logger.info("Closing TCP session for %s -> %s", session.src, session.dst)
+    from . import ssh_server
+
+    ssh_server.close_client(session.tcp_session)
+  else:
+    logger.warning("No session found. Cannot close.")
+
+
+def transmit(session, data):
+  """Write data to the transport of the session."""
+  if session.ax25_session is not None:
+    # Fill every frame up to paclen
+    length = paclen.get(session.port, default_paclen)
+    logger.debug("Sending %s bytes to ax25 session", len(data))
+    # pe writes frames to the AGWPE socket without locking
+    with _agwpe_send_lock:
+      for i in range(0, len(data), length):
+        session.ax25_session.send_data(data[i : i + length])
+    metrics.inc("oglbbs_sent_bytes_total", len(data), transport="ax25")
+    metrics.inc("oglbbs_sent_frames_total", -(-len(data) // length), transport="ax25")
+  elif session.tcp_session is not None:
+    logger.debug("Sending %s bytes to tcp_session", len(data))
+    metrics.inc("oglbbs_sent_bytes_total", len(data), transport="tcp")
+    metrics.inc("oglbbs_sent_frames_total", transport="tcp")
+    from . import ssh_server
+
+    return ssh_server.send_data(session.tcp_session, data)
   return True
 
 
+def format_stats():
+  """Human readable summary of the metrics for the STATS command."""
+  sessions = session_manager.count_by_transport()
+  output = line_ending + "Sessions:"
+  for transport, count in sessions.items():
+    output += f" {transport} {count}"
+  output += line_ending
+
+  sent_bytes = metrics.counter_values("oglbbs_sent_bytes_total")
+  sent_frames = metrics.counter_values("oglbbs_sent_frames_total")
+  for key, count in sorted(sent_bytes.items()):
+    transport = dict(key)["transport"]
+    frames = sent_frames.get(key, 0)
+    output += f"Sent {transport}: {count} bytes in {frames} frames" + line_ending
+
+  for title, name, label in (
+    ("Commands", "oglbbs_command_duration_seconds", "command"),
+    ("Database", "oglbbs_db_query_duration_seconds", "query"),
+    ("SSH handshakes", "oglbbs_ssh_handshake_duration_seconds", None),
+  ):
+    rows = metrics.summary(name)
+    if not rows:
+      continue
+    output += f"{title} (count, mean/p50/p99 ms):" + line_ending
+    for labels, count, mean, p50, p99 in rows:
+      output += (
+        f"  {labels.get(label, 'all'):<22} {count:>6} "
+        f"{mean * 1000:.1f}/{p50 * 1000:.1f}/{p99 * 1000:.1f}" + line_ending
+      )
+  return output
+
+
 def send_greeting(call_from, call_to, port):
+  # Queued as well, so that it goes out before the replies to the first commands
   session = session_manager.get(call_from, call_to, port)
-  msg = bbs_banner_text
-  send_data(session, msg)
+  dispatcher.submit(session, _send_greeting, session)
+  watch_idle(session)
+
+
+def _send_greeting(session):
+  if is_current(session):
+    with batched_output():
+      _write_greeting(session)
+
+
+def _write_greeting(session):
+  call_from = session.src
+  send_data(session, bbs_banner)
   msg = (
     line_ending
     + f"Welcome to OGLBBS v{version}!"
@@ -421,12 +1083,15 @@ def send_greeting(call_from, call_to, port):
     + line_ending
   )
   # Get number of messages
-  db_handle = bbs_db.init_db(db_filename)
-  private_messages = bbs_db.list_private_messages(db_handle, call_from.upper())
-  bbs_db.shutdown(db_handle)
-  message_count = len(private_messages)
+  db_handle = bbs_db.get_db(db_filename)
+  if forward.peers and bbs_db.get_home(db_handle, call_from) is not None:
+    # Messages for the user are no longer forwarded elsewhere
+    bbs_db.clear_home(db_handle, call_from)
+  message_count, unread_count = bbs_db.get_mailbox_counts(db_handle, call_from.upper())
   if message_count > 0:
-    msg += f"You have {message_count} private messages." + line_ending
+    msg += (
+      f"You have {message_count} private messages, {unread_count} unread." + line_ending
+    )
   else:
     msg += "You have no private messages." + line_ending
 
@@ -434,9 +1099,108 @@ def send_greeting(call_from, call_to, port):
   send_prompt(session)
 
 
+# === Housekeeping ===
+# Run by the timers of the main loop. Work on a session goes through its
+# command queue, so it does not race with the commands of the user.
+def transport_of(session):
+  return "ax25" if session.ax25_session is not None else "tcp"
+
+
+def watch_idle(session):
+  """Disconnect the session once it has been idle for too long."""
+  timeout = idle_timeout.get(transport_of(session), 0)
+  if timeout > 0:
+    timers.call_later(timeout, _idle_timer, session)
+
+
+def _idle_timer(session):
+  if not dispatcher.submit(session, _check_idle, session):
+    # Too busy to be idle
+    watch_idle(session)
+
+
+def _check_idle(session):
+  if not is_current(session) or session.closing:
+    return
+  timeout = idle_timeout.get(transport_of(session), 0)
+  idle = time.monotonic() - session.last_active
+  if idle < timeout:
+    timers.call_later(timeout - idle, _idle_timer, session)
+    return
+  logger.info("Disconnecting %s, idle for %d seconds.", session.src, idle)
+  send_data(session, line_ending + "Idle for too long. Goodbye!" + line_ending)
+  flush(session)
+  close_after_output(session)
+  session.active = False
+
+
+def _session_changed(event, session):
+  # Whoever is left waiting in a chat or chat request with a user who has gone
+  # is told as if it had timed out or ended
+  if event != "remove" or session.chat_target is None:
+    return
+  match session.state:
+    case "chat_request":
+      chat_event(session.chat_target, "timeout", session.src)
+    case "chat":
+      chat_event(session.chat_target, "end", session.src)
+
+
+def _chat_request_timer(session):
+  if not dispatcher.submit(session, _expire_chat_request, session):
+    timers.call_later(timers.tick, _chat_request_timer, session)
+
+
+def _expire_chat_request(session):
+  if not is_current(session) or session.state != "chat_request":
+    return
+  # A newer request may be pending
+  if session.chat_deadline is None or session.chat_deadline > time.monotonic():
+    return
+  logger.info("Chat request from %s to %s expired", session.src, session.chat_target)
+  chat_target = session.chat_target
+  session.state = "new"
+  session.chat_target = None
+  session.chat_deadline = None
+  with batched_output():
+    send_data(session, "Chat request timed out." + line_ending)
+    send_prompt(session)
+    chat_event(chat_target, "timeout", session.src)
+
+
+def housekeeping():
+  """
+  Archive a batch of expired messages, purge a batch of deleted ones or give
+  back a batch of free pages. Runs again soon while there is more to do,
+  otherwise after housekeeping_interval.
+  """
+  db_handle = bbs_db.get_db(db_filename)
+  try:
+    # Messages for other nodes are archived once every peer has them
+    forwarded_id = min(
+      (bbs_db.get_watermark(db_handle, peer) for peer in forward.peers), default=0
+    )
+    archived = bbs_db.archive_expired(db_handle, forwarded_id=forwarded_id)
+    if archived:
+      logger.info("Archived %s expired messages.", archived)
+    more = archived >= bbs_db.archive_batch
+    if not more:
+      purged = bbs_db.purge_deleted(db_handle)
+      if purged:
+        logger.info("Purged %s deleted messages.", purged)
+      more = purged >= bbs_db.purge_batch
+    if not more:
+      more = bbs_db.incremental_vacuum(db_handle) >= bbs_db.vacuum_pages
+  except Exception as e:
+    logger.error("Housekeeping failed: %s", e)
+    more = False
+  ratelimit.expire()
+  timers.call_later(housekeeping_pause if more else housekeeping_interval, housekeeping)
+
+
 def shutdown():
   try:
     app.stop()
-    print("BBS stopped.")
+    logger.info("BBS stopped.")
   except Exception:
     pass
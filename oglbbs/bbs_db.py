@@ -1,11 +1,93 @@
+import functools
+import logging
+import re
 import sqlite3
+import sys
+import threading
+import time
+import queue
+from concurrent.futures import Future
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+metrics.describe(
+  "oglbbs_db_query_duration_seconds",
+  "histogram",
+  "Duration of database calls, including the wait for the writer",
+)
+
+# === Connection pool ===
+# Every thread (the AGWPE callback thread, SSH client and transport threads)
+# gets its own long-lived connection. Connections of finished threads are
+# parked in an idle list and handed to the next thread asking for one.
+busy_timeout = 5.0
+max_idle_connections = 8
+# Size of the per-connection prepared statement cache. All queries below are
+# constant strings, so each is compiled once per connection and reused.
+statement_cache_size = 128
+
+pragmas = (
+  "PRAGMA journal_mode=WAL",
+  "PRAGMA synchronous=NORMAL",
+  "PRAGMA temp_store=MEMORY",
+  "PRAGMA cache_size=-4000",
+)
+
+_local = threading.local()
+_pool_lock = threading.Lock()
+_idle = {}
+_all_connections = []
+
+# === Writer ===
+# All writes go through a single writer thread with its own connection.
+# Writes queued while a transaction is being committed are grouped into the
+# next transaction, so a burst of writes costs one commit instead of one each.
+max_batch_size = 64
+
+_write_queue = queue.SimpleQueue()
+_writer_thread = None
+
+# === Full-text search ===
+# Messages stored before the search index existed are indexed in the
+# background, newest first, one small write transaction per batch.
+fts_backfill_batch = 500
+fts_backfill_pause = 0.05
+# Most words of a SEARCH used in the query
+max_search_terms = 8
+
+# === Housekeeping ===
+# Deleted messages are purged and the freed pages given back in small
+# batches, each its own short write transaction.
+purge_batch = 500
+vacuum_pages = 256
+
+# === Archive ===
+# Messages past their retention are moved to an archive database, ATTACHed
+# to every connection as "archive", so the hot messages table and its indexes
+# stay small. Ages are in days, counts are of the newest messages kept, for
+# private messages per mailbox. 0 keeps messages forever.
+archive_file = None
+public_max_age_days = 0
+public_max_count = 0
+private_max_age_days = 0
+private_max_count = 0
+archive_batch = 500
+
+_backfill_thread = None
+_backfill_stop = threading.Event()
 
 
 # === SQLite Setup ===
-def init_db(db_file="bbs.db"):
-  db = sqlite3.connect(db_file)
-  cur = db.cursor()
-  cur.execute("""
+# Schema migrations, applied in order. The index of the last applied one is
+# kept in PRAGMA user_version, so existing database files are upgraded in
+# place. Never edit a released migration, append a new one instead.
+migrations = [
+  # 1: initial schema
+  (
+    """
       CREATE TABLE IF NOT EXISTS messages (
           id INTEGER PRIMARY KEY AUTOINCREMENT,
           sender TEXT NOT NULL,
@@ -15,9 +97,8 @@ def init_db(db_file="bbs.db"):
           deleted INTEGER DEFAULT 0,
           timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
       )
-  """)
-  db.commit()
-  cur.execute("""
+    """,
+    """
       CREATE TABLE IF NOT EXISTS users (
           id INTEGER PRIMARY KEY AUTOINCREMENT,
           username TEXT UNIQUE NOT NULL,
@@ -25,24 +106,402 @@ def init_db(db_file="bbs.db"):
           created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
           last_login DATETIME
       )
-  """)
-  db.commit()
+    """,
+  ),
+  # 2: recipient callsign without SSID, indexed mailbox and public lookups
+  (
+    "ALTER TABLE messages ADD COLUMN base_recipient TEXT",
+    """
+      UPDATE messages SET base_recipient =
+        CASE WHEN instr(recipient, '-') > 0
+          THEN substr(recipient, 1, instr(recipient, '-') - 1)
+          ELSE recipient
+        END
+      WHERE recipient IS NOT NULL
+    """,
+    """
+      CREATE INDEX IF NOT EXISTS idx_messages_mailbox
+        ON messages (base_recipient, is_private, deleted, id)
+    """,
+    """
+      CREATE INDEX IF NOT EXISTS idx_messages_public
+        ON messages (is_private, deleted, id)
+    """,
+  ),
+  # 3: read flag and per-recipient mailbox counters kept up to date by triggers
+  (
+    "ALTER TABLE messages ADD COLUMN is_read INTEGER DEFAULT 0",
+    """
+      CREATE TABLE IF NOT EXISTS mailboxes (
+          base_recipient TEXT PRIMARY KEY,
+          total INTEGER NOT NULL DEFAULT 0,
+          unread INTEGER NOT NULL DEFAULT 0
+      ) WITHOUT ROWID
+    """,
+    """
+      INSERT INTO mailboxes (base_recipient, total, unread)
+        SELECT base_recipient, count(*), count(*) FROM messages
+        WHERE is_private = 1 AND deleted = 0 AND base_recipient IS NOT NULL
+        GROUP BY base_recipient
+    """,
+    """
+      CREATE TRIGGER IF NOT EXISTS trg_mailbox_insert
+      AFTER INSERT ON messages
+      WHEN NEW.is_private = 1 AND NEW.deleted = 0
+      BEGIN
+        INSERT INTO mailboxes (base_recipient, total, unread)
+          VALUES (NEW.base_recipient, 1, NEW.is_read = 0)
+          ON CONFLICT (base_recipient) DO UPDATE
+            SET total = total + 1, unread = unread + (NEW.is_read = 0);
+      END
+    """,
+    """
+      CREATE TRIGGER IF NOT EXISTS trg_mailbox_soft_delete
+      AFTER UPDATE OF deleted ON messages
+      WHEN OLD.is_private = 1 AND OLD.deleted = 0 AND NEW.deleted = 1
+      BEGIN
+        UPDATE mailboxes
+          SET total = total - 1, unread = unread - (OLD.is_read = 0)
+          WHERE base_recipient = OLD.base_recipient;
+      END
+    """,
+    """
+      CREATE TRIGGER IF NOT EXISTS trg_mailbox_read
+      AFTER UPDATE OF is_read ON messages
+      WHEN NEW.is_private = 1 AND NEW.deleted = 0 AND OLD.is_read = 0 AND NEW.is_read = 1
+      BEGIN
+        UPDATE mailboxes SET unread = unread - 1
+          WHERE base_recipient = NEW.base_recipient;
+      END
+    """,
+    """
+      CREATE TRIGGER IF NOT EXISTS trg_mailbox_delete
+      AFTER DELETE ON messages
+      WHEN OLD.is_private = 1 AND OLD.deleted = 0
+      BEGIN
+        UPDATE mailboxes
+          SET total = total - 1, unread = unread - (OLD.is_read = 0)
+          WHERE base_recipient = OLD.base_recipient;
+      END
+    """,
+  ),
+  # 4: full-text index of the messages, kept in sync by triggers. Rows older
+  # than fts_backfill.last_id are not indexed yet, see start_fts_backfill.
+  (
+    """
+      CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+          sender, content, base_recipient,
+          content='messages', content_rowid='id'
+      )
+    """,
+    """
+      CREATE TABLE IF NOT EXISTS fts_backfill (
+          id INTEGER PRIMARY KEY CHECK (id = 0),
+          last_id INTEGER NOT NULL
+      )
+    """,
+    """
+      INSERT INTO fts_backfill (id, last_id)
+        SELECT 0, max(id) FROM messages HAVING max(id) IS NOT NULL
+    """,
+    """
+      CREATE TRIGGER IF NOT EXISTS trg_fts_insert
+      AFTER INSERT ON messages
+      WHEN NEW.deleted = 0
+      BEGIN
+        INSERT INTO messages_fts (rowid, sender, content, base_recipient)
+          VALUES (NEW.id, NEW.sender, NEW.content, NEW.base_recipient);
+      END
+    """,
+    """
+      CREATE TRIGGER IF NOT EXISTS trg_fts_soft_delete
+      AFTER UPDATE OF deleted ON messages
+      WHEN OLD.deleted = 0 AND NEW.deleted = 1
+        AND OLD.id > coalesce((SELECT last_id FROM fts_backfill), 0)
+      BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, sender, content, base_recipient)
+          VALUES ('delete', OLD.id, OLD.sender, OLD.content, OLD.base_recipient);
+      END
+    """,
+    """
+      CREATE TRIGGER IF NOT EXISTS trg_fts_delete
+      AFTER DELETE ON messages
+      WHEN OLD.deleted = 0
+        AND OLD.id > coalesce((SELECT last_id FROM fts_backfill), 0)
+      BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, sender, content, base_recipient)
+          VALUES ('delete', OLD.id, OLD.sender, OLD.content, OLD.base_recipient);
+      END
+    """,
+  ),
+  # 5: store-and-forward to other nodes. msgid is the global id of a message
+  # received from another node, home_bbs the node a private message is to be
+  # forwarded to. forward_peers keeps the last message id each peer has
+  # acknowledged, homes the node a callsign was last heard from.
+  (
+    "ALTER TABLE messages ADD COLUMN msgid TEXT",
+    "ALTER TABLE messages ADD COLUMN home_bbs TEXT",
+    """
+      CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_msgid
+        ON messages (msgid) WHERE msgid IS NOT NULL
+    """,
+    """
+      CREATE INDEX IF NOT EXISTS idx_messages_home
+        ON messages (home_bbs, id) WHERE home_bbs IS NOT NULL
+    """,
+    """
+      CREATE TABLE IF NOT EXISTS forward_peers (
+          peer TEXT PRIMARY KEY,
+          last_forwarded INTEGER NOT NULL DEFAULT 0
+      )
+    """,
+    """
+      CREATE TABLE IF NOT EXISTS homes (
+          call TEXT PRIMARY KEY,
+          bbs TEXT NOT NULL
+      )
+    """,
+  ),
+]
+
+
+# Schema of the archive database, in the same way as migrations. Archived
+# messages keep their id and have the same columns and indexes, so queries run
+# unchanged on either schema. They are never soft deleted.
+archive_migrations = [
+  # 1: initial schema
+  (
+    """
+      CREATE TABLE IF NOT EXISTS archive.messages (
+          id INTEGER PRIMARY KEY,
+          sender TEXT NOT NULL,
+          recipient TEXT,
+          base_recipient TEXT,
+          content TEXT NOT NULL,
+          is_private INTEGER DEFAULT 0,
+          deleted INTEGER DEFAULT 0,
+          is_read INTEGER DEFAULT 0,
+          timestamp DATETIME,
+          archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+      )
+    """,
+    """
+      CREATE INDEX IF NOT EXISTS archive.idx_messages_mailbox
+        ON messages (base_recipient, is_private, deleted, id)
+    """,
+    """
+      CREATE INDEX IF NOT EXISTS archive.idx_messages_public
+        ON messages (is_private, deleted, id)
+    """,
+    """
+      CREATE VIRTUAL TABLE IF NOT EXISTS archive.messages_fts USING fts5(
+          sender, content, base_recipient,
+          content='messages', content_rowid='id'
+      )
+    """,
+    """
+      CREATE TRIGGER IF NOT EXISTS archive.trg_fts_insert
+      AFTER INSERT ON messages
+      BEGIN
+        INSERT INTO messages_fts (rowid, sender, content, base_recipient)
+          VALUES (NEW.id, NEW.sender, NEW.content, NEW.base_recipient);
+      END
+    """,
+  ),
+  # 2: routing of the private messages forwarded from or to other nodes
+  (
+    "ALTER TABLE archive.messages ADD COLUMN msgid TEXT",
+    "ALTER TABLE archive.messages ADD COLUMN home_bbs TEXT",
+  ),
+]
+
+
+def init_db(db_file="bbs.db"):
+  """Create or upgrade the schema. Call once at startup."""
+  db = get_db(db_file)
+  enable_incremental_vacuum(db)
+  migrate(db)
+  if archive_file is not None:
+    migrate(db, "archive", archive_migrations)
   return db
 
 
-def add_user_with_password(db, username, password):
-  cur = db.cursor()
+def enable_incremental_vacuum(db):
+  """Let purged pages be given back to the file system a few at a time."""
+  if db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+    return
+  db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+  # Only takes effect once the file is rebuilt
+  if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+    logger.info("Rebuilding the database for incremental vacuum.")
+    db.execute("VACUUM")
+
+
+def migrate(db, schema="main", steps=None):
+  """Apply the pending schema migrations in a single transaction."""
+  steps = migrations if steps is None else steps
+  db.execute("BEGIN IMMEDIATE")
+  try:
+    version = db.execute(f"PRAGMA {schema}.user_version").fetchone()[0]
+    for number, statements in enumerate(steps[version:], start=version + 1):
+      logger.info("Migrating %s database schema to version %s", schema, number)
+      for statement in statements:
+        db.execute(statement)
+      db.execute(f"PRAGMA {schema}.user_version = {number}")
+    db.commit()
+  except sqlite3.Error:
+    db.rollback()
+    raise
+
+
+def base_callsign(call):
+  """Strip the SSID from a callsign, e.g. HA5OGL-1 -> HA5OGL."""
+  return call.split("-")[0]
+
+
+def _connect(db_file):
+  db = sqlite3.connect(
+    db_file,
+    timeout=busy_timeout,
+    check_same_thread=False,
+    cached_statements=statement_cache_size,
+  )
+  for pragma in pragmas:
+    db.execute(pragma)
+  if archive_file is not None:
+    db.execute("ATTACH DATABASE ? AS archive", (archive_file,))
+    db.execute("PRAGMA archive.journal_mode=WAL")
+  return db
+
+
+def get_db(db_file="bbs.db"):
+  """Get the connection of the calling thread, opening one if needed."""
+  connections = getattr(_local, "connections", None)
+  if connections is None:
+    connections = _local.connections = {}
+  db = connections.get(db_file)
+  if db is not None:
+    return db
+  with _pool_lock:
+    idle = _idle.get(db_file)
+    if idle:
+      db = idle.pop()
+  if db is None:
+    db = _connect(db_file)
+    with _pool_lock:
+      _all_connections.append(db)
+  connections[db_file] = db
+  return db
+
+
+def release_db():
+  """Give the connections of the calling thread back to the pool."""
+  connections = getattr(_local, "connections", None)
+  if not connections:
+    return
+  for db_file, db in connections.items():
+    if db.in_transaction:
+      db.rollback()
+    with _pool_lock:
+      idle = _idle.setdefault(db_file, [])
+      if len(idle) < max_idle_connections:
+        idle.append(db)
+        continue
+      _all_connections.remove(db)
+    db.close()
+  connections.clear()
+
+
+def start_writer(db_file="bbs.db"):
+  """Start the writer thread. Until then, writes run on the caller's connection."""
+  global _writer_thread
+  if _writer_thread is not None:
+    return
+  _writer_thread = threading.Thread(
+    target=_writer_loop, args=(db_file,), name="db-writer", daemon=True
+  )
+  _writer_thread.start()
+
+
+def _writer_loop(db_file):
+  db = _connect(db_file)
+  running = True
+  while running:
+    batch = [_write_queue.get()]
+    # Take whatever else queued up in the meantime
+    while len(batch) < max_batch_size:
+      try:
+        batch.append(_write_queue.get_nowait())
+      except queue.Empty:
+        break
+    if None in batch:
+      running = False
+      batch = [item for item in batch if item is not None]
+    if batch:
+      _write_batch(db, batch)
+  db.close()
+
+
+def _write_batch(db, batch):
+  results = []
+  try:
+    db.execute("BEGIN IMMEDIATE")
+    for func, args, future in batch:
+      # A failing write must not take the rest of the batch with it
+      db.execute("SAVEPOINT write")
+      try:
+        result = func(db, *args)
+      except Exception as e:
+        db.execute("ROLLBACK TO write")
+        results.append((future, None, e))
+      else:
+        results.append((future, result, None))
+      db.execute("RELEASE write")
+    db.commit()
+  except sqlite3.Error as e:
+    if db.in_transaction:
+      db.rollback()
+    results = [(future, None, e) for _, _, future in batch]
+  for future, result, error in results:
+    if error is not None:
+      future.set_exception(error)
+    else:
+      future.set_result(result)
+
+
+def _write(db, func, *args):
+  """Run a write on the writer thread and wait until it is committed."""
+  if _writer_thread is None:
+    try:
+      result = func(db, *args)
+      db.commit()
+    except Exception:
+      db.rollback()
+      raise
+    return result
+  future = Future()
+  _write_queue.put((func, args, future))
+  return future.result()
+
+
+def _add_user_with_password(db, username, password):
   try:
-    cur.execute(
+    db.execute(
       "INSERT INTO users (username, password) VALUES (?, ?)", (username, password)
     )
-    db.commit()
   except sqlite3.IntegrityError:
-    print(f"User {username} already exists.")
+    logger.warning("User %s already exists.", username)
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="add_user_with_password")
+def add_user_with_password(db, username, password):
+  try:
+    _write(db, _add_user_with_password, username, password)
   except sqlite3.Error as e:
-    print(f"Error adding user {username}: {e}")
+    logger.error("Error adding user %s: %s", username, e)
 
 
+@metrics.timed("oglbbs_db_query_duration_seconds", query="get_user")
 def get_user(db, username):
   cur = db.cursor()
   cur.execute("SELECT username, password FROM users WHERE username = ?", (username,))
@@ -50,83 +509,562 @@ def get_user(db, username):
   return user
 
 
-def change_login_time(db, username):
-  cur = db.cursor()
-  cur.execute(
+def _change_login_time(db, username):
+  cur = db.execute(
     "UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE username = ?", (username,)
   )
-  db.commit()
   return cur.rowcount > 0
 
 
+@metrics.timed("oglbbs_db_query_duration_seconds", query="change_login_time")
+def change_login_time(db, username):
+  return _write(db, _change_login_time, username)
+
+
+def _change_password(db, username, new_password):
+  cur = db.execute(
+    "UPDATE users SET password = ? WHERE username = ?", (new_password, username)
+  )
+  return cur.rowcount > 0
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="change_password")
 def change_password(db, username, new_password):
-  cur = db.cursor()
   try:
-    cur.execute(
-      "UPDATE users SET password = ? WHERE username = ?", (new_password, username)
-    )
-    db.commit()
-    return cur.rowcount > 0
+    return _write(db, _change_password, username, new_password)
   except sqlite3.Error as e:
-    print(f"Error changing password for {username}: {e}")
+    logger.error("Error changing password for %s: %s", username, e)
     return False
 
 
-def store_message(db, sender, content):
+def _store_message(db, sender, content):
   db.execute("INSERT INTO messages (sender, content) VALUES (?, ?)", (sender, content))
-  db.commit()
 
 
-def store_private_message(db, sender, recipient, content):
+@metrics.timed("oglbbs_db_query_duration_seconds", query="store_message")
+def store_message(db, sender, content):
+  _write(db, _store_message, sender, content)
+
+
+def _store_private_message(db, sender, recipient, content, home_bbs):
+  db.execute(
+    """
+      INSERT INTO messages
+        (sender, recipient, base_recipient, content, is_private, home_bbs)
+      VALUES (?, ?, ?, ?, 1, ?)
+    """,
+    (sender, recipient, base_callsign(recipient), content, home_bbs),
+  )
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="store_private_message")
+def store_private_message(db, sender, recipient, content, home_bbs=None):
+  """Store a private message, to be forwarded to home_bbs if given."""
+  _write(db, _store_private_message, sender, recipient, content, home_bbs)
+
+
+# === Forwarding ===
+@metrics.timed("oglbbs_db_query_duration_seconds", query="get_home")
+def get_home(db, call):
+  """The node a callsign was last heard from, None if not another one."""
+  row = db.execute(
+    "SELECT bbs FROM homes WHERE call = ?", (base_callsign(call),)
+  ).fetchone()
+  return row[0] if row is not None else None
+
+
+def _clear_home(db, call):
+  db.execute("DELETE FROM homes WHERE call = ?", (base_callsign(call),))
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="clear_home")
+def clear_home(db, call):
+  """Forget the home node of a callsign, which has connected here."""
+  _write(db, _clear_home, call)
+
+
+def list_home_nodes(db):
+  """The nodes private messages are to be forwarded to."""
+  return [
+    row[0]
+    for row in db.execute(
+      "SELECT DISTINCT home_bbs FROM messages WHERE home_bbs IS NOT NULL"
+    )
+  ]
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="forward_batch")
+def forward_batch(db, node, homes, after_id, limit):
+  """
+  List (id, msgid, sender, recipient, home_bbs, content, timestamp) of the
+  private messages to be forwarded to the nodes in homes, after after_id.
+  Messages written here get the msgid "<id>@<node>".
+  """
+  placeholders = ", ".join("?" * len(homes))
+  return db.execute(
+    f"""
+      SELECT id, coalesce(msgid, id || '@' || ?), sender, recipient, home_bbs,
+        content, timestamp
+      FROM messages
+      WHERE home_bbs IN ({placeholders}) AND id > ?
+        AND is_private = 1 AND deleted = 0
+      ORDER BY id LIMIT ?
+    """,
+    (node, *homes, after_id, limit),
+  ).fetchall()
+
+
+def get_watermark(db, peer):
+  """Id of the last message peer has acknowledged, 0 if none."""
+  row = db.execute(
+    "SELECT last_forwarded FROM forward_peers WHERE peer = ?", (peer,)
+  ).fetchone()
+  return row[0] if row is not None else 0
+
+
+def _set_watermark(db, peer, last_id):
   db.execute(
-    "INSERT INTO messages (sender, recipient, content, is_private) VALUES (?, ?, ?, 1)",
-    (sender, recipient, content),
+    """
+      INSERT INTO forward_peers (peer, last_forwarded) VALUES (?, ?)
+        ON CONFLICT (peer) DO UPDATE
+          SET last_forwarded = max(last_forwarded, excluded.last_forwarded)
+    """,
+    (peer, last_id),
+  )
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="set_watermark")
+def set_watermark(db, peer, last_id):
+  _write(db, _set_watermark, peer, last_id)
+
+
+def _store_forwarded(db, node, rows):
+  # Messages written here keep no msgid in their own row, so one coming back
+  # around a route loop would be stored again
+  rows = [row for row in rows if row[0].rpartition("@")[2] != node]
+  cur = db.executemany(
+    """
+      INSERT OR IGNORE INTO messages
+        (msgid, sender, recipient, base_recipient, content, is_private, home_bbs,
+         timestamp)
+      VALUES (?, ?, ?, ?, ?, 1, nullif(?, ?), ?)
+    """,
+    [
+      (msgid, sender, recipient, base_callsign(recipient), content, home, node, at)
+      for msgid, sender, recipient, home, content, at in rows
+    ],
+  )
+  stored = cur.rowcount
+  # Replies to the senders go back to the node the message came from
+  db.executemany(
+    """
+      INSERT INTO homes (call, bbs) VALUES (?, ?)
+        ON CONFLICT (call) DO UPDATE SET bbs = excluded.bbs
+    """,
+    [
+      (base_callsign(sender), msgid.rpartition("@")[2])
+      for msgid, sender, _, _, _, _ in rows
+      if msgid.rpartition("@")[2] != node
+    ],
   )
-  db.commit()
+  return stored
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="store_forwarded")
+def store_forwarded(db, node, rows):
+  """
+  Store the private messages (msgid, sender, recipient, home_bbs, content,
+  timestamp) received from another node, skipping those already here.
+  Returns the number stored.
+  """
+  if not rows:
+    return 0
+  return _write(db, _store_forwarded, node, rows)
+
+
+def _timed_rows(query):
+  """
+  Like metrics.timed, for queries whose rows are fetched as the caller
+  iterates. The time of the query and of fetching each row is observed once
+  the rows are done, the time the caller spends between rows is not.
+  """
 
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      start = time.perf_counter()
+      cur = func(*args, **kwargs)
+      return _fetch_timed(cur, query, time.perf_counter() - start)
 
-def list_messages(db, limit=5):
+    return wrapper
+
+  return decorator
+
+
+def _fetch_timed(cur, query, elapsed):
+  try:
+    while True:
+      start = time.perf_counter()
+      row = cur.fetchone()
+      elapsed += time.perf_counter() - start
+      if row is None:
+        return
+      yield row
+  finally:
+    metrics.observe("oglbbs_db_query_duration_seconds", elapsed, query=query)
+
+
+@_timed_rows("list_messages")
+def list_messages(db, limit=5, before_id=None, archived=False):
+  """
+  Iterate over (id, sender, content, timestamp) of public messages, newest
+  first, starting below before_id. Rows are fetched as the caller iterates.
+  With archived, of the archive instead.
+  """
   cur = db.cursor()
   cur.execute(
-    "SELECT sender, content, timestamp FROM messages WHERE is_private = 0 AND deleted = 0 ORDER BY id DESC LIMIT ?",
-    (limit,),
+    f"""
+      SELECT id, sender, content, timestamp FROM {_schema(archived)}.messages
+      WHERE is_private = 0 AND deleted = 0 AND id < ?
+      ORDER BY id DESC LIMIT ?
+  """,
+    (_keyset_start(before_id), limit),
   )
-  return cur.fetchall()
+  return cur
 
 
-def list_private_messages(db, recipient, limit=5):
+@_timed_rows("list_private_messages")
+def list_private_messages(db, recipient, limit=5, before_id=None, archived=False):
+  """Like list_messages, for the private messages of recipient."""
   cur = db.cursor()
   # Match recipient ignoring SSID (e.g., HA5OGL-1 and HA5OGL-2 both match HA5OGL)
-  base_recipient = recipient.split("-")[0] if "-" in recipient else recipient
   cur.execute(
-    """
-      SELECT id, sender, content, timestamp FROM messages
-      WHERE (recipient = ? OR recipient LIKE ? || '-%')
-        AND is_private = 1 AND deleted = 0
+    f"""
+      SELECT id, sender, content, timestamp FROM {_schema(archived)}.messages
+      WHERE base_recipient = ? AND is_private = 1 AND deleted = 0 AND id < ?
       ORDER BY id DESC LIMIT ?
   """,
-    (base_recipient, base_recipient, limit),
+    (base_callsign(recipient), _keyset_start(before_id), limit),
   )
-  return cur.fetchall()
+  return cur
 
 
-def delete_message(db, msg_id, recipient):
+def _schema(archived):
+  return "archive" if archived else "main"
+
+
+def _keyset_start(before_id):
+  # Pages continue below the last id seen, so deep pages are as cheap as the
+  # first one. Without one, start above any id.
+  return sys.maxsize if before_id is None else before_id
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="get_mailbox_counts")
+def get_mailbox_counts(db, recipient):
+  """Return (total, unread) private messages of a callsign, SSID ignored."""
   cur = db.cursor()
-  base_recipient = recipient.split("-")[0] if "-" in recipient else recipient
   cur.execute(
+    "SELECT total, unread FROM mailboxes WHERE base_recipient = ?",
+    (base_callsign(recipient),),
+  )
+  row = cur.fetchone()
+  if row is None:
+    return (0, 0)
+  return row
+
+
+def _mark_read(db, msg_ids):
+  db.executemany(
+    "UPDATE messages SET is_read = 1 WHERE id = ? AND is_read = 0",
+    [(msg_id,) for msg_id in msg_ids],
+  )
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="mark_read")
+def mark_read(db, msg_ids):
+  """Flag private messages as read."""
+  _write(db, _mark_read, msg_ids)
+
+
+def _delete_message(db, msg_id, recipient):
+  cur = db.execute(
     """
       UPDATE messages SET deleted = 1
-      WHERE id = ? AND (recipient = ? OR recipient LIKE ? || '-%') AND is_private = 1
+      WHERE id = ? AND base_recipient = ? AND is_private = 1 AND deleted = 0
     """,
-      (msg_id, base_recipient, base_recipient),
+    (msg_id, base_callsign(recipient)),
   )
-  if cur.rowcount:
-    db.commit()
-    return True
-  else:
+  return cur.rowcount > 0
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="delete_message")
+def delete_message(db, msg_id, recipient):
+  return _write(db, _delete_message, msg_id, recipient)
+
+
+def fts_query(text):
+  """
+  Turn the words of a SEARCH into an FTS5 query matching messages with all of
+  them, each as a prefix, in the sender or text. Returns None if there are no
+  words.
+  """
+  words = re.findall(r"\w+", text)[:max_search_terms]
+  if not words:
+    return None
+  return "{sender content} : (" + " ".join(f'"{word}"*' for word in words) + ")"
+
+
+@_timed_rows("search_messages")
+def search_messages(db, query, recipient, scope="all", limit=10, archived=False):
+  """
+  Iterate over (id, sender, content, timestamp, is_private) of messages
+  matching an fts_query, newest first. scope is "public", "private" (the
+  messages of recipient, SSID ignored) or "all" of both. With archived, of the
+  archive instead.
+  """
+  recipient = base_callsign(recipient)
+  schema = _schema(archived)
+  match scope:
+    case "public":
+      where = "m.is_private = 0"
+    case "private":
+      where = "m.is_private = 1 AND m.base_recipient = :recipient"
+      # Narrow down to the mailbox in the index, instead of checking every match
+      query += ' AND base_recipient : "' + recipient.replace('"', '""') + '"'
+    case _:
+      where = (
+        "(m.is_private = 0 OR (m.is_private = 1 AND m.base_recipient = :recipient))"
+      )
+  cur = db.cursor()
+  cur.execute(
+    f"""
+      SELECT m.id, m.sender, m.content, m.timestamp, m.is_private
+      FROM {schema}.messages_fts JOIN {schema}.messages m
+        ON m.id = messages_fts.rowid
+      WHERE messages_fts MATCH :query AND m.deleted = 0 AND {where}
+      ORDER BY messages_fts.rowid DESC LIMIT :limit
+  """,
+    {"query": query, "recipient": recipient, "limit": limit},
+  )
+  return cur
+
+
+def _fts_backfill_step(db, batch_size):
+  """Index the next batch of old messages. Returns False when done."""
+  row = db.execute("SELECT last_id FROM fts_backfill").fetchone()
+  if row is None:
+    return False
+  last_id = row[0]
+  low = last_id - batch_size
+  db.execute(
+    """
+      INSERT INTO messages_fts (rowid, sender, content, base_recipient)
+        SELECT id, sender, content, base_recipient FROM messages
+        WHERE id > ? AND id <= ? AND deleted = 0
+    """,
+    (low, last_id),
+  )
+  if low <= 0:
+    db.execute("DELETE FROM fts_backfill")
     return False
+  db.execute("UPDATE fts_backfill SET last_id = ?", (low,))
+  return True
 
 
-def shutdown(db):
-  db.close()
-  print("Database connection closed.")
+def start_fts_backfill(db_file="bbs.db"):
+  """
+  Index the messages stored before full-text search existed, in a background
+  thread. New messages are indexed by triggers, so this only runs once.
+  """
+  global _backfill_thread
+  db = get_db(db_file)
+  row = db.execute("SELECT last_id FROM fts_backfill").fetchone()
+  if row is None or _backfill_thread is not None:
+    return
+  logger.info("Building the search index of %s older messages", row[0])
+  _backfill_stop.clear()
+  _backfill_thread = threading.Thread(
+    target=_fts_backfill_loop, args=(db_file,), name="fts-backfill", daemon=True
+  )
+  _backfill_thread.start()
+
+
+def _fts_backfill_loop(db_file):
+  db = get_db(db_file)
+  try:
+    # Small batches with a pause in between, so user writes are not held up
+    while not _backfill_stop.is_set():
+      if not _write(db, _fts_backfill_step, fts_backfill_batch):
+        logger.info("Search index complete.")
+        break
+      _backfill_stop.wait(fts_backfill_pause)
+  except sqlite3.Error as e:
+    logger.error("Error building the search index: %s", e)
+  finally:
+    release_db()
+
+
+def _purge_deleted(db, batch_size):
+  return db.execute(
+    """
+      DELETE FROM messages WHERE id IN (
+        SELECT id FROM messages
+        WHERE is_private IN (0, 1) AND deleted = 1 LIMIT ?
+      )
+    """,
+    (batch_size,),
+  ).rowcount
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="purge_deleted")
+def purge_deleted(db, batch_size=None):
+  """Delete a batch of soft-deleted messages for good, return how many."""
+  return _write(db, _purge_deleted, batch_size or purge_batch)
+
+
+def _incremental_vacuum(db, pages):
+  free = db.execute("PRAGMA freelist_count").fetchone()[0]
+  # sqlite3 steps the pragma once, which frees a single page
+  for _ in range(min(free, pages)):
+    db.execute("PRAGMA incremental_vacuum(1)")
+  return free - db.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="incremental_vacuum")
+def incremental_vacuum(db, pages=None):
+  """Give up to pages free pages back to the file system, return how many."""
+  return _write(db, _incremental_vacuum, pages or vacuum_pages)
+
+
+def _expired_ids(db, is_private, max_age_days, max_count, limit, forwarded_id=0):
+  """
+  Ids of the oldest messages past their retention, at most limit. Messages
+  for other nodes above forwarded_id have not been forwarded yet, and stay.
+  """
+  ids = set()
+  if max_age_days > 0:
+    # Ids grow with time, so only the oldest messages need checking
+    ids.update(
+      row[0]
+      for row in db.execute(
+        """
+          SELECT id FROM (
+            SELECT id, timestamp FROM messages
+            WHERE is_private = ? AND deleted = 0
+              AND (home_bbs IS NULL OR id <= ?)
+            ORDER BY id LIMIT ?
+          ) WHERE timestamp < datetime('now', ?)
+        """,
+        (is_private, forwarded_id, limit, f"-{max_age_days} days"),
+      )
+    )
+  if max_count > 0 and not is_private:
+    row = db.execute(
+      """
+        SELECT id FROM messages WHERE is_private = 0 AND deleted = 0
+        ORDER BY id DESC LIMIT 1 OFFSET ?
+      """,
+      (max_count,),
+    ).fetchone()
+    if row is not None:
+      ids.update(
+        row[0]
+        for row in db.execute(
+          """
+            SELECT id FROM messages WHERE is_private = 0 AND deleted = 0 AND id <= ?
+            ORDER BY id LIMIT ?
+          """,
+          (row[0], limit),
+        )
+      )
+  if max_count > 0 and is_private:
+    # Mailboxes over the limit, from the counters kept by the triggers
+    mailboxes = db.execute(
+      "SELECT base_recipient, total - ? FROM mailboxes WHERE total > ? LIMIT ?",
+      (max_count, max_count, limit),
+    ).fetchall()
+    for recipient, excess in mailboxes:
+      ids.update(
+        row[0]
+        for row in db.execute(
+          """
+            SELECT id FROM messages
+            WHERE base_recipient = ? AND is_private = 1 AND deleted = 0
+              AND (home_bbs IS NULL OR id <= ?)
+            ORDER BY id LIMIT ?
+          """,
+          (recipient, forwarded_id, min(excess, limit)),
+        )
+      )
+  return sorted(ids)[:limit]
+
+
+def _archive_expired(db, batch_size, forwarded_id):
+  ids = _expired_ids(db, 0, public_max_age_days, public_max_count, batch_size)
+  ids += _expired_ids(
+    db,
+    1,
+    private_max_age_days,
+    private_max_count,
+    batch_size - len(ids),
+    forwarded_id,
+  )
+  params = [(msg_id,) for msg_id in ids]
+  # The archive commits separately from the main database, so a copy may be
+  # left behind by a crash. OR IGNORE skips it when the move is done again.
+  db.executemany(
+    """
+      INSERT OR IGNORE INTO archive.messages
+        (id, sender, recipient, base_recipient, content, is_private, is_read,
+         timestamp, msgid, home_bbs)
+      SELECT id, sender, recipient, base_recipient, content, is_private, is_read,
+        timestamp, msgid, home_bbs
+      FROM main.messages WHERE id = ?
+    """,
+    params,
+  )
+  # The delete triggers update the mailbox counters and the search index
+  db.executemany("DELETE FROM main.messages WHERE id = ?", params)
+  return len(ids)
+
+
+def retention_enabled():
+  limits = (public_max_age_days, public_max_count)
+  limits += (private_max_age_days, private_max_count)
+  return archive_file is not None and any(limit > 0 for limit in limits)
+
+
+@metrics.timed("oglbbs_db_query_duration_seconds", query="archive_expired")
+def archive_expired(db, batch_size=None, forwarded_id=0):
+  """
+  Move a batch of messages past their retention to the archive, except
+  private messages for other nodes above forwarded_id, the lowest watermark of
+  the peers, which are still to be forwarded.
+  """
+  if not retention_enabled():
+    return 0
+  return _write(db, _archive_expired, batch_size or archive_batch, forwarded_id)
+
+
+def shutdown():
+  """Stop the writer and close every pooled connection."""
+  global _writer_thread, _backfill_thread
+  if _backfill_thread is not None:
+    _backfill_stop.set()
+    _backfill_thread.join(timeout=5)
+    _backfill_thread = None
+  if _writer_thread is not None:
+    _write_queue.put(None)
+    _writer_thread.join(timeout=5)
+    _writer_thread = None
+  with _pool_lock:
+    connections = list(_all_connections)
+    _all_connections.clear()
+    _idle.clear()
+  getattr(_local, "connections", {}).clear()
+  for db in connections:
+    try:
+      db.close()
+    except sqlite3.Error:
+      pass
+  logger.info("Database connections closed.")
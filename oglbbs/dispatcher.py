@@ -0,0 +1,92 @@
+import logging
+import queue
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Commands run on a bounded pool of worker threads, so that a slow query never
+# holds up the thread reading from the AGWPE socket or the SSH reactor. Work is
+# queued per session. A session is served by one worker at a time, which keeps
+# its commands in order, and goes to the back of the line after each item, so
+# a busy session cannot starve the others.
+default_workers = 4
+# Items a session may have waiting before further input is refused
+max_queued = 16
+
+# Sessions with work waiting, each in it at most once
+_ready = queue.SimpleQueue()
+_lock = threading.Lock()
+_workers = []
+
+metrics.describe(
+  "oglbbs_command_queue_seconds",
+  "histogram",
+  "Time a command waited in its session queue for a worker",
+)
+metrics.describe(
+  "oglbbs_command_queue_full_total",
+  "counter",
+  "Input refused because the session queue was full",
+)
+
+
+def start(workers=default_workers):
+  """Start the worker threads. Until then, work runs on the caller's thread."""
+  if _workers or workers < 1:
+    return
+  for i in range(workers):
+    thread = threading.Thread(target=_worker_loop, name=f"worker-{i}", daemon=True)
+    thread.start()
+    _workers.append(thread)
+  logger.info("Started %s command workers.", workers)
+
+
+def submit(session, func, *args):
+  """
+  Queue func(*args) behind the earlier work of the session. Returns False if
+  the queue of the session is full.
+  """
+  if not _workers:
+    func(*args)
+    return True
+  with _lock:
+    if len(session.queued) >= max_queued:
+      metrics.inc("oglbbs_command_queue_full_total")
+      return False
+    session.queued.append((func, args, time.monotonic()))
+    if session.scheduled:
+      return True
+    session.scheduled = True
+  _ready.put(session)
+  return True
+
+
+def _worker_loop():
+  while True:
+    session = _ready.get()
+    if session is None:
+      return
+    with _lock:
+      func, args, queued_at = session.queued.popleft()
+    metrics.observe("oglbbs_command_queue_seconds", time.monotonic() - queued_at)
+    try:
+      func(*args)
+    except Exception:
+      logger.exception("Error handling %s", session)
+    with _lock:
+      if not session.queued:
+        session.scheduled = False
+        continue
+    _ready.put(session)
+
+
+def shutdown():
+  """Stop the workers. Work still queued is dropped."""
+  for _ in _workers:
+    _ready.put(None)
+  for thread in _workers:
+    thread.join(timeout=5)
+  _workers.clear()
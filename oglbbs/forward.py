@@ -0,0 +1,269 @@
+import collections
+import json
+import logging
+import socket
+import sqlite3
+import threading
+
+from . import bbs_db
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Store-and-forward of private messages between oglbbs nodes over TCP. A
+# message sent to CALL@NODE, or to a callsign last heard from another node, is
+# stored with that node as its home_bbs and pushed to the neighbor it is
+# routed through. Pushing runs on a thread of its own, after every SEND to
+# another node and every interval seconds. Each neighbor has a watermark, the
+# last message id it acknowledged, so a transfer broken off resumes from
+# there. Messages carry a global id, "<id>@<origin node>", and the receiving
+# node skips those it already has.
+#
+# The protocol is line based. The sender opens with "OGLFWD1 <call>
+# [<secret>]" and the receiver answers "OGLFWD1 <call>". Then the sender
+# streams batches, each a JSON line per message followed by "SYNC <last id>",
+# which the receiver acknowledges with "ACK <last id> <stored>" once the batch
+# is committed. Up to window batches are sent before waiting for an
+# acknowledgement. "END" closes the transfer.
+protocol = "OGLFWD1"
+node_call = None
+# Neighbors by callsign
+peers = {}
+# Neighbor for nodes not routed through any other
+default_peer = None
+interval = 300
+batch_size = 50
+window = 4
+# Seconds a transfer may stall
+timeout = 60
+# Longest line of the protocol
+max_line = 65536
+
+_db_file = None
+_server = None
+_threads = []
+_kick = threading.Event()
+_stop = threading.Event()
+
+metrics.describe(
+  "oglbbs_forwarded_messages_total",
+  "counter",
+  "Private messages forwarded to and received from other nodes",
+)
+
+
+class Peer:
+  """A neighbor node and the nodes routed through it."""
+
+  __slots__ = ("call", "host", "port", "routes", "secret")
+
+  def __init__(self, call, host, port, routes=(), secret=None):
+    self.call = call.upper()
+    self.host = host
+    self.port = port
+    self.routes = {route.upper() for route in routes}
+    self.secret = secret
+
+  def __repr__(self):
+    return f"Peer({self.call} at {self.host}:{self.port})"
+
+
+def node_of(address):
+  """The node of a "CALL@NODE" address or a hierarchical node address."""
+  return address.upper().split(".")[0]
+
+
+def is_local(node):
+  return node_call is None or node_of(node) == node_call
+
+
+def route(node):
+  """The neighbor a message to node goes through, None if there is none."""
+  node = node_of(node)
+  for peer in peers.values():
+    if node == peer.call or node in peer.routes:
+      return peer
+  return peers.get(default_peer)
+
+
+def kick():
+  """Push the waiting messages now instead of at the next interval."""
+  _kick.set()
+
+
+def start(db_file, listen=None):
+  """
+  Start pushing messages to the neighbors, and receiving them on listen, a
+  (host, port) tuple, if given.
+  """
+  global _db_file, _server
+  _db_file = db_file
+  _stop.clear()
+  if listen is not None:
+    _server = socket.create_server(listen)
+    _start_thread(_accept_loop, "forward-server")
+    logger.info("Receiving forwarded messages on %s:%s", *listen)
+  _start_thread(_push_loop, "forward-push")
+
+
+def _start_thread(target, name, *args):
+  thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+  thread.start()
+  # A receiver thread is started for every transfer, those finished are dropped
+  _threads[:] = [t for t in _threads if t.is_alive()]
+  _threads.append(thread)
+
+
+def shutdown():
+  _stop.set()
+  _kick.set()
+  if _server is not None:
+    _server.close()
+  for thread in _threads:
+    thread.join(timeout=2)
+  _threads.clear()
+
+
+# === Sending ===
+def _push_loop():
+  while not _stop.is_set():
+    for peer in list(peers.values()):
+      try:
+        forward_to(peer)
+      except (OSError, ValueError, sqlite3.Error) as e:
+        logger.warning("Forwarding to %s failed: %s", peer, e)
+      finally:
+        bbs_db.release_db()
+    _kick.wait(interval)
+    _kick.clear()
+
+
+def forward_to(peer):
+  """Push the messages waiting for peer, returns the number acknowledged."""
+  db = bbs_db.get_db(_db_file)
+  homes = [node for node in bbs_db.list_home_nodes(db) if route(node) is peer]
+  if not homes:
+    return 0
+  last_id = bbs_db.get_watermark(db, peer.call)
+  rows = bbs_db.forward_batch(db, node_call, homes, last_id, batch_size)
+  if not rows:
+    return 0
+  logger.info("Forwarding to %s from message %s", peer, last_id)
+  acknowledged = 0
+  with socket.create_connection((peer.host, peer.port), timeout) as conn:
+    reader = conn.makefile("rb")
+    hello = f"{protocol} {node_call}"
+    if peer.secret:
+      hello += f" {peer.secret}"
+    conn.sendall(hello.encode() + b"\n")
+    reply = reader.readline(max_line).split()
+    if len(reply) != 2 or reply[0] != protocol.encode():
+      raise ValueError(f"unexpected greeting {reply!r}")
+    # Batches sent and not yet acknowledged, (last id, messages)
+    pending = collections.deque()
+    while rows or pending:
+      if rows and len(pending) < window:
+        payload = [_encode(row) for row in rows]
+        payload.append(f"SYNC {rows[-1][0]}\n".encode())
+        conn.sendall(b"".join(payload))
+        pending.append((rows[-1][0], len(rows)))
+        rows = bbs_db.forward_batch(db, node_call, homes, rows[-1][0], batch_size)
+        continue
+      ack = reader.readline(max_line).split()
+      sync_id, count = pending.popleft()
+      if len(ack) != 3 or ack[0] != b"ACK" or int(ack[1]) != sync_id:
+        raise ValueError(f"unexpected acknowledgement {ack!r}")
+      bbs_db.set_watermark(db, peer.call, sync_id)
+      acknowledged += count
+      metrics.inc(
+        "oglbbs_forwarded_messages_total", count, peer=peer.call, direction="out"
+      )
+    conn.sendall(b"END\n")
+  logger.info("Forwarded %s messages to %s", acknowledged, peer)
+  return acknowledged
+
+
+def _encode(row):
+  _, msgid, sender, recipient, home_bbs, content, timestamp = row
+  message = {
+    "msgid": msgid,
+    "from": sender,
+    "to": recipient,
+    "bbs": home_bbs,
+    "text": content,
+    "at": timestamp,
+  }
+  return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+def _decode(line):
+  message = json.loads(line)
+  # Without a node the message is for a user of this one
+  home_bbs = message.get("bbs")
+  return (
+    message["msgid"],
+    message["from"],
+    message["to"],
+    node_of(home_bbs) if home_bbs else None,
+    message["text"],
+    message["at"],
+  )
+
+
+# === Receiving ===
+def _accept_loop():
+  while not _stop.is_set():
+    try:
+      conn, addr = _server.accept()
+    except OSError:
+      return
+    _start_thread(_receive, f"forward-{addr[0]}", conn, addr)
+
+
+def _receive(conn, addr):
+  try:
+    with conn:
+      conn.settimeout(timeout)
+      _receive_messages(conn, addr)
+  except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+    logger.warning("Receiving forwarded messages from %s failed: %s", addr, e)
+  finally:
+    bbs_db.release_db()
+
+
+def _receive_messages(conn, addr):
+  reader = conn.makefile("rb")
+  hello = reader.readline(max_line).decode(errors="replace").split()
+  peer = peers.get(hello[1].upper()) if len(hello) >= 2 else None
+  if (
+    len(hello) < 2
+    or hello[0] != protocol
+    or peer is None
+    or (peer.secret and hello[2:] != [peer.secret])
+  ):
+    logger.warning("Refusing forwarding from %s: %s", addr, hello[:2])
+    return
+  conn.sendall(f"{protocol} {node_call}\n".encode())
+  db = bbs_db.get_db(_db_file)
+  rows = []
+  received = 0
+  while True:
+    line = reader.readline(max_line)
+    if line.startswith(b"{"):
+      rows.append(_decode(line))
+      if len(rows) > max(batch_size, 1000):
+        raise ValueError("batch too large")
+    elif line.startswith(b"SYNC "):
+      stored = bbs_db.store_forwarded(db, node_call, rows)
+      metrics.inc(
+        "oglbbs_forwarded_messages_total", len(rows), peer=peer.call, direction="in"
+      )
+      received += len(rows)
+      rows = []
+      sync_id = line.split()[1].decode()
+      conn.sendall(f"ACK {sync_id} {stored}\n".encode())
+    elif line.strip() == b"END" or not line:
+      break
+    else:
+      raise ValueError(f"unexpected line {line[:40]!r}")
+  logger.info("Received %s forwarded messages from %s", received, peer)
@@ -0,0 +1,54 @@
+import re
+
+# Lines end in CR (AX.25), LF or CR LF (SSH)
+line_break = re.compile(rb"\r\n|\r|\n")
+
+max_line_length = 1024
+
+
+class LineAssembler:
+  """Assemble complete lines from the received chunks of a stream.
+
+  A line may be split across several frames, and a frame may carry several
+  lines. feed() returns the lines completed by a chunk, decoded and without
+  the line ending. Lines longer than max_length are dropped and returned as
+  None, so the caller can report them.
+  """
+
+  __slots__ = ("max_length", "_buffer", "_skip_lf", "_overflow")
+
+  def __init__(self, max_length=max_line_length):
+    self.max_length = max_length
+    self._buffer = bytearray()
+    # A CR ended the last chunk, a leading LF of the next one belongs to it
+    self._skip_lf = False
+    self._overflow = False
+
+  def feed(self, data):
+    lines = []
+    if self._skip_lf and data.startswith(b"\n"):
+      data = data[1:]
+    self._skip_lf = data.endswith(b"\r")
+    pos = 0
+    for match in line_break.finditer(data):
+      self._append(data[pos : match.start()])
+      lines.append(self._take())
+      pos = match.end()
+    self._append(data[pos:])
+    return lines
+
+  def _append(self, chunk):
+    if self._overflow:
+      return
+    self._buffer += chunk
+    if len(self._buffer) > self.max_length:
+      self._buffer.clear()
+      self._overflow = True
+
+  def _take(self):
+    if self._overflow:
+      self._overflow = False
+      return None
+    line = self._buffer.decode("utf-8", errors="ignore").strip()
+    self._buffer.clear()
+    return line
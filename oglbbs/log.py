@@ -0,0 +1,42 @@
+import logging
+import logging.handlers
+import queue
+import sys
+
+log_format = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Third party loggers which are too chatty on INFO
+quiet_loggers = {"paramiko": "WARNING", "pe": "WARNING"}
+
+_listener = None
+
+
+def setup(level="INFO", module_levels=None, stream=None):
+  """
+  Route all log records through a queue to a background thread, so logging
+  never blocks the caller on I/O. module_levels maps logger names, like
+  oglbbs.bbs, to their own level.
+  """
+  global _listener
+  # SimpleQueue.put is reentrant, so logging from signal handlers is safe
+  log_queue = queue.SimpleQueue()
+  handler = logging.StreamHandler(stream or sys.stdout)
+  handler.setFormatter(logging.Formatter(log_format))
+  _listener = logging.handlers.QueueListener(log_queue, handler)
+
+  root = logging.getLogger()
+  root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+  root.setLevel(level.upper())
+  levels = dict(quiet_loggers)
+  levels.update(module_levels or {})
+  for name, module_level in levels.items():
+    logging.getLogger(name).setLevel(module_level.upper())
+  _listener.start()
+
+
+def shutdown():
+  """Write out the queued records and stop the background thread."""
+  global _listener
+  if _listener is not None:
+    _listener.stop()
+    _listener = None
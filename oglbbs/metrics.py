@@ -0,0 +1,237 @@
+import functools
+import ipaddress
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from sub-millisecond DB lookups to slow links
+default_buckets = (
+  0.0005,
+  0.001,
+  0.0025,
+  0.005,
+  0.01,
+  0.025,
+  0.05,
+  0.1,
+  0.25,
+  0.5,
+  1.0,
+  2.5,
+  5.0,
+  10.0,
+)
+
+_lock = threading.Lock()
+# name -> (type, help)
+_descriptions = {}
+# name -> {labels: value}
+_counters = {}
+# name -> {labels: [bucket counts..., sum, count]}
+_histograms = {}
+# name -> callback returning {labels: value}
+_gauges = {}
+_server = None
+
+
+def describe(name, metric_type, help_text):
+  _descriptions[name] = (metric_type, help_text)
+
+
+def _labels(labels):
+  return tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+  """Increase a counter."""
+  key = _labels(labels)
+  with _lock:
+    values = _counters.setdefault(name, {})
+    values[key] = values.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+  """Record a value, usually a duration in seconds, in a histogram."""
+  key = _labels(labels)
+  with _lock:
+    values = _histograms.setdefault(name, {})
+    counts = values.get(key)
+    if counts is None:
+      counts = values[key] = [0] * (len(default_buckets) + 2)
+    for i, bound in enumerate(default_buckets):
+      if value <= bound:
+        counts[i] += 1
+        break
+    counts[-2] += value
+    counts[-1] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+  """Observe the duration of the block in a histogram."""
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+  """Decorator observing the duration of each call in a histogram."""
+
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with timer(name, **labels):
+        return func(*args, **kwargs)
+
+    return wrapper
+
+  return decorator
+
+
+def gauge(name, callback):
+  """Register a gauge. callback returns {labels dict as tuple: value}."""
+  _gauges[name] = callback
+
+
+def _format_labels(key, extra=()):
+  pairs = list(key) + list(extra)
+  if not pairs:
+    return ""
+  return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render():
+  """Return all metrics in the Prometheus text exposition format."""
+  lines = []
+
+  def header(name, metric_type):
+    _, help_text = _descriptions.get(name, (metric_type, name))
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+
+  with _lock:
+    counters = {name: dict(values) for name, values in _counters.items()}
+    histograms = {
+      name: {key: list(counts) for key, counts in values.items()}
+      for name, values in _histograms.items()
+    }
+  for name, values in sorted(counters.items()):
+    header(name, "counter")
+    for key, value in sorted(values.items()):
+      lines.append(f"{name}{_format_labels(key)} {value}")
+  for name, callback in sorted(_gauges.items()):
+    header(name, "gauge")
+    for key, value in sorted(callback().items()):
+      lines.append(f"{name}{_format_labels(key)} {value}")
+  for name, values in sorted(histograms.items()):
+    header(name, "histogram")
+    for key, counts in sorted(values.items()):
+      cumulative = 0
+      for bound, count in zip(default_buckets, counts):
+        cumulative += count
+        labels = _format_labels(key, (("le", bound),))
+        lines.append(f"{name}_bucket{labels} {cumulative}")
+      labels = _format_labels(key, (("le", "+Inf"),))
+      lines.append(f"{name}_bucket{labels} {counts[-1]}")
+      lines.append(f"{name}_sum{_format_labels(key)} {counts[-2]:.6f}")
+      lines.append(f"{name}_count{_format_labels(key)} {counts[-1]}")
+  return "\n".join(lines) + "\n"
+
+
+def _quantile(counts, q):
+  """Estimate a quantile as the upper bound of the bucket holding it."""
+  total = counts[-1]
+  if total == 0:
+    return 0.0
+  rank = q * total
+  cumulative = 0
+  for bound, count in zip(default_buckets, counts):
+    cumulative += count
+    if cumulative >= rank:
+      return bound
+  return float("inf")
+
+
+def summary(name):
+  """Return [(labels, count, mean, p50, p99)] of a histogram."""
+  with _lock:
+    values = {key: list(counts) for key, counts in _histograms.get(name, {}).items()}
+  rows = []
+  for key, counts in sorted(values.items()):
+    count = counts[-1]
+    mean = counts[-2] / count if count else 0.0
+    rows.append(
+      (dict(key), count, mean, _quantile(counts, 0.5), _quantile(counts, 0.99))
+    )
+  return rows
+
+
+def counter_values(name):
+  """Return {labels: value} of a counter."""
+  with _lock:
+    return {key: value for key, value in _counters.get(name, {}).items()}
+
+
+def _handler_class():
+  # http.server is only imported if the endpoint is enabled
+  from http.server import BaseHTTPRequestHandler
+
+  class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path not in ("/", "/metrics"):
+        self.send_error(404)
+        return
+      body = render().encode()
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      logger.debug("%s - %s", self.address_string(), format % args)
+
+  return MetricsHandler
+
+
+def is_loopback(host):
+  try:
+    addresses = socket.getaddrinfo(host, None)
+  except OSError:
+    return False
+  return all(ipaddress.ip_address(addr[4][0]).is_loopback for addr in addresses)
+
+
+def start_server(host="127.0.0.1", port=9108):
+  """Serve the metrics over HTTP in a background thread, on loopback only."""
+  global _server
+  if not is_loopback(host):
+    logger.error("Metrics server must listen on a loopback address, not %s", host)
+    return False
+  from http.server import ThreadingHTTPServer
+
+  try:
+    _server = ThreadingHTTPServer((host, port), _handler_class())
+  except OSError as e:
+    logger.error("Failed to start the metrics server: %s", e)
+    return False
+  _server.daemon_threads = True
+  threading.Thread(
+    target=_server.serve_forever, name="metrics-http", daemon=True
+  ).start()
+  logger.info("Metrics served on http://%s:%s/metrics", host, port)
+  return True
+
+
+def shutdown():
+  global _server
+  if _server is not None:
+    _server.shutdown()
+    _server.server_close()
+    _server = None
@@ -1,17 +1,30 @@
 import configparser
+import logging
 import os
 import argparse
+import select
 import signal
+import socket
 import sys
 import threading
-import time
 
-from . import ssh_server
+from . import airtime
 from . import bbs_db
 from . import bbs
+from . import dispatcher
+from . import forward
+from . import log
+from . import metrics
+from . import presence
+from . import ratelimit
+from . import timers
 
 
+logger = logging.getLogger(__name__)
+
 shutdown_event = threading.Event()
+# Self-pipe waking up the main loop on signals and shutdown requests
+wakeup_r, wakeup_w = socket.socketpair()
 
 # Global flags to control the start of TCP and AX.25 servers
 # This is useful for testing purposes.
@@ -20,14 +33,36 @@ start_ax25 = True
 
 
 def handle_signal(signum, frame):
-  print(f"\nReceived signal {signum}, shutting down.")
+  logger.info("Received signal %s, shutting down.", signum)
+  request_shutdown()
+
+
+def request_shutdown():
+  """Stop the main loop. Safe to call from any thread."""
   shutdown_event.set()
+  wakeup()
+
+
+def wakeup():
+  try:
+    wakeup_w.send(b"\0")
+  except (BlockingIOError, OSError):
+    pass
 
 
 def shutdown():
-  print("Shutting down.")
+  logger.info("Shutting down.")
   bbs.shutdown()
-  ssh_server.shutdown()
+  if start_tcp:
+    from . import ssh_server
+
+    ssh_server.shutdown()
+  forward.shutdown()
+  presence.shutdown()
+  dispatcher.shutdown()
+  metrics.shutdown()
+  bbs_db.shutdown()
+  log.shutdown()
   for thread in threading.enumerate():
     if thread is not threading.current_thread():
       try:
@@ -37,7 +72,45 @@ def shutdown():
   sys.exit(0)
 
 
+def start_forwarding(config, bbscall, db_file):
+  forward.node_call = bbs_db.base_callsign(bbscall.upper())
+  forward.interval = config.getint("forward", "interval", fallback=forward.interval)
+  forward.batch_size = config.getint(
+    "forward", "batch_size", fallback=forward.batch_size
+  )
+  forward.window = config.getint("forward", "window", fallback=forward.window)
+  # Each neighbor has a [peer CALL] section
+  for section in config.sections():
+    if not section.lower().startswith("peer "):
+      continue
+    host, _, port = config.get(section, "address").rpartition(":")
+    routes = config.get(section, "routes", fallback="").replace(",", " ").split()
+    peer = forward.Peer(
+      section[len("peer ") :].strip(),
+      host,
+      int(port),
+      routes,
+      config.get(section, "secret", fallback=None),
+    )
+    forward.peers[peer.call] = peer
+    logger.info("Forwarding to %s for %s", peer, " ".join(peer.routes) or "itself")
+  forward.default_peer = config.get("forward", "default", fallback="").upper() or None
+  listen = None
+  if config.has_option("forward", "listen_port"):
+    listen = (
+      config.get("forward", "listen_address", fallback="127.0.0.1"),
+      config.getint("forward", "listen_port"),
+    )
+  forward.start(db_file, listen)
+
+
 def main():
+  wakeup_r.setblocking(False)
+  wakeup_w.setblocking(False)
+  # Timers set by other threads may be due before the main loop wakes up
+  timers.wake = wakeup
+  # Signals arriving while blocked in select() make the self-pipe readable
+  signal.set_wakeup_fd(wakeup_w.fileno())
   signal.signal(signal.SIGHUP, handle_signal)
   signal.signal(signal.SIGTERM, handle_signal)
   signal.signal(signal.SIGINT, handle_signal)
@@ -53,58 +126,186 @@ def main():
   args = parser.parse_args()
 
   # === Configuration ===
-  print(f"Using config file: {args.config}")
   config = configparser.ConfigParser()
   conf_path = args.config
   config.read(conf_path)
 
+  # === Logging ===
+  # [log] level is the default, any other option sets the level of a module,
+  # e.g. oglbbs.bbs = DEBUG
+  log_levels = dict(config.items("log")) if config.has_section("log") else {}
+  log_level = log_levels.pop("level", "INFO")
+  log.setup(log_level, log_levels)
+
+  logger.info("Using config file: %s", args.config)
+
   db_file = config.get("db", "file_name", fallback="bbs.db")
 
-  print(f"Using database file: {db_file}")
+  logger.info("Using database file: %s", db_file)
+
+  # Messages past their retention are moved to the archive database
+  bbs_db.archive_file = config.get("retention", "archive_file", fallback=None) or None
+  retention_options = (
+    "public_max_age_days",
+    "public_max_count",
+    "private_max_age_days",
+    "private_max_count",
+  )
+  for option in retention_options:
+    setattr(
+      bbs_db,
+      option,
+      config.getint("retention", option, fallback=getattr(bbs_db, option)),
+    )
+  if bbs_db.archive_file is not None:
+    logger.info("Using archive file: %s", bbs_db.archive_file)
+  elif any(getattr(bbs_db, option) > 0 for option in retention_options):
+    logger.warning("Retention limits need an archive_file, keeping all messages.")
+  bbs_db.init_db(db_file)
+  bbs_db.start_writer(db_file)
+  bbs_db.start_fts_backfill(db_file)
 
   agw_host = config.get("agw", "host", fallback="localhost")
   agw_port = config.getint("agw", "port", fallback=8000)
   bbscall = config.get("station", "call", fallback="N0CALL")
 
   bbsbanner = config.get("station", "banner", fallback="OGL BBS")
+  sysop_calls = config.get("station", "sysop", fallback="").replace(",", " ").split()
+
+  # AX.25 paclen, "paclen" for all ports, "paclen_portN" for radio port N
+  port_paclen = {}
+  if config.has_section("agw"):
+    for option in config.options("agw"):
+      if option.startswith("paclen_port"):
+        port = int(option[len("paclen_port") :])
+        port_paclen[port] = config.getint("agw", option)
+  bbs.set_paclen(config.getint("agw", "paclen", fallback=128), port_paclen)
+
+  # Output to AX.25 stations is paced to the channel, fairly between them
+  bbs.use_airtime = config.getboolean("agw", "fair_output", fallback=True)
+  airtime.default_baud = config.getint("agw", "baud", fallback=airtime.default_baud)
+  if config.has_section("agw"):
+    for option in config.options("agw"):
+      if option.startswith("baud_port"):
+        port = int(option[len("baud_port") :])
+        airtime.baud_rate[port] = config.getint("agw", option)
+  airtime.max_outstanding = config.getint(
+    "agw", "max_outstanding", fallback=airtime.max_outstanding
+  )
+
+  # Commands run on worker threads instead of the threads receiving them
+  workers = config.getint("commands", "workers", fallback=dispatcher.default_workers)
+  dispatcher.max_queued = config.getint(
+    "commands", "queue_size", fallback=dispatcher.max_queued
+  )
+  dispatcher.start(workers)
 
-  print(f"Using AGWPE host: {agw_host}, port: {agw_port}")
-  print(f"Using station call: {bbscall}")
+  # Token buckets per callsign and address, rate per second and burst
+  ratelimit.enabled = config.getboolean("limits", "enabled", fallback=True)
+  for kind, (rate, burst) in ratelimit.limits.items():
+    ratelimit.limits[kind] = (
+      config.getfloat("limits", f"{kind}_rate", fallback=rate),
+      config.getfloat("limits", f"{kind}_burst", fallback=burst),
+    )
+
+  # Output is written by a thread of each session, from a bounded queue
+  bbs.use_writers = True
+  bbs.max_queued_output = config.getint(
+    "output", "queue_size", fallback=bbs.max_queued_output
+  )
+  overflow = config.get("output", "overflow", fallback=bbs.overflow_policy)
+  if overflow in ("drop_oldest", "disconnect"):
+    bbs.overflow_policy = overflow
+  else:
+    logger.error(
+      "Unknown output overflow policy %s, using %s", overflow, bbs.overflow_policy
+    )
+
+  logger.info("Using AGWPE host: %s, port: %s", agw_host, agw_port)
+  logger.info("Using station call: %s", bbscall)
 
   if start_tcp:
+    # Only import paramiko if SSH is used
+    from . import ssh_server
+
     ssh_addr = config.get("ssh", "listen_address", fallback="localhost")
     ssh_port = config.getint("ssh", "listen_port", fallback=8002)
-    ssh_key = config.get("ssh", "key", fallback="/etc/ssh/ssh_host_rsa_key")
-    print(f"Using SSH listener: {ssh_addr}:{ssh_port}")
+    ssh_keys = config.get("ssh", "key", fallback="/etc/ssh/ssh_host_rsa_key")
+    ssh_keys = ssh_keys.replace(",", " ").split()
+    ssh_max_clients = config.getint("ssh", "max_clients", fallback=100)
+    logger.info("Using SSH listener: %s:%s", ssh_addr, ssh_port)
 
-    ssh_server.start_ssh_server(ssh_addr, ssh_port, ssh_key, bbscall, db_file)
+    stat = ssh_server.start_ssh_server(
+      ssh_addr, ssh_port, ssh_keys, bbscall, db_file, ssh_max_clients
+    )
+    if not stat:
+      logger.error("Failed to start the SSH server.")
+      shutdown()
   else:
-    print("Not starting the SSH server.")
+    logger.info("Not starting the SSH server.")
+
+  # Rendered banners are kept next to the database by default
+  banner_cache_dir = config.get(
+    "station", "banner_cache_dir", fallback=os.path.dirname(os.path.abspath(db_file))
+  )
+  bbs.init(bbsbanner, db_file, sysop_calls, banner_cache_dir or None)
+  bbs.chat_request_timeout = config.getint(
+    "station", "chat_request_timeout", fallback=bbs.chat_request_timeout
+  )
+  bbs.idle_timeout["ax25"] = config.getint(
+    "agw", "idle_timeout", fallback=bbs.idle_timeout["ax25"]
+  )
+  bbs.idle_timeout["tcp"] = config.getint(
+    "ssh", "idle_timeout", fallback=bbs.idle_timeout["tcp"]
+  )
+  bbs.housekeeping_interval = config.getint(
+    "db", "purge_interval", fallback=bbs.housekeeping_interval
+  )
 
-  bbs.init(bbsbanner)
+  if config.getboolean("metrics", "enabled", fallback=False):
+    metrics_addr = config.get("metrics", "listen_address", fallback="127.0.0.1")
+    metrics_port = config.getint("metrics", "listen_port", fallback=9108)
+    metrics.start_server(metrics_addr, metrics_port)
 
   if start_ax25:
     stat = bbs.run_bbs(agw_host, agw_port, bbscall, db_file)
     if not stat:
-      print("Failed to start the BBS.")
+      logger.error("Failed to start the BBS.")
       shutdown()
-    print("BBS initialized and running.")
+    logger.info("BBS initialized and running.")
   else:
-    print("Not starting the AX.25 server.")
+    logger.info("Not starting the AX.25 server.")
+
+  timers.call_later(bbs.housekeeping_interval, bbs.housekeeping)
 
-  last_housekeeping = time.time()
+  # Private messages for users of other nodes are forwarded to the neighbors
+  if config.getboolean("forward", "enabled", fallback=False):
+    start_forwarding(config, bbscall, db_file)
+
+  # WHO and CHAT reach the users of the other processes of the node
+  if config.getboolean("presence", "enabled", fallback=False):
+    presence.refresh = config.getint("presence", "refresh", fallback=presence.refresh)
+    presence.start(
+      config.get("presence", "directory", fallback="/run/oglbbs"),
+      config.get("presence", "name", fallback=f"{bbscall.upper()}-{os.getpid()}"),
+    )
 
   # === Start BBS ===
-  while True:
+  # Sleep until a connection arrives, a signal or shutdown request wakes us
+  # up, or the next timer is due.
+  while not shutdown_event.is_set():
+    read_fds = [wakeup_r]
     if start_tcp:
-      ssh_server.step()
-    time.sleep(0.1)
-    # Add maintenance tasks.
-    # Cancel chat requests if it is not answered in 30 seconds.
-    # Delete old messages.
-    # Disconnect inactive users.
-    if time.time() - last_housekeeping > 600:
-      # bbs.housekeeping()
-      last_housekeeping = time.time()
-    if shutdown_event.is_set():
-      shutdown()
+      read_fds.append(ssh_server.sock)
+    readable, _, _ = select.select(read_fds, [], [], timers.timeout())
+    if wakeup_r in readable:
+      try:
+        while wakeup_r.recv(512):
+          pass
+      except BlockingIOError:
+        pass
+    if start_tcp and ssh_server.sock in readable:
+      ssh_server.accept_client()
+    # Chat request expiry, idle disconnects and purging deleted messages
+    timers.run()
+  shutdown()
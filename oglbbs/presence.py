@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from . import bbs_db
+from . import session_manager
+
+logger = logging.getLogger(__name__)
+
+# Presence of the sessions of sibling oglbbs processes on this host, e.g. one
+# per TNC, so that WHO and CHAT reach the users of all of them. Each process
+# binds a Unix datagram socket in directory, tells the others as its sessions
+# come and go, and keeps a replica of theirs, so lookups need no round trip.
+# A process starting up asks the others for their sessions, and asks again
+# every refresh seconds, which also mends lost notifications. Chat requests
+# and lines for a user of another process are sent to its socket. A process
+# whose socket refuses datagrams has gone, and its sessions are dropped.
+directory = None
+# Name of this process, also the name of its socket
+name = None
+refresh = 60
+# Called with (target call, event, call, text) for a chat event from another
+# process, on the presence thread
+on_chat = None
+# Largest datagram sent or received
+max_datagram = 65536
+
+_sock = None
+_thread = None
+_running = False
+# Sessions of the other processes, process name -> {(src, dst, port): None}
+_remote = {}
+_lock = threading.Lock()
+
+
+def start(socket_directory, process_name):
+  """Join the other processes sharing socket_directory."""
+  global directory, name, _sock, _thread, _running
+  directory = socket_directory
+  name = process_name
+  os.makedirs(directory, exist_ok=True)
+  path = _path(name)
+  try:
+    os.unlink(path)
+  except FileNotFoundError:
+    pass
+  _sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+  _sock.bind(path)
+  _sock.settimeout(refresh)
+  _running = True
+  session_manager.watchers.append(_session_changed)
+  _thread = threading.Thread(target=_receive_loop, name="presence", daemon=True)
+  _thread.start()
+  _broadcast({"op": "hello"})
+  logger.info("Sharing presence as %s in %s", name, directory)
+
+
+def shutdown():
+  global _running
+  if _sock is None:
+    return
+  _running = False
+  _broadcast({"op": "bye"})
+  try:
+    os.unlink(_path(name))
+  except OSError:
+    pass
+  _sock.close()
+
+
+def _path(process_name):
+  return os.path.join(directory, f"{process_name}.sock")
+
+
+def _others():
+  try:
+    files = os.listdir(directory)
+  except OSError:
+    return []
+  own = f"{name}.sock"
+  return [
+    file[: -len(".sock")] for file in files if file.endswith(".sock") and file != own
+  ]
+
+
+# === Sending ===
+def _send(process_name, message):
+  message["from"] = name
+  data = json.dumps(message, separators=(",", ":")).encode()
+  try:
+    _sock.sendto(data, _path(process_name))
+  except (ConnectionRefusedError, FileNotFoundError):
+    # Nobody is reading the socket any more
+    logger.info("Process %s has gone.", process_name)
+    _forget(process_name)
+    try:
+      os.unlink(_path(process_name))
+    except OSError:
+      pass
+  except OSError as e:
+    logger.warning("Cannot reach process %s: %s", process_name, e)
+
+
+def _broadcast(message):
+  for process_name in _others():
+    _send(process_name, dict(message))
+
+
+def _session_changed(event, session):
+  _broadcast({"op": event, "session": [session.src, session.dst, session.port]})
+
+
+def send_chat(target_call, event, call, text=None):
+  """Send a chat event to the process of target_call, if any has it."""
+  if _sock is None:
+    return False
+  with _lock:
+    owners = [
+      process_name
+      for process_name, sessions in _remote.items()
+      if any(src == target_call for src, _, _ in sessions)
+    ]
+  for process_name in owners:
+    _send(
+      process_name,
+      {"op": "chat", "to": target_call, "event": event, "call": call, "text": text},
+    )
+  return bool(owners)
+
+
+# === Receiving ===
+def _receive_loop():
+  last_hello = time.monotonic()
+  while _running:
+    try:
+      data = _sock.recv(max_datagram)
+    except socket.timeout:
+      data = None
+    except OSError:
+      return
+    if data:
+      try:
+        _handle(json.loads(data))
+      except Exception:
+        logger.exception("Error handling presence message")
+    if time.monotonic() - last_hello >= refresh:
+      last_hello = time.monotonic()
+      _broadcast({"op": "hello"})
+
+
+def _handle(message):
+  sender = message["from"]
+  match message["op"]:
+    case "hello":
+      sessions = [[s.src, s.dst, s.port] for s in session_manager.get_active_sessions()]
+      _send(sender, {"op": "sync", "sessions": sessions})
+    case "sync":
+      with _lock:
+        _remote[sender] = {tuple(key): None for key in message["sessions"]}
+    case "add":
+      with _lock:
+        _remote.setdefault(sender, {})[tuple(message["session"])] = None
+    case "remove":
+      with _lock:
+        _remote.get(sender, {}).pop(tuple(message["session"]), None)
+    case "bye":
+      _forget(sender)
+    case "chat":
+      if on_chat is not None:
+        on_chat(message["to"], message["event"], message["call"], message["text"])
+
+
+def _forget(process_name):
+  with _lock:
+    _remote.pop(process_name, None)
+
+
+# === Lookups ===
+def find(call):
+  """
+  Callsign of a user of another process, matching call exactly or, without
+  SSID, with any SSID. None if there is none.
+  """
+  base = bbs_db.base_callsign(call)
+  match = None
+  with _lock:
+    for sessions in _remote.values():
+      for src, _, _ in sessions:
+        if src == call:
+          return src
+        if match is None and "-" not in call and bbs_db.base_callsign(src) == base:
+          match = src
+  return match
+
+
+def remote_sessions():
+  """Snapshot list of (process name, src, dst, port) of the other processes."""
+  with _lock:
+    return [
+      (process_name, *key)
+      for process_name, sessions in sorted(_remote.items())
+      for key in sessions
+    ]
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Token buckets limiting how fast a station may connect, send commands, store
+# messages and have output queued. Each kind has a rate, in tokens per second,
+# and a burst, the most tokens a bucket holds. AX.25 connects and SSH logins
+# are counted per callsign, without SSID, apart, so failed logins over SSH do
+# not lock a station out of the radio. SSH connections are also counted per
+# source address ("connect_addr"), output in bytes. A rate of 0 turns the limit
+# off.
+limits = {
+  "connect": (0.1, 5),
+  "login": (0.1, 5),
+  "connect_addr": (0.2, 10),
+  "command": (2.0, 20),
+  "message": (0.1, 10),
+  "output": (4096, 65536),
+}
+enabled = True
+# Buckets kept before the full ones are swept out early
+max_buckets = 10000
+
+
+class Bucket:
+  __slots__ = ("tokens", "stamp")
+
+  def __init__(self, tokens, stamp):
+    self.tokens = tokens
+    self.stamp = stamp
+
+
+# Buckets keyed by (kind, key). A full bucket is the same as no bucket, so
+# those are dropped by expire() to keep the table small.
+_buckets = {}
+_lock = threading.Lock()
+
+metrics.describe(
+  "oglbbs_rate_limited_total", "counter", "Actions refused or delayed by rate limits"
+)
+
+
+def _take(kind, key, cost, now):
+  # Called with _lock held. Returns the tokens left, negative if short.
+  rate, burst = limits[kind]
+  bucket = _buckets.get((kind, key))
+  if bucket is None:
+    if len(_buckets) >= max_buckets:
+      _expire(now)
+    bucket = _buckets[(kind, key)] = Bucket(burst, now)
+  else:
+    bucket.tokens = min(burst, bucket.tokens + (now - bucket.stamp) * rate)
+    bucket.stamp = now
+  return bucket.tokens - cost
+
+
+def allow(kind, key, cost=1):
+  """Take cost tokens from the bucket of key, if it has them."""
+  if not enabled or limits[kind][0] <= 0:
+    return True
+  with _lock:
+    left = _take(kind, key, cost, time.monotonic())
+    if left >= 0:
+      _buckets[(kind, key)].tokens = left
+      return True
+  metrics.inc("oglbbs_rate_limited_total", kind=kind)
+  logger.debug("Rate limit %s of %s exceeded.", kind, key)
+  return False
+
+
+def admit(kind, key, count):
+  """
+  Take up to count tokens from the bucket of key, as many as it has, and
+  return the number taken.
+  """
+  if not enabled or limits[kind][0] <= 0:
+    return count
+  with _lock:
+    left = _take(kind, key, count, time.monotonic())
+    taken = count if left >= 0 else max(0, int(left + count))
+    _buckets[(kind, key)].tokens = left + count - taken
+  if taken < count:
+    metrics.inc("oglbbs_rate_limited_total", kind=kind)
+    logger.debug("Rate limit %s of %s exceeded.", kind, key)
+  return taken
+
+
+def delay(kind, key, cost):
+  """
+  Take cost tokens from the bucket of key, going into debt if short, and
+  return the seconds to wait until the debt is paid off.
+  """
+  rate = limits[kind][0]
+  if not enabled or rate <= 0:
+    return 0
+  with _lock:
+    left = _take(kind, key, cost, time.monotonic())
+    _buckets[(kind, key)].tokens = left
+  if left >= 0:
+    return 0
+  metrics.inc("oglbbs_rate_limited_total", kind=kind)
+  return -left / rate
+
+
+def expire():
+  """Drop the buckets which have filled up again."""
+  with _lock:
+    _expire(time.monotonic())
+
+
+def _expire(now):
+  full = []
+  for (kind, key), bucket in _buckets.items():
+    rate, burst = limits[kind]
+    if rate <= 0 or bucket.tokens + (now - bucket.stamp) * rate >= burst:
+      full.append((kind, key))
+  for bucket_key in full:
+    del _buckets[bucket_key]
+
+
+def count():
+  """Number of buckets kept."""
+  return len(_buckets)
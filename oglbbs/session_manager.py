@@ -1,35 +1,211 @@
+import collections
+import logging
+import threading
+import time
+
+from . import bbs_db
+from . import line_assembler
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+  """A user connected to the BBS over AX.25 or SSH."""
+
+  __slots__ = (
+    "src",
+    "dst",
+    "port",
+    "active",
+    "state",
+    "chat_target",
+    "chat_deadline",
+    "room",
+    "more",
+    "ax25_session",
+    "tcp_session",
+    "assembler",
+    "output",
+    "output_lock",
+    "queued",
+    "scheduled",
+    "outbox",
+    "outbox_bytes",
+    "outbox_ready",
+    "writer",
+    "closing",
+    "last_active",
+  )
+
+  def __init__(self, src, dst, port, ax25_session=None, tcp_session=None):
+    self.src = src
+    self.dst = dst
+    self.port = port
+    self.active = True
+    self.state = "new"
+    self.chat_target = None
+    # When an unanswered chat request expires, time.monotonic()
+    self.chat_deadline = None
+    # Name of the chat room the user is in
+    self.room = None
+    # Where MORE continues: (command, page size, last id shown, archived)
+    self.more = None
+    self.ax25_session = ax25_session
+    self.tcp_session = tcp_session
+    self.assembler = line_assembler.LineAssembler()
+    # Output waiting to be flushed to the transport
+    self.output = bytearray()
+    self.output_lock = threading.Lock()
+    # Work waiting for a command worker, and whether the session is in line
+    self.queued = collections.deque()
+    self.scheduled = False
+    # Output waiting for the writer thread of the session, which hangs up once
+    # it is written if closing is set
+    self.outbox = collections.deque()
+    self.outbox_bytes = 0
+    self.outbox_ready = threading.Condition()
+    self.writer = None
+    self.closing = False
+    # When the user last sent anything, time.monotonic()
+    self.last_active = time.monotonic()
+
+  @property
+  def key(self):
+    return (self.src, self.dst, self.port)
+
+  def __repr__(self):
+    return f"Session({self.src} -> {self.dst} on port {self.port}, {self.state})"
+
+
 # Sessions keyed by (src, dst, port)
 sessions = {}
+# Chat rooms, name -> {session: None}, in the order of joining
+rooms = {}
+# Secondary indexes: callsign -> {key: session}, base callsign -> {key: session}
+_by_call = {}
+_by_base_call = {}
+_lock = threading.Lock()
+# Called with ("add" or "remove", session) as sessions come and go
+watchers = []
+
+
+def _notify(event, session):
+  for watcher in watchers:
+    try:
+      watcher(event, session)
+    except Exception:
+      logger.exception("Error notifying %s of session %s", event, session)
+
+
+def _add(session):
+  key = session.key
+  with _lock:
+    old = sessions.get(key)
+    if old is not None:
+      # Its transport is gone or about to be, and remove() will skip it
+      old.active = False
+      _unindex(old)
+      _leave_room(old)
+    sessions[key] = session
+    _by_call.setdefault(session.src, {})[key] = session
+    _by_base_call.setdefault(bbs_db.base_callsign(session.src), {})[key] = session
+  if old is not None:
+    _notify("remove", old)
+  _notify("add", session)
+  return session
+
+
+def _unindex(session):
+  key = session.key
+  for index, call in (
+    (_by_call, session.src),
+    (_by_base_call, bbs_db.base_callsign(session.src)),
+  ):
+    entries = index.get(call)
+    if entries is not None:
+      entries.pop(key, None)
+      if not entries:
+        del index[call]
 
 
 def add_ax25(src, dst, port, session):
   """Add a session to the sessions dictionary."""
-  sessions[(src, dst, port)] = {"active": True, "ax25_session": session, "state": "new"}
-  print(f"Added session: {src} -> {dst} on port {port}")
+  new_session = _add(Session(src, dst, port, ax25_session=session))
+  logger.info("Added session: %s -> %s on port %s", src, dst, port)
+  return new_session
 
 
 def add_tcp(src, dst, port, session):
   """Add a TCP session to the sessions dictionary."""
-  sessions[(src, dst, port)] = {"active": True, "tcp_session": session, "state": "new"}
-  print(f"Added TCP session: {src} -> {dst} on port {port}")
+  new_session = _add(Session(src, dst, port, tcp_session=session))
+  logger.info("Added TCP session: %s -> %s on port %s", src, dst, port)
+  return new_session
 
 
-def remove(src, dst, port):
-  """Remove a session from the sessions dictionary."""
-  if (src, dst, port) in sessions:
-    del sessions[(src, dst, port)]
-    print(f"Removed session: {src} -> {dst} on port {port}")
+def remove(src, dst, port, transport=None):
+  """
+  Remove a session from the sessions dictionary. If transport, the AX.25
+  connection or SSH channel, is given, only remove the session if it belongs to
+  it and not to a newer connection of the same station.
+  """
+  key = (src, dst, port)
+  with _lock:
+    session = sessions.get(key)
+    if session is not None and transport is not None:
+      if transport is not session.ax25_session and transport is not session.tcp_session:
+        logger.debug("Session %s -> %s on port %s was replaced", src, dst, port)
+        return
+    if session is not None:
+      del sessions[key]
+      _unindex(session)
+      _leave_room(session)
+  if session is not None:
+    _notify("remove", session)
+    logger.info("Removed session: %s -> %s on port %s", src, dst, port)
   else:
-    print(f"Session not found: {src} -> {dst} on port {port}")
+    logger.warning("Session not found: %s -> %s on port %s", src, dst, port)
+
+
+def join_room(session, room):
+  """Put the session into a chat room, return the other members."""
+  with _lock:
+    _leave_room(session)
+    members = rooms.setdefault(room, {})
+    others = list(members)
+    members[session] = None
+    session.room = room
+  return others
+
+
+def leave_room(session):
+  """Take the session out of its chat room, return the remaining members."""
+  with _lock:
+    return _leave_room(session)
+
+
+def _leave_room(session):
+  room = session.room
+  session.room = None
+  members = rooms.get(room)
+  if members is None:
+    return []
+  members.pop(session, None)
+  if not members:
+    del rooms[room]
+  return list(members)
+
+
+def room_members(room):
+  """Get a snapshot list of the sessions in a chat room."""
+  with _lock:
+    return list(rooms.get(room, ()))
 
 
 def get_active_sessions():
-  """Get a list of active sessions."""
-  return [
-    ((s, d, port), session)
-    for (s, d, port), session in sessions.items()
-    if session.get("active", False) == True
-  ]
+  """Get a snapshot list of active sessions."""
+  with _lock:
+    return [session for session in sessions.values() if session.active]
 
 
 def get(src, dst, port):
@@ -38,7 +214,33 @@ def get(src, dst, port):
 
 
 def get_all_sessions_by_call(src):
-  """Get a list of sessions for a given src and dst across all ports."""
-  return [
-    ((s, d, port), session) for (s, d, port), session in sessions.items() if s == src
-  ]
+  """Get a snapshot list of sessions of a callsign across all ports."""
+  with _lock:
+    return list(_by_call.get(src, {}).values())
+
+
+def get_all_sessions_by_base_call(call):
+  """Get a snapshot list of sessions of a callsign with any SSID."""
+  with _lock:
+    return list(_by_base_call.get(bbs_db.base_callsign(call), {}).values())
+
+
+def count():
+  """Number of sessions."""
+  return len(sessions)
+
+
+def count_by_transport():
+  """Number of sessions per transport."""
+  with _lock:
+    ax25 = sum(1 for session in sessions.values() if session.ax25_session is not None)
+  return {"ax25": ax25, "tcp": len(sessions) - ax25}
+
+
+metrics.describe("oglbbs_sessions", "gauge", "Connected sessions")
+metrics.gauge(
+  "oglbbs_sessions",
+  lambda: {
+    (("transport", transport),): n for transport, n in count_by_transport().items()
+  },
+)
@@ -1,49 +1,86 @@
+import logging
 import socket
 import paramiko
 import threading
 import select
+import selectors
 import hashlib
+import queue
+import time
 
 from . import session_manager
 from . import bbs_db
 from . import bbs
+from . import metrics
+from . import ratelimit
 
 
+logger = logging.getLogger(__name__)
+
 ssh_dymmy_port_id = 1234
 
+# Host key types tried, in order, when loading a key file
+host_key_classes = (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey)
+# Parsed host keys, shared by all transports
+host_keys = []
+
+# Maximum number of SSH connections, pending or logged in
+max_clients = 100
+# Seconds a client has to authenticate and open a shell
+shell_timeout = 30
+
+sock = None
+# All SSH clients are serviced by a single reactor thread. Paramiko still runs
+# its own transport thread per connection for the SSH protocol itself.
+_selector = None
+_reactor_thread = None
+_running = False
+_wakeup_r = None
+_wakeup_w = None
+# Channels which requested a shell, waiting to be picked up by the reactor
+_ready = queue.SimpleQueue()
+# Channels to be closed by the reactor
+_closing = queue.SimpleQueue()
+# Transports still negotiating, mapped to (start, deadline)
+_pending = {}
+# Logged in clients, channel -> (call, fd)
+_clients = {}
+_clients_lock = threading.Lock()
 
-class SSHServer(paramiko.ServerInterface):
-  def __init__(self):
-    self.event = threading.Event()
 
+class SSHServer(paramiko.ServerInterface):
   def check_auth_password(self, username, password):
-    db = bbs_db.init_db(db_file_name)
-
-    username = username.strip().upper()
-    print(f"Authenticating user: {username}")
-    # Validate the callsign format
-    if bbs.is_valid_callsign(username) is False:
-      print(f"Invalid callsign: {username}")
-      bbs_db.shutdown(db)
-      return paramiko.AUTH_FAILED
-    hashed_password = hashlib.sha1(password.encode("utf-8")).hexdigest()
-    # Check if the user exists in the database and the password matches
-    user = bbs_db.get_user(db, username)
-
-    if user is None:
-      print(f"User {username} not found in database.")
-      bbs_db.add_user_with_password(db, username, hashed_password)
-      print(f"User {username} added to database.")
-    elif user[1] != hashed_password:
-      print(f"Password for user {username} does not match.")
-      bbs_db.shutdown(db)
-      return paramiko.AUTH_FAILED
-    call = username.upper()
-    print(f"Authenticated user: {call}")
-    bbs_db.change_login_time(db, username)
-    bbs_db.shutdown(db)
-    print(f"User {username} authenticated successfully.")
-    return paramiko.AUTH_SUCCESSFUL
+    db = bbs_db.get_db(db_file_name)
+    try:
+      username = username.strip().upper()
+      logger.debug("Authenticating user: %s", username)
+      # Validate the callsign format
+      if bbs.is_valid_callsign(username) is False:
+        logger.warning("Invalid callsign: %s", username)
+        return paramiko.AUTH_FAILED
+      # Every attempt counts, before any hashing or database work
+      if not ratelimit.allow("login", bbs_db.base_callsign(username)):
+        logger.warning("Too many logins of %s, refusing.", username)
+        return paramiko.AUTH_FAILED
+      hashed_password = hashlib.sha1(password.encode("utf-8")).hexdigest()
+      # Check if the user exists in the database and the password matches
+      user = bbs_db.get_user(db, username)
+
+      if user is None:
+        logger.info("User %s not found in database.", username)
+        bbs_db.add_user_with_password(db, username, hashed_password)
+        logger.info("User %s added to database.", username)
+      elif user[1] != hashed_password:
+        logger.warning("Password for user %s does not match.", username)
+        return paramiko.AUTH_FAILED
+      call = username.upper()
+      logger.info("Authenticated user: %s", call)
+      bbs_db.change_login_time(db, username)
+      logger.info("User %s authenticated successfully.", username)
+      return paramiko.AUTH_SUCCESSFUL
+    finally:
+      # The connection goes back to the pool on every path, errors included
+      bbs_db.release_db()
 
   def get_allowed_auths(self, username):
     return "password"
@@ -54,94 +91,232 @@ class SSHServer(paramiko.ServerInterface):
     return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
 
   def check_channel_shell_request(self, channel):
-    self.event.set()
+    # Hand the channel over to the reactor
+    _ready.put(channel)
+    _wakeup()
     return True
 
 
+def load_host_key(key_file):
+  """Load a private host key of any supported type."""
+  for key_class in host_key_classes:
+    try:
+      return key_class.from_private_key_file(key_file)
+    except paramiko.SSHException:
+      continue
+  raise paramiko.SSHException(f"Unsupported or invalid key: {key_file}")
+
+
+def load_host_keys(key_files):
+  """Load and validate the configured host keys, return the parsed keys."""
+  keys = []
+  for key_file in key_files:
+    logger.debug("Loading host key... %s", key_file)
+    try:
+      host_key = load_host_key(key_file)
+    except (OSError, paramiko.SSHException) as e:
+      logger.error("Failed to load host key: %s", e)
+      continue
+    logger.info("Loaded %s host key %s", host_key.get_name(), host_key.fingerprint)
+    keys.append(host_key)
+  return keys
+
+
+class _KexDone(threading.Event):
+  """
+  Set by paramiko when the key exchange of the transport has completed or
+  failed. Records the time since accepting the connection on success, before
+  any waiting for the user to type a password.
+  """
+
+  def __init__(self, transport, accepted):
+    super().__init__()
+    self.transport = transport
+    self.accepted = accepted
+
+  def set(self):
+    if not self.is_set() and self.transport.initial_kex_done:
+      metrics.observe(
+        "oglbbs_ssh_handshake_duration_seconds", time.monotonic() - self.accepted
+      )
+    super().set()
+
+
 def handle_client(client):
+  """Start the SSH negotiation on an accepted socket without blocking."""
+  accepted = time.monotonic()
   transport = paramiko.Transport(client)
-  print(f"Loading host key... {key}")
-  try:
-    if key.endswith("rsa"):
-      host_key = paramiko.RSAKey(filename=key)
-    else:
-      host_key = paramiko.Ed25519Key(filename=key)
+  for host_key in host_keys:
     transport.add_server_key(host_key)
-  except Exception as e:
-    print(f"Failed to load host key: {e}")
-    transport.close()
-    close_client(client)
-    return
-  server = SSHServer()
 
   try:
-    transport.start_server(server=server)
+    # Passing an event makes the negotiation run in the transport thread
+    transport.start_server(event=_KexDone(transport, accepted), server=SSHServer())
   except paramiko.SSHException:
-    print("SSH negotiation failed.")
-    return
-
-  chan = transport.accept(20)
-  if chan is None:
-    print("No channel.")
+    logger.warning("SSH negotiation failed.")
+    transport.close()
     return
 
-  server.event.wait(10)
-  if not server.event.is_set():
-    print("No shell request.")
-    return
+  with _clients_lock:
+    now = time.monotonic()
+    _pending[transport] = (now, now + shell_timeout)
+  _wakeup()
 
-  # Get the authenticated username from the transport
-  print("Client connected, waiting for username...")
-  username = transport.get_username() if hasattr(transport, "get_username") else None
-  print(f"Authenticated username: {username}")
-  if username is None and hasattr(transport, "remote_username"):
-    username = transport.remote_username
 
-  call = username.upper()
+def _wakeup():
+  try:
+    _wakeup_w.send(b"\0")
+  except (BlockingIOError, OSError):
+    pass
 
-  print(f"Authenticated user: {call}")
 
-  session_manager.add_tcp(call, bbscallsign, ssh_dymmy_port_id, chan)
-  bbs.send_greeting(call, bbscallsign, ssh_dymmy_port_id)
-  if call is not None:
+def _register_ready():
+  while True:
+    try:
+      chan = _ready.get_nowait()
+    except queue.Empty:
+      return
+    transport = chan.get_transport()
+    # Drain the accept queue of the transport, the channel is handled here
+    transport.accept(0)
+    username = transport.get_username()
+    with _clients_lock:
+      _pending.pop(transport, None)
+    if username is None:
+      logger.warning("No authenticated user.")
+      chan.close()
+      transport.close()
+      continue
+
+    call = username.strip().upper()
+    logger.info("Authenticated user: %s", call)
+    fd = chan.fileno()
+    with _clients_lock:
+      _clients[chan] = (call, fd)
+    _selector.register(fd, selectors.EVENT_READ, chan)
+    session_manager.add_tcp(call, bbscallsign, ssh_dymmy_port_id, chan)
     try:
-      while True:
-        fd = chan.fileno()
-        if fd < 0:
-          break
-        if chan.closed == True:
-          print("Channel closed.")
-          break
-        data = chan.recv(1024).decode("utf-8").strip()
-        if not data:
-          data = "\n"
-        bbs.handle_command(db_file_name, call, bbscallsign, ssh_dymmy_port_id, data)
+      bbs.send_greeting(call, bbscallsign, ssh_dymmy_port_id)
     except Exception as e:
-      print(f"Error: {e}")
+      logger.error("Error: %s", e)
+      _drop(chan)
+
+
+def _service(chan):
+  try:
+    data = chan.recv(1024)
+  except Exception as e:
+    logger.error("Error: %s", e)
+    data = b""
+  if not data:
+    _drop(chan)
+    return
+  call, _ = _clients[chan]
+  bbs.handle_data(db_file_name, call, bbscallsign, ssh_dymmy_port_id, data)
+
 
-  chan.close()
+def _drop(chan):
+  with _clients_lock:
+    client = _clients.pop(chan, None)
+  if client is None:
+    return
+  call, fd = client
+  # Unregister before closing, closing the channel closes its fd
+  try:
+    _selector.unregister(fd)
+  except (KeyError, ValueError):
+    pass
+  transport = chan.get_transport()
+  try:
+    chan.close()
+  except Exception as e:
+    # The client may have hung up first
+    logger.debug("Error closing channel: %s", e)
   transport.close()
-  print("Client disconnected.")
+  logger.info("Client disconnected.")
+  session_manager.remove(call, bbscallsign, ssh_dymmy_port_id, chan)
+  logger.info("Session removed.")
+
+
+def _expire_pending():
+  now = time.monotonic()
+  with _clients_lock:
+    expired = [
+      transport
+      for transport, (_, deadline) in _pending.items()
+      if deadline < now or not transport.is_active()
+    ]
+    for transport in expired:
+      del _pending[transport]
+  for transport in expired:
+    if transport.is_active():
+      logger.warning("No shell request.")
+    transport.close()
+
 
-  # Remove the session
-  if call is not None:
-    session_manager.remove(call, bbscallsign, ssh_dymmy_port_id)
-    print("Session removed.")
+def _reactor():
+  while _running:
+    # Only wake up periodically while handshakes are pending
+    timeout = 1 if _pending else None
+    for selector_key, _ in _selector.select(timeout=timeout):
+      if selector_key.data is None:
+        try:
+          while _wakeup_r.recv(512):
+            pass
+        except BlockingIOError:
+          pass
+        _register_ready()
+        while not _closing.empty():
+          _drop(_closing.get())
+      else:
+        try:
+          _service(selector_key.data)
+        except Exception as e:
+          logger.error("Error: %s", e)
+          _drop(selector_key.data)
+    _expire_pending()
+  for chan in list(_clients):
+    _drop(chan)
+
+
+metrics.describe(
+  "oglbbs_ssh_handshake_duration_seconds",
+  "histogram",
+  "Time from accepting an SSH connection to the end of its key exchange",
+)
+metrics.describe(
+  "oglbbs_ssh_refused_total", "counter", "SSH connections refused, by reason"
+)
+metrics.describe(
+  "oglbbs_ssh_clients", "gauge", "SSH connections, pending and logged in"
+)
+metrics.gauge("oglbbs_ssh_clients", lambda: {(): client_count()})
+
+
+def client_count():
+  """Number of SSH connections, pending and logged in."""
+  with _clients_lock:
+    return len(_pending) + len(_clients)
 
 
 def close_client(client):
+  if client in _clients:
+    # Channels are closed by the reactor, which owns their fds
+    _closing.put(client)
+    _wakeup()
+    return
   try:
-    print(f"Closing client connection...")
+    logger.debug("Closing client connection...")
     client.close()
   except Exception as e:
-    print(f"Error closing client: {e}")
+    logger.error("Error closing client: %s", e)
 
 
 def send_data(chan, data):
   try:
-    chan.send(data)
+    chan.sendall(data)
   except Exception as e:
-    print(f"Error sending data: {e}")
+    logger.error("Error sending data: %s", e)
     return False
   return True
 
@@ -149,37 +324,83 @@ def send_data(chan, data):
 def start_ssh_server(
   host="127.0.0.1",
   port=8002,
-  key_file="/etc/ssh/ssh_host_rsa_key",
+  key_files=("/etc/ssh/ssh_host_rsa_key",),
   bbscall="N0CALL",
   db_file="bbs.db",
+  max_conn=100,
 ):
   global sock
-  global key
+  global host_keys
   global bbscallsign
   global db_file_name
+  global max_clients
+  global _selector, _reactor_thread, _running, _wakeup_r, _wakeup_w
   db_file_name = db_file
   bbscallsign = bbscall
-  key = key_file
+  max_clients = max_conn
+  host_keys = load_host_keys(key_files)
+  if not host_keys:
+    logger.error("No usable SSH host key.")
+    return False
   sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
   sock.bind((host, port))
   sock.listen(100)
-  print(f"SSH server started on {host}:{port}")
+  sock.setblocking(False)
+
+  _wakeup_r, _wakeup_w = socket.socketpair()
+  _wakeup_r.setblocking(False)
+  _wakeup_w.setblocking(False)
+  _selector = selectors.DefaultSelector()
+  _selector.register(_wakeup_r, selectors.EVENT_READ, None)
+  _running = True
+  _reactor_thread = threading.Thread(target=_reactor, name="ssh-reactor", daemon=True)
+  _reactor_thread.start()
+  logger.info("SSH server started on %s:%s, max %s clients", host, port, max_clients)
   return True
 
 
+def accept_client():
+  """Accept a pending connection. Call when the listening socket is readable."""
+  try:
+    client, addr = sock.accept()
+  except BlockingIOError:
+    return
+  except Exception as e:
+    logger.error("Error accepting connection: %s", e)
+    return
+  if client_count() >= max_clients:
+    logger.warning(
+      "Refusing connection from %s: %s clients connected", addr, max_clients
+    )
+    metrics.inc("oglbbs_ssh_refused_total", reason="max_clients")
+    client.close()
+    return
+  # Refused before the SSH handshake and its key exchange
+  if not ratelimit.allow("connect_addr", addr[0]):
+    logger.warning("Refusing connection from %s: too many connects", addr)
+    metrics.inc("oglbbs_ssh_refused_total", reason="rate_limit")
+    client.close()
+    return
+  logger.info("New connection from %s", addr)
+  client.setblocking(True)
+  handle_client(client)
+
+
 def step():
   if sock is None or sock.fileno() < 0:
     return
   readable, _, _ = select.select([sock], [], [], 0)
   if readable:
-    try:
-      client, addr = sock.accept()
-      print(f"New connection from {addr}")
-      threading.Thread(target=handle_client, args=(client,)).start()
-    except Exception as e:
-      print(f"Error accepting connection: {e}")
+    accept_client()
 
 
 def shutdown():
-  sock.close()
-  print("SSH server shut down.")
+  global _running
+  # Nothing was started if no host key could be loaded
+  if sock is not None:
+    sock.close()
+  _running = False
+  if _reactor_thread is not None:
+    _wakeup()
+    _reactor_thread.join(timeout=2)
+  logger.info("SSH server shut down.")
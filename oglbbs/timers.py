@@ -0,0 +1,100 @@
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Hashed timer wheel for the deadlines of every session (chat requests, idle
+# links) and the periodic housekeeping. Timers are kept in one of wheel_size
+# slots by the tick they are due, so scheduling and cancelling cost O(1) no
+# matter how many are pending. The main loop sleeps until the first slot
+# holding timers is due and calls run(), which only looks at the slots passed.
+tick = 1.0
+wheel_size = 256
+# Called when a timer is scheduled earlier than the main loop sleeps, to wake
+# it up. Safe to call from any thread.
+wake = None
+
+
+class Timer:
+  __slots__ = ("tick", "func", "args", "cancelled")
+
+  def __init__(self, due_tick, func, args):
+    self.tick = due_tick
+    self.func = func
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+
+_wheel = [[] for _ in range(wheel_size)]
+_lock = threading.Lock()
+_next_tick = int(time.monotonic() / tick)
+# No timer is due before this tick, None if none is pending
+_earliest = None
+
+
+def call_later(delay, func, *args):
+  """
+  Run func(*args) on the main loop after delay seconds, rounded up to the next
+  tick. Safe to call from any thread.
+  """
+  global _earliest
+  due = math.ceil((time.monotonic() + delay) / tick)
+  with _lock:
+    timer = Timer(max(due, _next_tick), func, args)
+    _wheel[timer.tick % wheel_size].append(timer)
+    earlier = _earliest is None or timer.tick < _earliest
+    if earlier:
+      _earliest = timer.tick
+  if earlier and wake is not None:
+    wake()
+  return timer
+
+
+def timeout():
+  """Seconds until a timer may be due, None if none is pending."""
+  with _lock:
+    earliest = _earliest
+  if earliest is None:
+    return None
+  return max(0, earliest * tick - time.monotonic())
+
+
+def run():
+  """Run the timers which are due."""
+  global _next_tick, _earliest
+  now = int(time.monotonic() / tick)
+  due = []
+  with _lock:
+    # After a long stall every slot is visited once
+    last = min(now, _next_tick + wheel_size - 1)
+    for slot_tick in range(_next_tick, last + 1):
+      slot = _wheel[slot_tick % wheel_size]
+      if not slot:
+        continue
+      remaining = []
+      for timer in slot:
+        if timer.cancelled:
+          continue
+        if timer.tick <= now:
+          due.append(timer)
+        else:
+          remaining.append(timer)
+      _wheel[slot_tick % wheel_size] = remaining
+    _next_tick = max(_next_tick, now + 1)
+    # The first slot holding timers. Those may be due a turn of the wheel
+    # later, then the main loop wakes up once for nothing.
+    _earliest = None
+    for slot_tick in range(_next_tick, _next_tick + wheel_size):
+      if _wheel[slot_tick % wheel_size]:
+        _earliest = slot_tick
+        break
+  for timer in due:
+    try:
+      timer.func(*timer.args)
+    except Exception:
+      logger.exception("Error in timer %s", timer.func)
@@ -0,0 +1,30 @@
+import pytest
+
+from oglbbs import bbs_db
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+  monkeypatch.setattr(bbs_db, "archive_file", str(tmp_path / "archive.db"))
+  monkeypatch.setattr(bbs_db, "private_max_age_days", 30)
+  db_file = str(tmp_path / "bbs.db")
+  bbs_db.init_db(db_file)
+  yield bbs_db.get_db(db_file)
+  bbs_db.release_db()
+
+
+def test_messages_waiting_for_forwarding_are_kept(db):
+  bbs_db.store_private_message(db, "BE0AAA", "BE0CCC", "for away", "BE0XYZ")
+  bbs_db.store_private_message(db, "BE0AAA", "BE0DDD", "for here")
+  db.execute("UPDATE messages SET timestamp = datetime('now', '-60 days')")
+  db.commit()
+  assert bbs_db.archive_expired(db) == 1
+  assert db.execute("SELECT content FROM main.messages").fetchall() == [("for away",)]
+
+  # Archived once the peers have acknowledged it, with its routing
+  msg_id = db.execute("SELECT id FROM main.messages").fetchone()[0]
+  assert bbs_db.archive_expired(db, forwarded_id=msg_id) == 1
+  row = db.execute(
+    "SELECT home_bbs FROM archive.messages WHERE content = 'for away'"
+  ).fetchone()
+  assert row == ("BE0XYZ",)
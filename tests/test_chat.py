@@ -0,0 +1,41 @@
+import pytest
+
+from oglbbs import bbs
+from oglbbs import bbs_db
+from oglbbs import session_manager
+
+from test_forward import Channel
+
+
+@pytest.fixture
+def sessions(tmp_path):
+  db_file = str(tmp_path / "bbs.db")
+  bbs_db.init_db(db_file)
+  bbs.db_filename = db_file
+  if bbs._session_changed not in session_manager.watchers:
+    session_manager.watchers.append(bbs._session_changed)
+  calls = ("BE0AAA", "BE0CCC")
+  yield [session_manager.add_tcp(call, "BE0BBS", 0, Channel()) for call in calls]
+  for call in calls:
+    session_manager.remove(call, "BE0BBS", 0)
+  bbs_db.release_db()
+
+
+def test_request_ends_when_requester_leaves(sessions):
+  requester, target = sessions
+  bbs.handle_command(bbs.db_filename, "BE0AAA", "BE0BBS", 0, "CHAT BE0CCC")
+  assert target.state == "chat_request"
+  session_manager.remove("BE0AAA", "BE0BBS", 0)
+  assert target.state == "new"
+  assert target.chat_target is None
+  assert b"Chat request timed out." in target.tcp_session.out
+
+
+def test_chat_ends_when_partner_leaves(sessions):
+  requester, target = sessions
+  bbs.handle_command(bbs.db_filename, "BE0AAA", "BE0BBS", 0, "CHAT BE0CCC")
+  bbs.handle_command(bbs.db_filename, "BE0CCC", "BE0BBS", 0, "ACCEPT")
+  assert requester.state == "chat"
+  session_manager.remove("BE0CCC", "BE0BBS", 0)
+  assert requester.state == "new"
+  assert b"Chat session ended." in requester.tcp_session.out
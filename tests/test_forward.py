@@ -0,0 +1,56 @@
+import pytest
+
+from oglbbs import bbs
+from oglbbs import bbs_db
+from oglbbs import forward
+from oglbbs import session_manager
+
+
+class Channel:
+  """Stands in for the SSH channel of a session."""
+
+  def __init__(self):
+    self.out = b""
+
+  def sendall(self, data):
+    self.out += data
+
+  def close(self):
+    pass
+
+
+@pytest.fixture
+def db(tmp_path):
+  db_file = str(tmp_path / "bbs.db")
+  bbs_db.init_db(db_file)
+  yield bbs_db.get_db(db_file)
+  bbs_db.release_db()
+  forward.peers.clear()
+  forward.node_call = None
+
+
+@pytest.fixture
+def session(db):
+  channel = Channel()
+  session = session_manager.add_tcp("BE0AAA", "BE0BBS", 0, channel)
+  yield session
+  session_manager.remove("BE0AAA", "BE0BBS", 0)
+
+
+def test_local_send_is_not_forwarded(db, session):
+  bbs.send_private_message(session, db, "BE1XY-2", "hello")
+  row = db.execute("SELECT recipient, home_bbs FROM messages").fetchone()
+  assert row == ("BE1XY-2", None)
+  assert b"Message sent to BE1XY-2" in session.tcp_session.out
+
+
+def test_received_message_without_node_is_local(db):
+  line = (
+    b'{"msgid":"7@BE0CCC","from":"BE0CCC","to":"BE0AAA","bbs":null,'
+    b'"text":"hi","at":"2026-01-01 00:00:00"}\n'
+  )
+  row = forward._decode(line)
+  assert row[3] is None
+  assert bbs_db.store_forwarded(db, "BE0BBS", [row]) == 1
+  stored = db.execute("SELECT recipient, home_bbs FROM messages").fetchone()
+  assert stored == ("BE0AAA", None)